@@ -1,17 +1,19 @@
 from ..PulsePrimitives import *
 from ..Compiler import compile_to_hardware
 from ..PulseSequencePlotter import plot_pulse_files
-from ..Cliffords import clifford_seq, clifford_mat, inverse_clifford
 from .helpers import create_cal_seqs, cal_descriptor
 
 import os
 from csv import reader
 import numpy as np
 from functools import reduce
+from itertools import chain
 
 
-def create_RB_seqs(numQubits, lengths, repeats=32, interleaveGate=None, recovery=True):
-    """Create a list of lists of Clifford gates to implement RB. """
+def create_RB_arrays(numQubits, lengths, repeats=32, interleaveGate=None, recovery=True):
+    """Create the Clifford gates of RB sequences as integer arrays, one array
+    of shape (repeats, gates) per length. The recovery gates of all the
+    sequences are computed at once from the Clifford tables."""
     if numQubits == 1:
         cliffGroupSize = 24
     elif numQubits == 2:
@@ -19,35 +21,31 @@ def create_RB_seqs(numQubits, lengths, repeats=32, interleaveGate=None, recovery
     else:
         raise Exception("Can only handle one or two qubits.")
 
-    #Create lists of of random integers
-    #Subtract one from length for recovery gate
-    seqs = []
+    # the Clifford tables are only imported when needed, they are slow to set up
+    from ..Cliffords import clifford_table
+    table = clifford_table(numQubits)
+    arrays = []
     for length in lengths:
-        seqs += np.random.randint(0, cliffGroupSize,
-                                  size=(repeats, length - 1)).tolist()
+        #Subtract one from length for recovery gate
+        seqs = np.random.randint(0, cliffGroupSize, size=(repeats, length - 1))
+        #Possibly inject the interleaved gate
+        if interleaveGate:
+            seqs = np.stack((seqs, np.full_like(seqs, interleaveGate)),
+                            axis=-1).reshape(repeats, -1)
+        if recovery:
+            seqs = np.hstack((seqs, table.inverse(table.product(seqs))[:, None]))
+        arrays.append(seqs)
+    return arrays
 
-    #Possibly inject the interleaved gate
-    if interleaveGate:
-        newSeqs = []
-        for seq in seqs:
-            newSeqs.append(np.vstack((np.array(
-                seq, dtype=np.int), interleaveGate * np.ones(
-                    len(seq), dtype=np.int))).flatten(order='F').tolist())
-        seqs = newSeqs
-
-    if recovery:
-        #Calculate the recovery gate
-        for seq in seqs:
-            if len(seq) == 1:
-                mat = clifford_mat(seq[0], numQubits)
-            else:
-                mat = reduce(lambda x, y: np.dot(y, x),
-                             [clifford_mat(c, numQubits) for c in seq])
-            seq.append(inverse_clifford(mat))
 
+def create_RB_seqs(numQubits, lengths, repeats=32, interleaveGate=None, recovery=True):
+    """Create a list of lists of Clifford gates to implement RB. """
+    seqs = []
+    for array in create_RB_arrays(numQubits, lengths, repeats, interleaveGate, recovery):
+        seqs += array.tolist()
     return seqs
 
-def SingleQubitRB(qubit, seqs, purity=False, showPlot=False, add_cals=True):
+def SingleQubitRB(qubit, seqs, purity=False, showPlot=False, add_cals=True, library=False):
     """Single qubit randomized benchmarking using 90 and 180 generators.
 
     Parameters
@@ -55,14 +53,19 @@ def SingleQubitRB(qubit, seqs, purity=False, showPlot=False, add_cals=True):
     qubit : logical channel to implement sequence (LogicalChannel)
     seqs : list of lists of Clifford group integers
     showPlot : whether to plot (boolean)
+    library : build the pulses of each Clifford once and share them between
+        all its uses, with a single choice of generators (see CliffordLibrary)
     """
 
+    from ..Cliffords import clifford_seq, CliffordLibrary
+    gate = lambda c: clifford_seq(c, qubit)
+    if library:
+        gate = CliffordLibrary(gate)
     seqsBis = []
     op = [Id(qubit, length=0), Y90m(qubit), X90(qubit)]
     for ct in range(3 if purity else 1):
         for seq in seqs:
-            seqsBis.append(reduce(operator.add, [clifford_seq(c, qubit)
-                                                for c in seq]))
+            seqsBis.append(list(chain.from_iterable(gate(c) for c in seq)))
             #append tomography pulse to measure purity
             seqsBis[-1].append(op[ct])
             #append measurement
@@ -87,7 +90,7 @@ def SingleQubitRB(qubit, seqs, purity=False, showPlot=False, add_cals=True):
     return metafile
 
 
-def TwoQubitRB(q1, q2, seqs, showPlot=False, suffix="", add_cals=True):
+def TwoQubitRB(q1, q2, seqs, showPlot=False, suffix="", add_cals=True, library=False):
     """Two qubit randomized benchmarking using 90 and 180 single qubit generators and ZX90
 
     Parameters
@@ -96,11 +99,16 @@ def TwoQubitRB(q1, q2, seqs, showPlot=False, suffix="", add_cals=True):
     seqs : list of lists of Clifford group integers
     showPlot : whether to plot (boolean)
     suffix : suffix to apply to sequence file names
+    library : build the pulses of each Clifford once and share them between
+        all its uses, with a single choice of generators (see CliffordLibrary)
     """
+    from ..Cliffords import clifford_seq, CliffordLibrary
+    gate = lambda c: clifford_seq(c, q2, q1)
+    if library:
+        gate = CliffordLibrary(gate)
     seqsBis = []
     for seq in seqs:
-        seqsBis.append(reduce(operator.add, [clifford_seq(c, q2, q1)
-                                             for c in seq]))
+        seqsBis.append(list(chain.from_iterable(gate(c) for c in seq)))
 
     #Add the measurement to all sequences
     for seq in seqsBis:
@@ -124,7 +132,7 @@ def TwoQubitRB(q1, q2, seqs, showPlot=False, suffix="", add_cals=True):
         plot_pulse_files(metafile)
     return metafile
 
-def SingleQubitRB_AC(qubit, seqs, purity=False, showPlot=False, add_cals=True):
+def SingleQubitRB_AC(qubit, seqs, purity=False, showPlot=False, add_cals=True, library=False):
     """Single qubit randomized benchmarking using atomic Clifford pulses.
 
     Parameters
@@ -132,12 +140,18 @@ def SingleQubitRB_AC(qubit, seqs, purity=False, showPlot=False, add_cals=True):
     qubit : logical channel to implement sequence (LogicalChannel)
     seqFile : file containing sequence strings
     showPlot : whether to plot (boolean)
+    library : build the pulse of each Clifford once and share it between all
+        its uses (see CliffordLibrary)
     """
+    from ..Cliffords import CliffordLibrary
+    gate = lambda c: AC(qubit, c)
+    if library:
+        gate = CliffordLibrary(gate)
     seqsBis = []
     op = [Id(qubit, length=0), Y90m(qubit), X90(qubit)]
     for ct in range(3 if purity else 1):
         for seq in seqs:
-            seqsBis.append([AC(qubit, c) for c in seq])
+            seqsBis.append([gate(c) for c in seq])
             #append tomography pulse to measure purity
             seqsBis[-1].append(op[ct])
             #append measurement
@@ -161,7 +175,7 @@ def SingleQubitRB_AC(qubit, seqs, purity=False, showPlot=False, add_cals=True):
         plot_pulse_files(metafile)
     return metafile
 
-def SingleQubitRB_DiAC(qubit, seqs, compiled=True, purity=False, showPlot=False, add_cals=True):
+def SingleQubitRB_DiAC(qubit, seqs, compiled=True, purity=False, showPlot=False, add_cals=True, library=False):
     """Single qubit randomized benchmarking using diatomic Clifford pulses.
 
     Parameters
@@ -172,12 +186,18 @@ def SingleQubitRB_DiAC(qubit, seqs, compiled=True, purity=False, showPlot=False,
     purity : measure <Z>,<X>,<Y> of final state, to measure purity. See J.J.
         Wallman et al., New J. Phys. 17, 113020 (2015)
     showPlot : whether to plot (boolean)
+    library : build the pulses of each Clifford once and share them between
+        all its uses (see CliffordLibrary)
     """
+    from ..Cliffords import CliffordLibrary
+    gate = lambda c: DiAC(qubit, c, compiled)
+    if library:
+        gate = CliffordLibrary(gate)
     seqsBis = []
     op = [Id(qubit, length=0), Y90m(qubit), X90(qubit)]
     for ct in range(3 if purity else 1):
         for seq in seqs:
-            seqsBis.append([DiAC(qubit, c, compiled) for c in seq])
+            seqsBis.append([gate(c) for c in seq])
             #append tomography pulse to measure purity
             seqsBis[-1].append(op[ct])
             #append measurement
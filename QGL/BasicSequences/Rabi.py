@@ -31,7 +31,8 @@ def RabiAmp(qubit, amps, phase=0, showPlot=False):
         'partition': 1
     }]
 
-    metafile = compile_to_hardware(seqs, 'Rabi/Rabi', axis_descriptor=axis_descriptor)
+    metafile = compile_to_hardware(seqs, 'Rabi/Rabi', axis_descriptor=axis_descriptor,
+        sweep_template=True)
 
     if showPlot:
         plot_pulse_files(metafile)
@@ -67,7 +68,7 @@ def RabiWidth(qubit,
                     shape_fun=shape_fun), MEAS(qubit)] for l in widths]
 
     metafile = compile_to_hardware(seqs, 'Rabi/Rabi',
-        axis_descriptor=[delay_descriptor(widths)])
+        axis_descriptor=[delay_descriptor(widths)], sweep_template=True)
 
     if showPlot:
         plot_pulse_files(metafile)
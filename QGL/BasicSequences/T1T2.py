@@ -1,7 +1,7 @@
 from ..PulsePrimitives import *
 from ..Compiler import compile_to_hardware
 from ..PulseSequencePlotter import plot_pulse_files
-from scipy.constants import pi
+from numpy import pi
 from .helpers import create_cal_seqs, delay_descriptor, cal_descriptor
 
 
@@ -36,7 +36,8 @@ def InversionRecovery(qubit,
         axis_descriptor=[
             delay_descriptor(delays),
             cal_descriptor((qubit,), calRepeats)
-        ])
+        ],
+        sweep_template=True)
 
     if showPlot:
         plot_pulse_files(metafile)
@@ -80,7 +81,8 @@ def Ramsey(qubit,
         axis_descriptor=[
             delay_descriptor(pulseSpacings),
             cal_descriptor((qubit,), calRepeats)
-        ])
+        ],
+        sweep_template=True)
 
     if showPlot:
         plot_pulse_files(metafile)
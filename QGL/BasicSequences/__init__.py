@@ -2,7 +2,7 @@ from .Rabi import RabiAmp, RabiWidth, RabiAmpPi, RabiAmp_NQubits, PulsedSpec, Si
 from .T1T2 import Ramsey, InversionRecovery
 from .FlipFlop import FlipFlop
 from .SPAM import SPAM
-from .RB import create_RB_seqs, SingleQubitRB, SingleQubitRB_AC, SingleQubitRB_DiAC, SingleQubitIRB_AC, SimultaneousRB_AC, SingleQubitRBT, TwoQubitRB
+from .RB import create_RB_seqs, create_RB_arrays, SingleQubitRB, SingleQubitRB_AC, SingleQubitRB_DiAC, SingleQubitIRB_AC, SimultaneousRB_AC, SingleQubitRBT, TwoQubitRB
 from .Decoupling import HahnEcho, CPMG
 from .helpers import create_cal_seqs, delay_descriptor, cal_descriptor
 from .CR import EchoCRPhase, EchoCRLen, EchoCRAmp, PiRabi
@@ -33,16 +33,9 @@ import re
 import traceback
 import datetime
 import importlib
-from atom.api import Atom, Str, Int, Typed
-import networkx as nx
+from atom.api import Atom, Str, Int, Typed, ForwardTyped
 import yaml
 
-# FSEvents observer in watchdog cannot have multiple watchers of the same path
-# use kqueue instead
-if sys.platform == 'darwin':
-    from watchdog.observers.kqueue import KqueueObserver as Observer
-else:
-    from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import time
 
@@ -103,6 +96,13 @@ class LibraryFileWatcher(object):
             finally:
                 loader.dispose()
 
+        # FSEvents observer in watchdog cannot have multiple watchers of the same path
+        # use kqueue instead
+        if sys.platform == 'darwin':
+            from watchdog.observers.kqueue import KqueueObserver as Observer
+        else:
+            from watchdog.observers import Observer
+
         self.eventHandler = MyEventHandler(self.filenames, self.callback)
         self.observer = Observer()
         self.observer.schedule(self.eventHandler, path=os.path.dirname(os.path.abspath(main_path)))
@@ -123,7 +123,8 @@ class LibraryFileWatcher(object):
 class ChannelLibrary(Atom):
     # channelDict = Dict(Str, Channel)
     channelDict = Typed(dict)
-    connectivityG = Typed(nx.DiGraph)
+    # networkx is slow to import, so only do it when creating a library
+    connectivityG = ForwardTyped(lambda: importlib.import_module('networkx').DiGraph)
     library_file = Str()
     fileWatcher = Typed(LibraryFileWatcher)
     version = Int(5)
@@ -136,6 +137,8 @@ class ChannelLibrary(Atom):
         """Create the channel library. We assume that the user wants the config file in the 
         usual locations specified in the config files."""
         
+        import networkx as nx
+
         # Load the basic config options from the yaml
         self.library_file = config.load_config(library_file)
 
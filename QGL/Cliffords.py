@@ -1,6 +1,8 @@
 """
 Manipulating Cliffords.  Mainly for RB purposes.
 """
+import logging
+import os
 import numpy as np
 from scipy.linalg import expm
 from numpy import pi
@@ -9,8 +11,11 @@ from random import choice
 import operator
 from functools import reduce
 
+from . import config
 from .PulsePrimitives import *
 
+logger = logging.getLogger(__name__)
+
 #Single qubit paulis
 pX = np.array([[0, 1], [1, 0]], dtype=np.complex128)
 pY = np.array([[0, -1j], [1j, 0]], dtype=np.complex128)
@@ -186,6 +191,7 @@ def entangling_seq(gate, q1, q2):
             q2, q1), (X90(q1) + Y90m(q1)) * X90(q2), ZX90_CR(q2, q1)]
 
 
+@memoize
 def entangling_mat(gate):
     """
 	Helper function to create the entangling gate matrix
@@ -223,6 +229,24 @@ def clifford_seq(c, q1, q2=None):
         return seq
 
 
+class CliffordLibrary(object):
+    """
+	Pulses of the Cliffords, built by gate(c) the first time Clifford c is
+	asked for and shared by all later uses. Where gate makes a random choice
+	between equivalent decompositions (as clifford_seq does), it is made once
+	per Clifford.
+	"""
+
+    def __init__(self, gate):
+        self.gate = gate
+        self.pulses = {}
+
+    def __call__(self, c):
+        if c not in self.pulses:
+            self.pulses[c] = self.gate(c)
+        return self.pulses[c]
+
+
 @memoize
 def clifford_mat(c, numQubits):
     """
@@ -243,20 +267,173 @@ def clifford_mat(c, numQubits):
         return mat
 
 
+"""
+Cliffords map Paulis to Paulis by conjugation, and this action determines them
+up to a global phase. We tabulate it for each Clifford as an array 'action'
+over the n-qubit Paulis P_p of pauli_mats: action[p] = q + len(action) * s
+where C P_p C^dag = (-1)^s P_q. Composing and inverting Cliffords is then
+integer indexing, and a Clifford is found from its action with a dictionary.
+"""
+
+#Bump when the enumeration of the Cliffords changes to invalidate saved tables
+CLIFFORD_TABLE_VERSION = 1
+
+
+def pauli_action(mats):
+    """
+	Return the actions of an array of Clifford matrices on the Paulis.
+	"""
+    mats = np.asarray(mats)
+    dim = mats.shape[-1]
+    paulis = np.array(pauli_mats(int(np.log2(dim))))
+    # coefficients[c, p, q] = tr(P_q C P_p C^dag) / dim
+    conjugated = np.einsum('cij,pjk,clk->cpil', mats, paulis, mats.conj())
+    coefficients = np.einsum('qli,cpil->cpq', paulis, conjugated).real / dim
+    images = np.abs(coefficients).argmax(axis=-1)
+    signs = np.take_along_axis(coefficients, images[..., None], axis=-1)[..., 0]
+    if not np.allclose(np.abs(signs), 1):
+        raise ValueError("Not a Clifford matrix.")
+    return (images + len(paulis) * (signs < 0)).astype(np.uint8)
+
+
+def compose_actions(first, second):
+    """
+	Return the action of applying the Clifford(s) with action 'first' and then
+	'second'. Works on stacked actions along the leading axes.
+	"""
+    num = first.shape[-1]
+    images = np.take_along_axis(second, first % num, axis=-1)
+    return images % num + num * ((first >= num) ^ (images >= num))
+
+
+def reduce_actions(actions):
+    """
+	Return the action of applying in turn the Cliffords with the actions
+	stacked along the second to last axis, composing them pairwise.
+	"""
+    while actions.shape[-2] > 1:
+        composed = compose_actions(actions[..., 0:-1:2, :], actions[..., 1::2, :])
+        if actions.shape[-2] % 2:
+            composed = np.concatenate((composed, actions[..., -1:, :]), axis=-2)
+        actions = composed
+    return actions[..., 0, :]
+
+
+def invert_action(action):
+    """
+	Return the action of the inverse of the Clifford(s) with 'action'.
+	"""
+    num = action.shape[-1]
+    inverse = np.empty_like(action)
+    np.put_along_axis(inverse, action % num,
+                      np.arange(num, dtype=action.dtype) + num * (action >= num),
+                      axis=-1)
+    return inverse
+
+
+def clifford_table_file(numQubits):
+    """
+	Return the file the tables of the numQubits Cliffords are saved to, next
+	to the compile cache, or None if config.AWGDir is not set.
+	"""
+    if not config.AWGDir:
+        return None
+    return os.path.join(config.AWGDir, '.qglcache',
+                        'cliffords{}q-v{}.npz'.format(numQubits, CLIFFORD_TABLE_VERSION))
+
+
+def build_clifford_actions(numQubits):
+    """
+	Return the actions of all the numQubits Cliffords, loading them from
+	clifford_table_file if it was saved before.
+	"""
+    fileName = clifford_table_file(numQubits)
+    if fileName and os.path.exists(fileName):
+        try:
+            with np.load(fileName) as FID:
+                return FID['actions']
+        except (IOError, ValueError, KeyError):
+            logger.warning("Rebuilding corrupt Clifford table %s", fileName)
+    numCliffords = 24 if numQubits == 1 else len(C2Seqs)
+    actions = pauli_action([clifford_mat(c, numQubits) for c in range(numCliffords)])
+    if fileName:
+        try:
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            np.savez(fileName, actions=actions)
+        except OSError as e:
+            logger.warning("Could not save Clifford table %s: %s", fileName, e)
+    return actions
+
+
+class CliffordTable(object):
+    """
+	Composition and inversion of the numQubits Cliffords by their index.
+	Inverses are tabulated, and for a single qubit so is the full
+	multiplication table. All methods work on arrays of Cliffords at once.
+	"""
+
+    def __init__(self, numQubits):
+        assert numQubits <= 2, "Oops! I only handle one or two qubits"
+        self.numQubits = numQubits
+        self.actions = build_clifford_actions(numQubits)
+        # the images of the X and Z of each qubit determine a Clifford, so
+        # packing them gives a key into a dense index
+        self.generators = [p * 4**(numQubits - 1 - k)
+                           for k in range(numQubits) for p in (1, 3)]
+        self.shifts = (2 * numQubits + 1) * np.arange(len(self.generators))
+        self.index = np.full(2**(self.shifts[-1] + 2 * numQubits + 1), -1, dtype=np.int16)
+        self.index[self.keys(self.actions)[::-1]] = np.arange(len(self.actions))[::-1]
+        self.inverses = self.lookup(invert_action(self.actions))
+        if numQubits == 1:
+            self.products = self.lookup(compose_actions(
+                self.actions[:, None, :], self.actions[None, :, :]))
+        else:
+            self.products = None
+
+    def keys(self, actions):
+        return (actions[..., self.generators].astype(np.int64) << self.shifts).sum(axis=-1)
+
+    def lookup(self, actions):
+        """
+		Return the indices of the Cliffords with the given (stacked) actions.
+		"""
+        indices = self.index[self.keys(np.asarray(actions))]
+        if np.any(indices < 0):
+            raise KeyError("Unknown Clifford action")
+        return indices.astype(np.int64)
+
+    def product(self, seqs):
+        """
+		Return the index of the Clifford applying those along the last axis of
+		'seqs' in turn, for a single sequence or an array of them.
+		"""
+        seqs = np.asarray(seqs, dtype=np.int64)
+        if seqs.shape[-1] == 0:
+            return np.zeros(seqs.shape[:-1], dtype=np.int64)
+        if self.products is not None:
+            return reduce(lambda c1, c2: self.products[c1, c2], np.moveaxis(seqs, -1, 0))
+        return self.lookup(reduce_actions(self.actions[seqs]))
+
+    def inverse(self, c):
+        return self.inverses[c]
+
+
+@memoize
+def clifford_table(numQubits):
+    return CliffordTable(numQubits)
+
+
 def inverse_clifford(cMat):
     dim = cMat.shape[0]
     if dim == 2:
-        for ct in range(24):
-            if np.isclose(
-                    np.abs(np.dot(cMat, clifford_mat(ct, 1)).trace()), dim):
-                return ct
+        table = clifford_table(1)
     elif dim == 4:
-        for ct in range(len(C2Seqs)):
-            if np.isclose(
-                    np.abs(np.dot(cMat, clifford_mat(ct, 2)).trace()), dim):
-                return ct
+        table = clifford_table(2)
     else:
         raise Exception("Expected 2 or 4 qubit dimensional matrix.")
 
-    #If we got here something is wrong
-    raise Exception("Couldn't find inverse clifford")
+    try:
+        return int(table.inverse(table.lookup(pauli_action([cMat])[0])))
+    except (KeyError, ValueError):
+        #If we got here something is wrong
+        raise Exception("Couldn't find inverse clifford")
@@ -0,0 +1,469 @@
+'''
+A persistent, content-addressed cache for the compiler.
+
+Compiled wires are stored per sequence under a key derived from a structural
+hash of the sequence and of the parameters of the channels it is compiled
+against. Base waveforms are stored under a hash of their shape parameters and
+sampling rate. Entries are evicted least-recently-used first once the cache
+grows past its size limit.
+
+Copyright 2018 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import types
+import numpy as np
+
+from . import config
+from . import Channels
+from . import ChannelLibraries
+from . import PulseShapes
+from .PulseSequencer import Pulse, CompositePulse, PulseBlock, CompoundGate
+from .BlockLabel import BlockLabel
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the compiler output for a given input changes. Shape functions
+# are keyed by their code, defaults, closure values and the numbers and
+# strings among their globals; changes to any other state they read (e.g. a
+# global array or a function they call) are not detected, so clear the cache
+# after making those.
+CACHE_VERSION = 3
+
+class Uncacheable(Exception):
+    '''Raised when an object has no stable fingerprint.'''
+    pass
+
+def fingerprint(obj, memo=None, local=False):
+    '''
+    Returns a hex digest of the structure of 'obj' that is stable across
+    processes and sessions. Channels are identified by label; the channel
+    parameters are accounted for separately by `channel_digest`. 'memo' may be
+    shared between calls to reuse the digests of common sub-objects (e.g.
+    memoized pulses) while those objects are alive.
+
+    With 'local', functions are identified by identity rather than by name
+    and code, so that distinct functions (e.g. two lambdas) are never
+    confused, but the digest is only meaningful within this process. A memo
+    must not be shared between local and other calls.
+    '''
+    if memo is None:
+        memo = {}
+    if local:
+        memo[_LOCAL] = True
+    return _digest(obj, memo)
+
+def _digest(obj, memo):
+    # sub-objects are digested once per memo, keyed by id; the memo keeps a
+    # reference so that ids are not recycled
+    if id(obj) in memo:
+        return memo[id(obj)][1]
+    digest = hashlib.sha1(_token(obj, memo).encode('utf-8')).hexdigest()
+    memo[id(obj)] = (obj, digest)
+    return digest
+
+def _token(obj, memo):
+    try:
+        tokenizer = _tokenizers[type(obj)]
+    except KeyError:
+        tokenizer = _tokenizers[type(obj)] = _find_tokenizer(obj)
+    return tokenizer(obj, memo)
+
+def _items(objs, memo):
+    # pulses, blocks and shape functions are often shared, so they are
+    # digested (and memoized) separately; everything else is inlined
+    return ','.join(_digest(obj, memo) if type(obj) in _shared else
+                    _token(obj, memo) for obj in objs)
+
+def _scalar_token(obj, memo):
+    return '{0}:{1!r}'.format(type(obj).__name__, obj)
+
+def _channel_token(obj, memo):
+    return 'chan:' + obj.label
+
+def _pulse_token(obj, memo):
+    # the scalar fields are stable under repr, so take them in one go
+    return 'Pulse({0!r},{1},{2},{3})'.format(
+        (obj.label, obj.length, obj.amp, obj.phase, obj.frequency,
+         obj.frameChange, obj.isTimeAmp, obj.isZero, obj.maddr, obj.moffset),
+        obj.channel.label, _token(obj.shapeParams, memo),
+        _token(obj.ignoredStrParams, memo))
+
+def _composite_pulse_token(obj, memo):
+    return 'CompositePulse({0})'.format(_items(obj, memo))
+
+def _sequence_token(obj, memo):
+    return '{0}({1})'.format(type(obj).__name__, _items(obj, memo))
+
+def _dict_token(obj, memo):
+    keys = list(obj)
+    if all(type(k) is str for k in keys):
+        keys.sort()
+    return 'dict({0})'.format(_items((x for k in keys for x in (k, obj[k])), memo))
+
+def _array_token(obj, memo):
+    if obj.dtype.hasobject:
+        raise Uncacheable("object array")
+    return 'ndarray:{0}:{1}:{2}'.format(obj.dtype.str, obj.shape,
+        hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest())
+
+def _pulse_block_token(obj, memo):
+    return 'PulseBlock({0})'.format(_items(
+        (obj.alignment, obj.label, obj.length, obj.pulses), memo))
+
+def _compound_gate_token(obj, memo):
+    return 'CompoundGate({0})'.format(_items((obj.label, obj.seq), memo))
+
+def _composite_shape_token(obj, memo):
+    return 'CompositeShape({0})'.format(_items(
+        (obj.operation, obj.coefficients, obj.pulses), memo))
+
+def _block_label_token(obj, memo):
+    return 'BlockLabel:{0}'.format(obj.label)
+
+def _function_token(obj, memo):
+    if memo.get(_LOCAL):
+        # the memo keeps a reference, so the id is not recycled
+        return 'func:{0}'.format(id(obj))
+    # functions are identified by name, defaults, code, the values captured
+    # by closures and the scalar globals they read, so that editing a
+    # function or a constant it uses invalidates its entries
+    active = memo.setdefault(_ACTIVE, set())
+    if id(obj) in active:
+        raise Uncacheable("recursive function {0}".format(obj.__qualname__))
+    active.add(id(obj))
+    try:
+        try:
+            cells = tuple(cell.cell_contents for cell in obj.__closure__ or ())
+        except ValueError:
+            raise Uncacheable("empty closure cell in {0}".format(obj.__qualname__))
+        return 'func:{0}.{1}({2}):{3}'.format(obj.__module__, obj.__qualname__,
+            _items((obj.__defaults__, obj.__kwdefaults__, cells,
+                    _scalar_globals(obj)), memo),
+            _code_digest(obj.__code__))
+    finally:
+        active.discard(id(obj))
+
+def _scalar_globals(obj):
+    # the numbers and strings among the globals the code may read; other
+    # globals (modules, functions, arrays...) are not accounted for
+    names = set(_code_names(obj.__code__))
+    return dict((name, value) for name, value in obj.__globals__.items()
+                if name in names and isinstance(value, _scalars))
+
+def _code_names(code):
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _code_names(const)
+
+def _code_digest(code):
+    h = hashlib.sha1(code.co_code)
+    h.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        # nested functions and comprehensions have their own code objects
+        if isinstance(const, types.CodeType):
+            h.update(_code_digest(const).encode('utf-8'))
+        elif isinstance(const, frozenset):
+            h.update(repr(sorted(const, key=repr)).encode('utf-8'))
+        else:
+            h.update(repr(const).encode('utf-8'))
+    return h.hexdigest()
+
+def _record_token(obj, memo):
+    # control flow and TDM instructions are plain records
+    return '{0}.{1}({2})'.format(type(obj).__module__,
+        type(obj).__qualname__, _token(obj.__dict__, memo))
+
+def _uncacheable_token(obj, memo):
+    raise Uncacheable("no fingerprint for {0}".format(type(obj)))
+
+def _find_tokenizer(obj):
+    if obj is None or isinstance(obj, _scalars):
+        return _scalar_token
+    for cls, tokenizer in [(Channels.Channel, _channel_token),
+                           (Pulse, _pulse_token),
+                           (CompositePulse, _composite_pulse_token),
+                           ((list, tuple), _sequence_token),
+                           (dict, _dict_token),
+                           (np.ndarray, _array_token),
+                           (PulseBlock, _pulse_block_token),
+                           (CompoundGate, _compound_gate_token),
+                           (PulseShapes.CompositeShape, _composite_shape_token),
+                           (BlockLabel, _block_label_token)]:
+        if isinstance(obj, cls):
+            return tokenizer
+    if callable(obj) and hasattr(obj, '__code__'):
+        return _function_token
+    if type(obj).__module__.startswith('QGL.') and hasattr(obj, '__dict__'):
+        return _record_token
+    return _uncacheable_token
+
+# tokenizers resolved per type
+_tokenizers = {}
+
+_scalars = (bool, int, float, complex, str, np.generic)
+
+# memo keys of the local flag and of the functions being tokenized
+_LOCAL = 'local'
+_ACTIVE = 'active'
+
+_shared = {Pulse, CompositePulse, PulseBlock, CompoundGate,
+           PulseShapes.CompositeShape, types.FunctionType}
+
+def channel_digest(channels):
+    '''
+    Digest of the parameters of 'channels' (and their physical channels) plus
+    the connectivity graph, i.e. everything besides the sequence itself that
+    compile_sequence depends on.
+    '''
+    h = hashlib.sha1('version:{0};'.format(CACHE_VERSION).encode('utf-8'))
+    encode = lambda chan: json.dumps(chan.json_encode(), sort_keys=True, default=repr)
+    for chan in sorted(channels, key=lambda c: c.label):
+        h.update(encode(chan).encode('utf-8'))
+        if getattr(chan, 'phys_chan', None) is not None:
+            h.update(encode(chan.phys_chan).encode('utf-8'))
+    graph = getattr(ChannelLibraries.channelLib, 'connectivityG', None)
+    if graph is not None:
+        edges = sorted((src.label, dst.label, data['channel'].label)
+                       for src, dst, data in graph.edges(data=True))
+        h.update(repr(edges).encode('utf-8'))
+    return h.hexdigest()
+
+class _LabelPickler(pickle.Pickler):
+    '''Pickles channels by label so cached wires attach to live channels.'''
+    def persistent_id(self, obj):
+        if isinstance(obj, Channels.Channel):
+            return obj.label
+        return None
+
+class _LabelUnpickler(pickle.Unpickler):
+    def __init__(self, fid, chanTable):
+        super(_LabelUnpickler, self).__init__(fid)
+        self.chanTable = chanTable
+
+    def persistent_load(self, pid):
+        return self.chanTable[pid]
+
+class CompileCache(object):
+    '''
+    On-disk cache of compiled wires and waveforms.
+
+    path (optional): cache directory, defaults to a '.qglcache' folder in
+        config.AWGDir
+    max_size (optional): size limit in bytes, defaults to
+        config.compile_cache_size; the least recently used entries are evicted
+        beyond it
+    '''
+
+    def __init__(self, path=None, max_size=None):
+        self._path = path
+        self.max_size = max_size if max_size else config.compile_cache_size
+        self._size = None
+        self.reset_stats()
+
+    @property
+    def path(self):
+        if self._path is None:
+            return os.path.join(config.AWGDir, '.qglcache')
+        return self._path
+
+    def reset_stats(self):
+        self.stats = {
+            'sequence_hits': 0,
+            'sequence_misses': 0,
+            'waveform_hits': 0,
+            'waveform_misses': 0,
+            'evictions': 0
+        }
+
+    def report(self):
+        '''Statistics for the meta file.'''
+        report = dict(self.stats)
+        report['size'] = self.size
+        report['max_size'] = self.max_size
+        return report
+
+    def sequence_keys(self, seqs, channels):
+        '''
+        Returns one key per sequence, or None for those that cannot be cached.
+        '''
+        context = channel_digest(channels)
+        memo = {}
+        keys = []
+        for seq in seqs:
+            try:
+                keys.append(fingerprint([context, seq], memo))
+            except Uncacheable as e:
+                logger.debug("Not caching sequence: %s", e)
+                keys.append(None)
+        return keys
+
+    def load_wires(self, key, chanList):
+        '''
+        Returns the cached wires for 'key' as a dictionary keyed by the
+        channels in chanList, or None on a miss.
+        '''
+        data = self._read('wires', key, '.pkl') if key else None
+        if data is not None:
+            library = getattr(ChannelLibraries.channelLib, 'channelDict', {})
+            chanTable = {label: chan for label, chan in library.items()
+                         if isinstance(chan, Channels.Channel)}
+            chanTable.update({chan.label: chan for chan in chanList})
+            try:
+                wires = dict(_LabelUnpickler(io.BytesIO(data), chanTable).load())
+            except (KeyError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+                logger.debug("Discarding cache entry %s: %s", key, e)
+                wires = {}
+            if all(chan.label in wires for chan in chanList):
+                self.stats['sequence_hits'] += 1
+                return {chan: wires[chan.label] for chan in chanList}
+        self.stats['sequence_misses'] += 1
+        return None
+
+    def store_wires(self, key, wires):
+        '''Stores the wires (a dictionary keyed by channel) under 'key'.'''
+        if not key:
+            return
+        buf = io.BytesIO()
+        try:
+            _LabelPickler(buf, pickle.HIGHEST_PROTOCOL).dump(
+                [(chan.label, wire) for chan, wire in wires.items()])
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            logger.debug("Not caching sequence: %s", e)
+            return
+        self._write('wires', key, '.pkl', buf.getvalue())
+
+    def waveform_key(self, pulse, memo=None):
+        '''
+        Returns the key of the base shape of 'pulse', or None if its shape
+        function cannot be fingerprinted.
+        '''
+        try:
+            return fingerprint(['version', CACHE_VERSION, pulse.shapeParams,
+                                pulse.channel.phys_chan.sampling_rate], memo)
+        except Uncacheable:
+            return None
+
+    def load_waveform(self, key):
+        data = self._read('waveforms', key, '.npy') if key else None
+        if data is not None:
+            try:
+                wf = np.load(io.BytesIO(data), allow_pickle=False)
+            except ValueError:
+                wf = None
+            if wf is not None:
+                self.stats['waveform_hits'] += 1
+                return wf
+        self.stats['waveform_misses'] += 1
+        return None
+
+    def store_waveform(self, key, wf):
+        if not key or not isinstance(wf, np.ndarray) or wf.dtype.hasobject:
+            return
+        buf = io.BytesIO()
+        np.save(buf, wf, allow_pickle=False)
+        self._write('waveforms', key, '.npy', buf.getvalue())
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = sum(entry[2] for entry in self._entries())
+        return self._size
+
+    def prune(self):
+        '''
+        Evicts the least recently used entries until the cache is back under
+        three quarters of max_size.
+        '''
+        if self.size <= self.max_size:
+            return
+        target = 3 * self.max_size // 4
+        for _, fileName, size in sorted(self._entries()):
+            if self._size <= target:
+                break
+            try:
+                os.remove(fileName)
+            except OSError:
+                continue
+            self._size -= size
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        for _, fileName, _ in self._entries():
+            os.remove(fileName)
+        self._size = 0
+
+    def _file_name(self, kind, key, ext):
+        return os.path.join(self.path, kind, key[:2], key + ext)
+
+    def _entries(self):
+        # (mtime, path, size) of every cache file
+        out = []
+        for kind in ('wires', 'waveforms'):
+            for root, _, files in os.walk(os.path.join(self.path, kind)):
+                for f in files:
+                    fileName = os.path.join(root, f)
+                    try:
+                        st = os.stat(fileName)
+                    except OSError:
+                        continue
+                    out.append((st.st_mtime, fileName, st.st_size))
+        return out
+
+    def _read(self, kind, key, ext):
+        fileName = self._file_name(kind, key, ext)
+        try:
+            with open(fileName, 'rb') as FID:
+                data = FID.read()
+            # mark as recently used
+            os.utime(fileName)
+        except OSError:
+            return None
+        return data
+
+    def _write(self, kind, key, ext, data):
+        fileName = self._file_name(kind, key, ext)
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        # write then rename so readers never see a partial entry
+        tmpName = '{0}.{1}.tmp'.format(fileName, os.getpid())
+        with open(tmpName, 'wb') as FID:
+            FID.write(data)
+        if self._size is not None:
+            if os.path.exists(fileName):
+                self._size -= os.path.getsize(fileName)
+            self._size += len(data)
+        os.replace(tmpName, fileName)
+
+default_cache = None
+
+def get_cache():
+    '''
+    Returns the cache configured by config.compile_cache, or None if caching
+    is disabled. config.compile_cache may be True (cache in config.AWGDir) or
+    a directory.
+    '''
+    global default_cache
+    if not config.compile_cache:
+        return None
+    path = None if config.compile_cache is True else config.compile_cache
+    if (default_cache is None or default_cache._path != path or
+            default_cache.max_size != config.compile_cache_size):
+        default_cache = CompileCache(path)
+    return default_cache
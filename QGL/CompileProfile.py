@@ -0,0 +1,244 @@
+'''
+Per-stage instrumentation of the compiler.
+
+A Profiler records the wall time, the number of calls and the peak memory
+allocated by each stage of compile_to_hardware. Stages are timed with
+time.perf_counter and their memory is traced with tracemalloc, which slows the
+compilation down noticeably; pass trace_memory=False to only collect timings.
+
+Copyright 2018 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import logging
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats(object):
+    '''
+    Accumulated statistics of one compiler stage. Times are in seconds and
+    memory in bytes.
+    '''
+    __slots__ = ('calls', 'wall_time', 'peak_memory')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0.0
+        self.peak_memory = None
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'wall_time': self.wall_time,
+                'peak_memory': self.peak_memory}
+
+
+class Profiler(object):
+    '''
+    Collects StageStats keyed by stage name, in the order the stages first
+    ran. The same profiler can be passed to several compilations, including
+    concurrent ones, to accumulate their statistics.
+
+    The peak memory of a stage is the largest amount of memory allocated
+    during any of its calls over what was in use when the call started.
+    Memory is traced for the duration of each compilation (see tracing);
+    stages that overlap others, e.g. those of concurrent compilations or the
+    sequence file writes of several AWGs, report an upper bound.
+    '''
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.stages = OrderedDict()
+
+    @contextmanager
+    def tracing(self):
+        '''
+        Traces memory while a compilation runs, if trace_memory is set.
+        tracemalloc is process-wide, so it is started by the first of
+        concurrent compilations and stopped by the last one.
+        '''
+        if not self.trace_memory:
+            yield
+            return
+        with _tracing_lock:
+            if _tracing['compilations'] == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing['owned'] = True
+            _tracing['compilations'] += 1
+        try:
+            yield
+        finally:
+            with _tracing_lock:
+                _tracing['compilations'] -= 1
+                if _tracing['compilations'] == 0 and _tracing['owned']:
+                    tracemalloc.stop()
+                    _tracing['owned'] = False
+
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+        start_memory = start_stage_tracing() if self.trace_memory else None
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            wall_time = time.perf_counter() - start
+            if start_memory is not None:
+                peak_memory = stop_stage_tracing(start_memory)
+            with self._lock:
+                stats.wall_time += wall_time
+                stats.calls += 1
+                if start_memory is not None:
+                    stats.peak_memory = max(stats.peak_memory or 0, peak_memory)
+
+    @property
+    def total_time(self):
+        return sum(stats.wall_time for stats in self.stages.values())
+
+    def to_dict(self):
+        return OrderedDict((name, stats.to_dict())
+                           for name, stats in self.stages.items())
+
+    def report(self):
+        '''
+        Formats the statistics as a table, one stage per line.
+        '''
+        width = max([len(name) for name in self.stages] + [len('stage')])
+        lines = ['{0:<{1}}  {2:>6}  {3:>10}  {4:>10}'.format(
+            'stage', width, 'calls', 'time (ms)', 'peak (kB)')]
+        for name, stats in self.stages.items():
+            if stats.peak_memory is None:
+                peak = '-'
+            else:
+                peak = '{0:.1f}'.format(stats.peak_memory / 1024)
+            lines.append('{0:<{1}}  {2:>6d}  {3:>10.2f}  {4:>10}'.format(
+                name, width, stats.calls, 1e3 * stats.wall_time, peak))
+        lines.append('{0:<{1}}  {2:>6}  {3:>10.2f}'.format(
+            'total', width, '', 1e3 * self.total_time))
+        return '\n'.join(lines)
+
+
+# the compilations tracing memory and the stages measuring it, counted across
+# threads; 'owned' is set when tracemalloc was started by a compilation
+_tracing_lock = threading.Lock()
+_tracing = {'compilations': 0, 'stages': 0, 'owned': False}
+
+def start_stage_tracing():
+    '''
+    Returns the memory in use at the start of a stage, or None if memory is
+    not traced. The peak is reset unless other stages are running.
+    '''
+    with _tracing_lock:
+        if not tracemalloc.is_tracing():
+            return None
+        if _tracing['stages'] == 0:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            elif _tracing['owned']:
+                # restarting is the only way to reset the peak before
+                # Python 3.9; tracing started by others is left alone
+                tracemalloc.stop()
+                tracemalloc.start()
+        _tracing['stages'] += 1
+        return tracemalloc.get_traced_memory()[0]
+
+def stop_stage_tracing(start_memory):
+    '''
+    Returns the peak memory of a stage that started with 'start_memory' in
+    use.
+    '''
+    with _tracing_lock:
+        _tracing['stages'] -= 1
+        return max(0, tracemalloc.get_traced_memory()[1] - start_memory)
+
+
+class NullProfiler(object):
+    '''
+    Stand-in used when profiling is disabled.
+    '''
+
+    def __bool__(self):
+        return False
+
+    @contextmanager
+    def tracing(self):
+        yield
+
+    @contextmanager
+    def stage(self, name):
+        yield None
+
+null_profiler = NullProfiler()
+
+
+class CompileCancelled(Exception):
+    '''
+    Raised by a compilation abandoned through CancellableProfiler.
+    '''
+    pass
+
+
+class CancellableProfiler(object):
+    '''
+    Wraps a profiler to abandon a compilation at the start of its next stage
+    once 'cancelled' (a threading.Event) is set, by raising CompileCancelled.
+    Everything else is delegated to the wrapped profiler.
+    '''
+
+    def __init__(self, profiler, cancelled):
+        self.profiler = profiler
+        self.cancelled = cancelled
+
+    def __bool__(self):
+        return bool(self.profiler)
+
+    def __getattr__(self, name):
+        return getattr(self.profiler, name)
+
+    @contextmanager
+    def stage(self, name):
+        if self.cancelled.is_set():
+            raise CompileCancelled("Compilation cancelled before " + name)
+        with self.profiler.stage(name) as stats:
+            yield stats
+
+
+def get_profiler(profile):
+    '''
+    Maps the 'profile' argument of compile_to_hardware to a profiler: a
+    Profiler or CancellableProfiler is used as is, anything else truthy
+    creates a new one and anything falsy gives the null_profiler. Defaults to
+    config.compile_profile.
+    '''
+    if profile is None:
+        profile = config.compile_profile
+    if isinstance(profile, (Profiler, CancellableProfiler)):
+        return profile
+    elif profile:
+        return Profiler()
+    return null_profiler
@@ -15,13 +15,20 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
+import asyncio
 import logging
 import numpy as np
 import os
-import operator
+import io
+import pickle
+import multiprocessing
+import threading
 from warnings import warn
 from copy import copy
-from functools import reduce
+from collections import OrderedDict
+from contextlib import ExitStack
+from functools import partial, reduce
+from itertools import islice
 from importlib import import_module
 import json
 
@@ -32,10 +39,12 @@ from . import Channels
 from . import ChannelLibraries
 from . import PulseShapes
 from .PulsePrimitives import Id
-from .PulseSequencer import Pulse, PulseBlock, CompositePulse
+from .PulseSequencer import Pulse, PulseBlock, CompositePulse, CompoundGate
 from . import ControlFlow
 from . import BlockLabel
 from . import TdmInstructions # only for APS2-TDM
+from . import CompileCache
+from . import CompileProfile
 
 logger = logging.getLogger(__name__)
 
@@ -67,7 +76,6 @@ def map_logical_to_physical(wires):
 def merge_channels(wires, channels):
     chan = channels[0]
     mergedWire = [[] for _ in range(len(wires[chan]))]
-    shape_funLib = {}
     for ct, segment in enumerate(mergedWire):
         entry_iterators = [iter(wires[ch][ct]) for ch in channels]
         while True:
@@ -97,12 +105,11 @@ def merge_channels(wires, channels):
             # create a new Pulse object for the merged pulse
 
             # If there is a non-zero SSB frequency copy it to the new entry
-            nonZeroSSBChan = np.nonzero(
-                [e.amp * e.frequency for e in entries])[0]
+            nonZeroSSBChan = [e for e in entries if e.amp * e.frequency != 0]
             assert len(nonZeroSSBChan) <= 1, \
                 "Unable to handle merging more than one non-zero entry with non-zero frequency."
             if nonZeroSSBChan:
-                frequency = entries[nonZeroSSBChan[0]].frequency
+                frequency = nonZeroSSBChan[0].frequency
             else:
                 frequency = 0.0
 
@@ -114,15 +121,8 @@ def merge_channels(wires, channels):
             else:
                 amp = 1.0
                 phase = 0.0
-                pulsesHash = tuple([(e.hashshape(), e.amp, e.phase) for e in entries])
-                if pulsesHash not in shape_funLib:
-                    # create closure to sum waveforms
-                    def sum_shapes(entries=entries, **kwargs):
-                        return reduce(operator.add,
-                            [e.amp * np.exp(1j * e.phase) * e.shape for e in entries])
-
-                    shape_funLib[pulsesHash] = sum_shapes
-                shape_fun = shape_funLib[pulsesHash]
+                shape_fun = PulseShapes.CompositeShape('sum',
+                    [e.amp * np.exp(1j * e.phase) for e in entries], entries)
 
             shapeParams = {"shape_fun": shape_fun, "length": block_length}
 
@@ -144,43 +144,38 @@ def pull_uniform_entries(entries, entry_iterators):
         A1* = A1 + B1 + C1
     and update entries such that entries = [A1*, A2].
     The function returns the resulting block length.
+
+    The channels are swept up to their next common entry boundary, pulling
+    each entry once and tracking which channels are all zeros, so that when
+    at most one channel is not, its entries are returned as is rather than
+    concatenated.
     '''
-    numChan = len(entries)
-    #keep track of how many entry iterators are used up
-    iterDone = [ False ] * numChan
-    ct = 0
-    lengths = np.array([e.length for e in entries])
+    lengths = [e.length for e in entries]
     entries_stack = [[e] for e in entries]
+    # channels with a non-zero entry
+    nonzero = set(ct for ct, e in enumerate(entries) if not e.isZero)
 
-    while True:
-        #If we've used up all the entries on all the channels we're done
-        if all(iterDone):
-            raise StopIteration("Unable to find a uniform set of entries")
-
-        #if all(np.isclose(x, lengths[0], atol=1e-10) for x in lengths):
-        if np.all(np.less(np.abs(lengths - lengths[0]), 1e-10)):
-            break
-
-        #Otherwise try to concatenate on entries to match lengths
-        while not np.isclose(lengths[ct], max(lengths), atol=1e-10):
-            # concatenate with following entry to make up the length difference
+    end = max(lengths)
+    ct = 0
+    while not all(abs(length - lengths[0]) < 1e-10 for length in lengths):
+        # concatenate following entries to make up the length difference
+        while lengths[ct] < end and not is_close_length(lengths[ct], end):
             try:
                 next_entry = next(entry_iterators[ct])
             except StopIteration:
-                iterDone[ct] = True
-
+                raise ValueError("Unable to find a uniform set of entries")
             entries_stack[ct].append(next_entry)
             lengths[ct] += next_entry.length
-
-        ct = (ct + 1) % numChan
-
+            if not next_entry.isZero:
+                nonzero.add(ct)
+        end = max(end, lengths[ct])
+        ct = (ct + 1) % len(lengths)
 
     #if we have all zeros or a single non zero we return that as a list of entries
-    allzero_chan = [all([e.isZero for e in stack]) for stack in entries_stack ]
-    if all(allzero_chan):
+    if not nonzero:
         entries = [ entries_stack[0] ]
-    elif np.sum(allzero_chan) == len(entries) - 1:
-        entries = [ entries_stack[allzero_chan.index(False)] ]
+    elif len(nonzero) == 1:
+        entries = [ entries_stack[nonzero.pop()] ]
     else:
         entries = []
         for stack in entries_stack:
@@ -189,6 +184,11 @@ def pull_uniform_entries(entries, entry_iterators):
     return entries, max(lengths)
 
 
+def is_close_length(length, target):
+    # np.isclose(length, target, atol=1e-10) without the array overhead
+    return abs(length - target) <= 1e-10 + 1e-5 * abs(target)
+
+
 def concatenate_entries(entry1, entry2):
     # TA waveforms with the same amplitude can be merged with a just length update
     # otherwise, need to concatenate the pulse shapes
@@ -200,14 +200,11 @@ def concatenate_entries(entry1, entry2):
     frameChange = entry1.frameChange + entry2.frameChange
     if not (entry1.isTimeAmp and entry2.isTimeAmp and entry1.amp == entry2.amp
             and entry1.phase == (entry1.frameChange + entry2.phase)):
-        # otherwise, need to build a closure to stack them
-        def stack_shapes(entry1=entry1, entry2=entry2, **kwargs):
-            return np.hstack((
-                entry1.amp * np.exp(1j * entry1.phase) * entry1.shape,
-                entry2.amp * np.exp(1j * (entry1.frameChange + entry2.phase)) *
-                entry2.shape))
-
-        shapeParams['shape_fun'] = stack_shapes
+        # otherwise, need to stack their shapes
+        shapeParams['shape_fun'] = PulseShapes.CompositeShape('stack',
+            [entry1.amp * np.exp(1j * entry1.phase),
+             entry2.amp * np.exp(1j * (entry1.frameChange + entry2.phase))],
+            [entry1, entry2])
         label = entry1.label + '+' + entry2.label
         amp = 1.0
         phase = 0.0
@@ -215,17 +212,31 @@ def concatenate_entries(entry1, entry2):
     return Pulse(label, entry1.channel, shapeParams, amp, phase, frameChange)
 
 
-def generate_waveforms(physicalWires):
+def generate_waveforms(physicalWires, cache=None):
     wfs = {ch: {} for ch in physicalWires.keys()}
+    memo = {}
+    # shape hashes of the pulses seen so far, keyed by id; memoized pulses
+    # recur throughout the wires
+    hashes = {}
     for ch, wire in physicalWires.items():
         for pulse in flatten(wire):
             if not isinstance(pulse, Pulse):
                 continue
-            if pulse.hashshape() not in wfs[ch]:
+            if id(pulse) not in hashes:
+                hashes[id(pulse)] = (pulse, pulse.hashshape())
+            shape = hashes[id(pulse)][1]
+            if shape not in wfs[ch]:
                 if pulse.isTimeAmp:
-                    wfs[ch][pulse.hashshape()] = np.ones(1, dtype=np.complex)
+                    wfs[ch][shape] = np.ones(1, dtype=np.complex)
+                elif cache:
+                    key = cache.waveform_key(pulse, memo)
+                    wf = cache.load_waveform(key)
+                    if wf is None:
+                        wf = pulse.shape
+                        cache.store_waveform(key, wf)
+                    wfs[ch][shape] = wf
                 else:
-                    wfs[ch][pulse.hashshape()] = pulse.shape
+                    wfs[ch][shape] = pulse.shape
     return wfs
 
 
@@ -300,15 +311,268 @@ def collect_specializations(seqs):
     return funcs
 
 
+def preprocess_sequences(seqs, add_slave_trigger=True,
+                         profiler=CompileProfile.null_profiler):
+    '''
+    Adds the WAITs, digitizer triggers, gating pulses and slave triggers to
+    'seqs' in place.
+    '''
+    # all sequences should start with a WAIT for synchronization
+    for seq in seqs:
+        if not isinstance(seq[0], ControlFlow.Wait):
+            logger.debug("Adding a WAIT - first sequence element was %s", seq[0])
+            seq.insert(0, ControlFlow.Wait())
+
+    # Add the digitizer trigger to measurements
+    logger.debug("Adding digitizer trigger")
+    with profiler.stage('add_digitizer_trigger'):
+        PatternUtils.add_digitizer_trigger(seqs)
+
+    # Add gating/blanking pulses
+    logger.debug("Adding blanking pulses")
+    with profiler.stage('add_gate_pulses'):
+        gated = set()
+        for seq in seqs:
+            PatternUtils.add_gate_pulses(seq, gated)
+
+    if add_slave_trigger and 'slave_trig' in ChannelLibraries.channelLib:
+        # Add the slave trigger
+        logger.debug("Adding slave trigger")
+        with profiler.stage('add_slave_trigger'):
+            PatternUtils.add_slave_trigger(seqs,
+                                           ChannelLibraries.channelLib['slave_trig'])
+    else:
+        logger.debug("Not adding slave trigger")
+
+
+def preprocess_sweep(seqs, add_slave_trigger=True, max_templates=4,
+                     profiler=CompileProfile.null_profiler):
+    '''
+    Same as preprocess_sequences for parameter sweeps. A sequence that differs
+    from a recently preprocessed one (the template) only in the amplitude,
+    phase or length of some of its pulses is stamped out from the template by
+    substituting those pulses, rather than preprocessed again. Sequences that
+    do not fit a template (e.g. calibration sequences) are preprocessed as
+    usual and become templates themselves.
+
+    Only this front half of the compiler is templated. The stamped sequences
+    are compiled, and their waveforms generated and translated, like any
+    other, so the speedup of a sweep end to end is modest (about a quarter
+    for a 1000-point Rabi sweep).
+    '''
+    templates = []
+    numStamped = 0
+    for seq in seqs:
+        stamped = None
+        with profiler.stage('stamp_sweep_template'):
+            for raw, processed in reversed(templates):
+                stamped = stamp_sweep_template(raw, processed, seq)
+                if stamped is not None:
+                    seq[:] = stamped
+                    numStamped += 1
+                    break
+        if stamped is None:
+            raw = list(seq)
+            preprocess_sequences([seq], add_slave_trigger, profiler)
+            templates = templates[1 - max_templates:] + [(raw, list(seq))]
+    logger.debug("Stamped %d of %d sequences from templates", numStamped, len(seqs))
+
+
+def stamp_sweep_template(raw, processed, seq):
+    '''
+    Returns the preprocessed version of 'seq' derived from the template
+    sequence 'raw' and its preprocessed version 'processed', or None if 'seq'
+    is not a variant of the template.
+    '''
+    if len(seq) != len(raw):
+        return None
+    substitutions = []
+    for old, new in zip(raw, seq):
+        if is_same_entry(old, new):
+            continue
+        if not is_sweep_variant(old, new):
+            return None
+        substitutions.append((old, new))
+
+    stamped = list(processed)
+    for old, new in substitutions:
+        # the swept pulse must appear exactly once in the template
+        matches = [ct for ct, entry in enumerate(stamped)
+                   if count_occurrences(entry, old) > 0]
+        if len(matches) != 1 or count_occurrences(stamped[matches[0]], old) != 1:
+            return None
+        ct = matches[0]
+        if new.length != old.length and stamped[ct] is not old:
+            # the template aligned other pulses (gates, triggers) to this one
+            return None
+        stamped[ct] = substitute_pulse(stamped[ct], old, new)
+    return stamped
+
+
+def is_same_entry(old, new):
+    if old is new:
+        return True
+    if type(old) is not type(new):
+        return False
+    if isinstance(old, CompoundGate):
+        return old.label == new.label and old.seq == new.seq
+    return old == new
+
+
+def is_sweep_variant(old, new):
+    '''
+    Checks that the pulses 'old' and 'new' differ at most in amplitude, phase
+    and length, so that preprocessing treats them alike.
+    '''
+    if not (type(old) is Pulse and type(new) is Pulse):
+        return False
+    if (old.channel is not new.channel or old.label != new.label or
+            old.frameChange != new.frameChange or
+            old.isTimeAmp != new.isTimeAmp or old.isZero != new.isZero or
+            old.maddr != new.maddr or old.moffset != new.moffset):
+        return False
+    if new.length != old.length and (old.length == 0 or new.length == 0):
+        # zero length pulses are dropped by compile_sequence
+        return False
+    oldParams = {k: v for k, v in old.shapeParams.items() if k != 'length'}
+    newParams = {k: v for k, v in new.shapeParams.items() if k != 'length'}
+    return oldParams == newParams
+
+
+def count_occurrences(entry, pulse):
+    if entry is pulse:
+        return 1
+    if isinstance(entry, CompositePulse):
+        return sum(count_occurrences(p, pulse) for p in entry.pulses)
+    if isinstance(entry, PulseBlock):
+        return sum(count_occurrences(p, pulse) for p in entry.pulses.values())
+    if isinstance(entry, CompoundGate):
+        return sum(count_occurrences(p, pulse) for p in entry.seq)
+    return 0
+
+
+def substitute_pulse(entry, old, new):
+    '''
+    Returns a copy of 'entry' with the pulse 'old' replaced by 'new'.
+    '''
+    if entry is old:
+        return new
+    if isinstance(entry, CompositePulse):
+        return entry._replace(pulses=[substitute_pulse(p, old, new) for p in entry.pulses])
+    if isinstance(entry, PulseBlock):
+        result = copy(entry)
+        result.pulses = OrderedDict((chan, substitute_pulse(p, old, new))
+                                    for chan, p in entry.pulses.items())
+        return result
+    if isinstance(entry, CompoundGate):
+        result = copy(entry)
+        result.seq = [substitute_pulse(p, old, new) for p in entry.seq]
+        return result
+    return entry
+
+
+def extract_subroutines(seqs, min_length=2, max_length=16,
+                        max_subroutines=8):
+    '''
+    Hoists trailing fragments shared by several preprocessed sequences, such
+    as measurement tails, calibration sequences and tomography readouts, into
+    subroutines. Each fragment is replaced by a Call and registered like a
+    qfunction, so that collect_specializations appends it to the sequences
+    and the APS2 driver places it in the instruction cache. This requires a
+    sequencer that supports CALL and RETURN.
+
+    Fragments run to the end of their sequences, so that the timing of all
+    channels is resynchronized by the following WAIT, and are made of
+    'min_length' to 'max_length' pulses, pulse blocks or gates without frame
+    changes. They must follow control flow or an entry without marker pulses,
+    so that gating buffers do not spill over into the subroutine. At most
+    'max_subroutines' fragments are extracted, picking those that save the
+    most entries first. Returns the labels of the subroutines.
+    '''
+    memo = {}
+    # candidate fragments keyed by the fingerprints of their entries
+    candidates = OrderedDict()
+    for ct, seq in enumerate(seqs):
+        start = len(seq)
+        while start > 0 and len(seq) - start < max_length and is_extractable(seq[start - 1]):
+            start -= 1
+        try:
+            keys = [CompileCache.fingerprint(entry, memo, local=True) for entry in seq[start:]]
+        except CompileCache.Uncacheable:
+            continue
+        for begin in range(start, len(seq) - min_length + 1):
+            previous = seq[begin - 1] if begin > 0 else None
+            if isinstance(previous, (ControlFlow.ControlInstruction, BlockLabel.BlockLabel)) or (
+                    is_extractable(previous) and not has_marker_pulse(previous)):
+                candidates.setdefault(tuple(keys[begin - start:]), []).append((ct, begin))
+
+    labels = []
+    done = set()
+    while len(labels) < max_subroutines:
+        best = None
+        for key, uses in candidates.items():
+            uses = [(ct, begin) for ct, begin in uses if ct not in done]
+            # each call replaces the fragment, which is stored once along with a RETURN
+            savings = (len(uses) - 1) * len(key) - len(uses) - 1
+            if savings > 0 and (best is None or savings > best[0]):
+                best = (savings, uses)
+        if best is None:
+            break
+        _, uses = best
+        ct, begin = uses[0]
+        subroutine = seqs[ct][begin:] + [ControlFlow.Return()]
+        target = BlockLabel.label(subroutine)
+        ControlFlow.qfunction_seq[target] = subroutine
+        for ct, begin in uses:
+            seqs[ct][begin:] = [ControlFlow.Call(target)]
+            done.add(ct)
+        labels.append(target)
+    logger.debug("Extracted %d subroutines called from %d sequences",
+                 len(labels), len(done))
+    return labels
+
+
+def is_extractable(entry):
+    return (isinstance(entry, (Pulse, CompositePulse, PulseBlock, CompoundGate)) and
+            all(p.frameChange == 0 for p in leaf_pulses(entry)))
+
+
+def has_marker_pulse(entry):
+    return any(isinstance(p.channel, Channels.LogicalMarkerChannel) and not p.isZero
+               for p in leaf_pulses(entry))
+
+
+def leaf_pulses(entry):
+    if isinstance(entry, Pulse):
+        yield entry
+    elif isinstance(entry, CompositePulse):
+        for p in entry.pulses:
+            yield from leaf_pulses(p)
+    elif isinstance(entry, PulseBlock):
+        for p in entry.pulses.values():
+            yield from leaf_pulses(p)
+    elif isinstance(entry, CompoundGate):
+        for p in entry.seq:
+            yield from leaf_pulses(p)
+
+
 def compile_to_hardware(seqs,
                         fileName,
                         suffix='',
                         axis_descriptor=None,
                         add_slave_trigger=True,
                         extra_meta=None,
-                        tdm_seq = False):
+                        tdm_seq = False,
+                        workers=None,
+                        cache=None,
+                        sweep_template=False,
+                        hoist_subroutines=False,
+                        profile=None,
+                        write_workers=None):
     '''
     Compiles 'seqs' to a hardware description and saves it to 'fileName'.
+    Identical sequences (e.g. repeated calibrations) are preprocessed and
+    compiled once (see find_duplicate_sequences).
     Other inputs:
         suffix (optional): string to append to end of fileName, e.g. with
             fileNames = 'test' and suffix = 'foo' might save to test-APSfoo.h5
@@ -318,42 +582,241 @@ def compile_to_hardware(seqs,
             the time delays between pulses.
         add_slave_trigger (optional): add the slave trigger(s)
         tdm_seq (optional): compile for TDM
+        workers (optional): number of processes used to compile the sequences
+            in parallel. The output is identical to the serial path.
+        cache (optional): a CompileCache to reuse the compiled wires and
+            waveforms of unchanged sequences from previous runs. Defaults to
+            the cache set up by config.compile_cache; pass False to disable.
+        sweep_template (optional): preprocess sequences that differ from an
+            earlier one only in pulse amplitudes, phases or lengths by patching
+            that prototype instead of starting from scratch (see
+            preprocess_sweep). Only preprocessing is templated: every sequence
+            is still compiled, and its waveforms generated and translated.
+            The output is unchanged.
+        hoist_subroutines (optional): move trailing fragments shared by
+            several sequences into subroutines (see extract_subroutines).
+            Requires sequencers that support subroutine calls, e.g. the APS2.
+        profile (optional): record the wall time, number of calls and peak
+            memory of each compiler stage. Pass True, or a
+            CompileProfile.Profiler to collect the statistics into. They are
+            logged and written to the meta file under 'compile_profile'.
+            Defaults to config.compile_profile.
+        write_workers (optional): number of processes used to translate and
+            write the sequence files of the AWGs in parallel. The files are
+            identical to the serial path, but the translator stages are then
+            missing from the profile.
     '''
-    logger.debug("Compiling %d sequence(s)", len(seqs))
+    return run_compilation(_compile_to_hardware(
+        seqs, fileName, suffix, axis_descriptor, add_slave_trigger,
+        extra_meta, tdm_seq, workers, cache, sweep_template,
+        hoist_subroutines, profile), write_workers)
+
+
+def compile_to_memory(seqs,
+                      axis_descriptor=None,
+                      add_slave_trigger=True,
+                      extra_meta=None,
+                      tdm_seq=False,
+                      workers=None,
+                      cache=None,
+                      sweep_template=False,
+                      hoist_subroutines=False,
+                      profile=None,
+                      write_workers=None):
+    '''
+    Compiles 'seqs' like compile_to_hardware, but returns the hardware data
+    rather than writing it to disk, e.g. to upload it from the same process.
+    Returns a dictionary of the arrays of each AWG keyed by the dataset names
+    of its sequence file (e.g. '/chan_1/instructions'), along with the meta
+    dictionary. The 'instruments' of the meta info give the keys of the AWGs
+    in the former. The arrays are the ones built by the translator, not
+    copies. Only supported by translators providing sequence_buffers (i.e.
+    the APS2). The inputs are as for compile_to_hardware.
+    '''
+    return run_compilation(_compile_to_hardware(
+        seqs, None, '', axis_descriptor, add_slave_trigger, extra_meta,
+        tdm_seq, workers, cache, sweep_template, hoist_subroutines, profile,
+        in_memory=True), write_workers)
+
+
+async def compile_to_hardware_async(seqs,
+                                    fileName,
+                                    suffix='',
+                                    axis_descriptor=None,
+                                    add_slave_trigger=True,
+                                    extra_meta=None,
+                                    tdm_seq=False,
+                                    workers=None,
+                                    cache=None,
+                                    sweep_template=False,
+                                    hoist_subroutines=False,
+                                    profile=None,
+                                    executor=None):
+    '''
+    Coroutine version of compile_to_hardware for asyncio applications. The
+    compiler stages run in 'executor' (defaults to the default executor of
+    the event loop) and the sequence files of the AWGs are written
+    concurrently in it, so the event loop is not blocked.
+
+    Cancelling the awaiting task abandons the compilation at the start of its
+    next stage; a stage that is already running, e.g. the write of a
+    sequence file, is completed first. The remaining inputs are as for
+    compile_to_hardware.
+    '''
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    profiler = CompileProfile.CancellableProfiler(
+        CompileProfile.get_profiler(profile), cancelled)
+    compilation = _compile_to_hardware(
+        seqs, fileName, suffix, axis_descriptor, add_slave_trigger,
+        extra_meta, tdm_seq, workers, cache, sweep_template,
+        hoist_subroutines, profiler)
+    try:
+        done, value = await loop.run_in_executor(
+            executor, step_compilation, compilation, None)
+        while not done:
+            results = await asyncio.gather(
+                *[loop.run_in_executor(executor, job) for job in value])
+            done, value = await loop.run_in_executor(
+                executor, step_compilation, compilation, results)
+    except asyncio.CancelledError:
+        # stop the stages still running in the executor
+        cancelled.set()
+        raise
+    return value
+
+
+def run_stage(profiler, name, func, *args):
+    with profiler.stage(name):
+        return func(*args)
+
+
+def step_compilation(compilation, results):
+    '''
+    Resumes 'compilation' (a generator returned by _compile_to_hardware) with
+    the results of the jobs it last yielded. Returns (True, output) once it
+    is done, otherwise (False, jobs) with the next jobs to run.
+    '''
+    try:
+        return False, compilation.send(results)
+    except StopIteration as e:
+        return True, e.value
 
-    # save input code to file
-    save_code(seqs, fileName + suffix)
 
-    # all sequences should start with a WAIT for synchronization
-    for seq in seqs:
-        if not isinstance(seq[0], ControlFlow.Wait):
-            logger.debug("Adding a WAIT - first sequence element was %s", seq[0])
-            seq.insert(0, ControlFlow.Wait())
+def run_compilation(compilation, workers=None):
+    '''
+    Runs 'compilation' to the end. The jobs it yields are run in turn, or in
+    a pool of 'workers' processes if workers > 1 (see run_jobs_parallel).
+    '''
+    done, value = step_compilation(compilation, None)
+    while not done:
+        if workers and workers > 1 and len(value) > 1:
+            results = run_jobs_parallel(value, workers)
+        else:
+            results = [job() for job in value]
+        done, value = step_compilation(compilation, results)
+    return value
 
-    # Add the digitizer trigger to measurements
-    logger.debug("Adding digitizer trigger")
-    PatternUtils.add_digitizer_trigger(seqs)
 
-    # Add gating/blanking pulses
-    logger.debug("Adding blanking pulses")
-    for seq in seqs:
-        PatternUtils.add_gate_pulses(seq)
+def _run_job(ct):
+    return _parallel_state['jobs'][ct]()
 
-    if add_slave_trigger and 'slave_trig' in ChannelLibraries.channelLib:
-        # Add the slave trigger
-        logger.debug("Adding slave trigger")
-        PatternUtils.add_slave_trigger(seqs,
-                                       ChannelLibraries.channelLib['slave_trig'])
+def run_jobs_parallel(jobs, workers):
+    '''
+    Runs each of 'jobs' in a pool of forked worker processes and returns
+    their results in order. The jobs only see the state of the parent at the
+    time of the fork and the stages they record in a profiler are lost. Falls
+    back to running them serially where fork is not available.
+    '''
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        warn("Parallel writing requires fork; writing serially")
+        return [job() for job in jobs]
+
+    _parallel_state['jobs'] = jobs
+    logger.debug("Running %d jobs on %d workers", len(jobs), workers)
+    try:
+        with multiprocessing.get_context('fork').Pool(min(workers, len(jobs))) as pool:
+            return pool.map(_run_job, range(len(jobs)))
+    finally:
+        _parallel_state.clear()
+
+
+def _compile_to_hardware(seqs, fileName, suffix, axis_descriptor,
+                         add_slave_trigger, extra_meta, tdm_seq, workers,
+                         cache, sweep_template, hoist_subroutines, profile,
+                         in_memory=False):
+    '''
+    Generator running the stages of compile_to_hardware. It yields once, with
+    a list of callables writing the sequence file (or building the buffers)
+    of each AWG, and expects the list of their results to be sent back, so
+    that the caller decides how to run them. Returns the meta file path, or
+    (buffers, meta) when 'in_memory'.
+    '''
+    profiler = CompileProfile.get_profiler(profile)
+    # memory is traced once for the whole compilation, including the writes
+    # the caller runs, rather than per stage
+    with profiler.tracing():
+        return (yield from _compile_stages(
+            seqs, fileName, suffix, axis_descriptor, add_slave_trigger,
+            extra_meta, tdm_seq, workers, cache, sweep_template,
+            hoist_subroutines, profiler, in_memory))
+
+
+def _compile_stages(seqs, fileName, suffix, axis_descriptor,
+                    add_slave_trigger, extra_meta, tdm_seq, workers, cache,
+                    sweep_template, hoist_subroutines, profiler, in_memory):
+    logger.debug("Compiling %d sequence(s)", len(seqs))
+
+    if cache is None:
+        cache = CompileCache.get_cache()
+    if cache:
+        cache.reset_stats()
+
+    # save input code to file
+    if not in_memory:
+        with profiler.stage('save_code'):
+            save_code(seqs, fileName + suffix)
+
+    # identical sequences are preprocessed and compiled once, unless they
+    # could share subroutines
+    originals = list(range(len(seqs)))
+    if not hoist_subroutines:
+        with profiler.stage('find_duplicate_sequences'):
+            originals = find_duplicate_sequences(seqs)
+    unique = [seq for ct, seq in enumerate(seqs) if originals[ct] == ct]
+    numUnique = len(unique)
+    if numUnique == len(seqs):
+        unique = seqs
     else:
-        logger.debug("Not adding slave trigger")
+        logger.debug("Compiling %d unique of %d sequences", numUnique, len(seqs))
+
+    if sweep_template:
+        preprocess_sweep(unique, add_slave_trigger, profiler=profiler)
+    else:
+        preprocess_sequences(unique, add_slave_trigger, profiler)
+
+    if hoist_subroutines:
+        with profiler.stage('extract_subroutines'):
+            extract_subroutines(seqs)
 
     # find channel set at top level to account for individual sequence channel variability
     channels = set()
-    for seq in seqs:
+    for seq in unique:
         channels |= find_unique_channels(seq)
 
     # Compile all the pulses/pulseblocks to sequences of pulses and control flow
-    wireSeqs = compile_sequences(seqs, channels)
+    with profiler.stage('compile_sequences'):
+        wireSeqs = compile_sequences(unique, channels, workers=workers,
+                                     cache=cache)
+
+    if unique is not seqs:
+        with profiler.stage('expand_duplicate_sequences'):
+            for ct, original in enumerate(originals):
+                if original != ct:
+                    seqs[ct][:] = seqs[original]
+            # along with the specializations appended by compile_sequences
+            seqs += unique[numUnique:]
+            wireSeqs = expand_wires(wireSeqs, originals)
 
     if not validate_linklist_channels(wireSeqs.keys()):
         print("Compile to hardware failed")
@@ -362,21 +825,24 @@ def compile_to_hardware(seqs,
     logger.debug('')
     logger.debug("Now after gating constraints:")
     # apply gating constraints
-    for chan, seq in wireSeqs.items():
-        if isinstance(chan, Channels.LogicalMarkerChannel):
-            wireSeqs[chan] = PatternUtils.apply_gating_constraints(
-                chan.phys_chan, seq)
+    with profiler.stage('apply_gating_constraints'):
+        for chan, seq in wireSeqs.items():
+            if isinstance(chan, Channels.LogicalMarkerChannel):
+                wireSeqs[chan] = PatternUtils.apply_gating_constraints(
+                    chan.phys_chan, seq)
     debug_print(wireSeqs, 'Gated sequence')
 
     # save number of measurements for meta info
-    num_measurements = count_measurements(wireSeqs)
-    wire_measurements = count_measurements_per_wire(wireSeqs)
+    with profiler.stage('count_measurements'):
+        num_measurements = count_measurements(wireSeqs)
+        wire_measurements = count_measurements_per_wire(wireSeqs)
 
     # map logical to physical channels, physWires is a list of
     # PhysicalQuadratureChannels and PhysicalMarkerChannels
     # for the APS, the naming convention is:
     # ASPName-12, or APSName-12m1
-    physWires = map_logical_to_physical(wireSeqs)
+    with profiler.stage('map_logical_to_physical'):
+        physWires = map_logical_to_physical(wireSeqs)
 
     # Pave the way for composite instruments, not useful yet...
     files = {}
@@ -404,15 +870,18 @@ def compile_to_hardware(seqs,
     delays = channel_delay_map(physWires)
 
     # apply delays
-    for chan, wire in physWires.items():
-        PatternUtils.delay(wire, delays[chan])
+    with profiler.stage('delay'):
+        for chan, wire in physWires.items():
+            PatternUtils.delay(wire, delays[chan])
     debug_print(physWires, 'Delayed wire')
 
     # generate wf library (base shapes)
-    wfs = generate_waveforms(physWires)
+    with profiler.stage('generate_waveforms'):
+        wfs = generate_waveforms(physWires, cache)
 
     # replace Pulse objects with Waveforms
-    physWires = pulses_to_waveforms(physWires)
+    with profiler.stage('pulses_to_waveforms'):
+        physWires = pulses_to_waveforms(physWires)
 
     # bundle wires on instruments, or channels depending
     # on whether we have one sequence per channel
@@ -421,33 +890,62 @@ def compile_to_hardware(seqs,
     # convert to hardware formats
     # files = {}
     awg_metas = {}
+    buffers = OrderedDict()
+    jobs = []
     for awgName, data in awgData.items():
-        # create the target folder if it does not exist
-        targetFolder = os.path.split(os.path.normpath(os.path.join(
-            config.AWGDir, fileName)))[0]
-        if not os.path.exists(targetFolder):
-            os.mkdir(targetFolder)
-        fullFileName = os.path.normpath(os.path.join(
-            config.AWGDir, fileName + '-' + awgName + suffix + data[
-                'seqFileExt']))
-        new_meta = data['translator'].write_sequence_file(data, fullFileName)
-        if new_meta:
-            awg_metas[awgName] = new_meta
+        translatorName = data['translator'].__name__.rsplit('.', 1)[-1]
+        if in_memory:
+            if not hasattr(data['translator'], 'sequence_buffers'):
+                raise NotImplementedError(
+                    "{} cannot compile to memory".format(translatorName))
+            jobs.append(partial(run_stage, profiler,
+                                translatorName + '.sequence_buffers',
+                                data['translator'].sequence_buffers, data))
+            location = awgName
+        else:
+            # create the target folder if it does not exist
+            targetFolder = os.path.split(os.path.normpath(os.path.join(
+                config.AWGDir, fileName)))[0]
+            if not os.path.exists(targetFolder):
+                os.mkdir(targetFolder)
+            location = os.path.normpath(os.path.join(
+                config.AWGDir, fileName + '-' + awgName + suffix + data[
+                    'seqFileExt']))
+            jobs.append(partial(run_stage, profiler,
+                                translatorName + '.write_sequence_file',
+                                data['translator'].write_sequence_file, data,
+                                location))
 
         # Allow for per channel and per AWG seq files
         if awgName in label_to_inst:
             if awgName in label_to_chan:
-                files[label_to_inst[awgName]][label_to_chan[awgName]] = fullFileName
+                files[label_to_inst[awgName]][label_to_chan[awgName]] = location
         else:
-            files[awgName] = fullFileName
+            files[awgName] = location
+
+    # the caller runs the writes of the AWGs, possibly concurrently
+    results = yield jobs
+    for awgName, result in zip(awgData, results):
+        if in_memory:
+            buffers[awgName], new_meta = result
+        else:
+            new_meta = result
+        if new_meta:
+            awg_metas[awgName] = new_meta
+
     # generate TDM sequences FIXME: what's the best way to identify the need for a TDM seq.? Support for single TDM
     if tdm_seq and 'APS2Pattern' in [wire.translator for wire in physWires]:
             aps2tdm_module = import_module('QGL.drivers.APS2Pattern') # this is redundant with above
-            tdm_instr = aps2tdm_module.tdm_instructions(seqs)
-            files['TDM'] = os.path.normpath(os.path.join(
-                config.AWGDir, fileName + '-' + 'TDM' + suffix + data[
-                    'seqFileExt']))
-            aps2tdm_module.write_tdm_seq(tdm_instr, files['TDM'])
+            with profiler.stage('APS2Pattern.write_tdm_seq'):
+                tdm_instr = aps2tdm_module.tdm_instructions(seqs)
+                if in_memory:
+                    files['TDM'] = 'TDM'
+                    buffers['TDM'] = aps2tdm_module.tdm_datasets(tdm_instr)
+                else:
+                    files['TDM'] = os.path.normpath(os.path.join(
+                        config.AWGDir, fileName + '-' + 'TDM' + suffix + data[
+                            'seqFileExt']))
+                    aps2tdm_module.write_tdm_seq(tdm_instr, files['TDM'])
 
     if extra_meta:
         extra_meta.update(awg_metas)
@@ -474,9 +972,20 @@ def compile_to_hardware(seqs,
     }
     if extra_meta:
         meta.update({'extra_meta': extra_meta})
-    metafilepath = os.path.join(config.AWGDir, fileName + '-meta.json')
-    with open(metafilepath, 'w') as FID:
-        json.dump(meta, FID, indent=2, sort_keys=True)
+    if cache:
+        cache.prune()
+        meta['compile_cache'] = cache.report()
+    if profiler:
+        # the meta write itself only shows up in the log
+        meta['compile_profile'] = profiler.to_dict()
+    if not in_memory:
+        metafilepath = os.path.join(config.AWGDir, fileName + '-meta.json')
+        with profiler.stage('write_meta'):
+            with open(metafilepath, 'w') as FID:
+                json.dump(meta, FID, indent=2, sort_keys=True)
+    if profiler:
+        logger.info("Compile profile for %s:\n%s", fileName or 'memory',
+                    profiler.report())
 
     # Restore the wire info
     for wire in old_wire_names.keys():
@@ -484,13 +993,265 @@ def compile_to_hardware(seqs,
     for wire in old_wire_instrs.keys():
         wire.instrument = old_wire_instrs[wire]
 
+    if in_memory:
+        return buffers, meta
     # Return the filenames we wrote
     return metafilepath
 
 
-def compile_sequences(seqs, channels=set()):
+def compile_to_hardware_streaming(seqs,
+                                  fileName,
+                                  chunk_size=1000,
+                                  channels=None,
+                                  suffix='',
+                                  axis_descriptor=None,
+                                  add_slave_trigger=True,
+                                  extra_meta=None,
+                                  workers=None,
+                                  cache=None,
+                                  sweep_template=False):
+    '''
+    Compiles 'seqs' like compile_to_hardware, but 'seqs' may be any iterable
+    (e.g. a generator) of sequences. Sequences are pulled and compiled
+    'chunk_size' at a time and appended to the sequence files as they go, so
+    the memory used does not grow with the number of sequences.
+    Other inputs:
+        channels (optional): the set of logical channels used by all the
+            sequences. Defaults to the channels of the first chunk; later
+            chunks may not use any other channel.
+        The remaining inputs are as for compile_to_hardware.
+    Streaming is only supported by translators providing a
+    SequenceFileWriter (i.e. the APS2) and does not support subroutine calls.
+    '''
+    if cache is None:
+        cache = CompileCache.get_cache()
+    if cache:
+        cache.reset_stats()
+
+    num_sequences = 0
+    num_measurements = 0
+    wire_measurements = {}
+    first_label = None
+    delays = None
+    writers = OrderedDict()
+    files = {}
+
+    with ExitStack() as stack:
+        codeFile = stack.enter_context(open_code_file(fileName + suffix))
+        for chunk, last in iterate_chunks(seqs, chunk_size):
+            # save input code to file
+            for seq in chunk:
+                codeFile.write(u',\n ' if num_sequences else u'[')
+                codeFile.write(pretty_code(seq))
+                num_sequences += 1
+            if collect_specializations(chunk):
+                raise NotImplementedError(
+                    "Subroutine calls cannot be compiled in streaming mode")
+
+            if sweep_template:
+                preprocess_sweep(chunk, add_slave_trigger)
+            else:
+                preprocess_sequences(chunk, add_slave_trigger)
+
+            chunk_channels = set()
+            for seq in chunk:
+                chunk_channels |= find_unique_channels(seq)
+            if channels is None:
+                channels = chunk_channels
+            elif not chunk_channels <= channels:
+                raise ValueError(
+                    "Sequences use channels {0} that are not in the channel "
+                    "set; pass all channels up front".format(
+                        [chan.label for chan in chunk_channels - channels]))
+
+            # turn into a loop, by appending GOTO(0) at end of last sequence
+            if first_label is None:
+                first_label = BlockLabel.label(chunk[0])
+            if last and not isinstance(chunk[-1][-1], ControlFlow.Goto):
+                chunk[-1].append(ControlFlow.Goto(first_label))
+
+            wireSeqs = compile_wires(chunk, channels, workers=workers,
+                                     cache=cache)
+            if not validate_linklist_channels(wireSeqs.keys()):
+                print("Compile to hardware failed")
+                return
+
+            # apply gating constraints
+            for chan, seq in wireSeqs.items():
+                if isinstance(chan, Channels.LogicalMarkerChannel):
+                    wireSeqs[chan] = PatternUtils.apply_gating_constraints(
+                        chan.phys_chan, seq)
+
+            num_measurements += count_measurements(wireSeqs)
+            for wire, n in count_measurements_per_wire(wireSeqs).items():
+                wire_measurements[wire] = wire_measurements.get(wire, 0) + n
+
+            physWires = map_logical_to_physical(wireSeqs)
+
+            if delays is None:
+                for wire in physWires.keys():
+                    pattern_module = import_module('QGL.drivers.' + wire.translator)
+                    if not hasattr(pattern_module, 'SequenceFileWriter'):
+                        raise NotImplementedError(
+                            "{0} does not support streaming compilation".format(
+                                wire.translator))
+                delays = channel_delay_map(physWires)
+            for chan, wire in physWires.items():
+                PatternUtils.delay(wire, delays[chan])
+
+            wfs = generate_waveforms(physWires, cache)
+            physWires = pulses_to_waveforms(physWires)
+            awgData = bundle_wires(physWires, wfs)
+
+            for awgName, data in awgData.items():
+                if awgName not in writers:
+                    # create the target folder if it does not exist
+                    targetFolder = os.path.split(os.path.normpath(os.path.join(
+                        config.AWGDir, fileName)))[0]
+                    if not os.path.exists(targetFolder):
+                        os.mkdir(targetFolder)
+                    files[awgName] = os.path.normpath(os.path.join(
+                        config.AWGDir, fileName + '-' + awgName + suffix +
+                        data['seqFileExt']))
+                    writers[awgName] = stack.enter_context(
+                        data['translator'].SequenceFileWriter(files[awgName]))
+                writers[awgName].append(data)
+
+        if num_sequences == 0:
+            raise ValueError("No sequences to compile")
+        codeFile.write(u']')
+
+        awg_metas = {}
+        for awgName, writer in writers.items():
+            new_meta = writer.close()
+            if new_meta:
+                awg_metas[awgName] = new_meta
+
+    print('Compiled {} sequences.'.format(num_sequences))
+
+    if extra_meta:
+        extra_meta.update(awg_metas)
+    else:
+        extra_meta = awg_metas
+    # create meta output
+    if not axis_descriptor:
+        axis_descriptor = [{
+            'name': 'segment',
+            'unit': None,
+            'points': list(range(1, 1 + num_measurements)),
+            'partition': 1
+        }]
+    receiver_measurements = {}
+    for wire, n in wire_measurements.items():
+        if wire.receiver_chan and n>0:
+            receiver_measurements[wire.receiver_chan.label] = n
+    meta = {
+        'instruments': files,
+        'num_sequences': num_sequences,
+        'num_measurements': num_measurements,
+        'axis_descriptor': axis_descriptor,
+        'receivers': receiver_measurements
+    }
+    if extra_meta:
+        meta.update({'extra_meta': extra_meta})
+    if cache:
+        cache.prune()
+        meta['compile_cache'] = cache.report()
+    metafilepath = os.path.join(config.AWGDir, fileName + '-meta.json')
+    with open(metafilepath, 'w') as FID:
+        json.dump(meta, FID, indent=2, sort_keys=True)
+
+    return metafilepath
+
+
+def iterate_chunks(seqs, chunk_size):
+    '''
+    Yields (chunk, last) pairs of up to 'chunk_size' sequences taken from the
+    iterable 'seqs', where 'last' flags the final chunk.
+    '''
+    seqs = iter(seqs)
+    chunk = list(islice(seqs, chunk_size))
+    while chunk:
+        following = list(islice(seqs, chunk_size))
+        yield chunk, not following
+        chunk = following
+
+
+def find_duplicate_sequences(seqs):
+    '''
+    Returns the index of the first sequence identical to each of 'seqs', or
+    its own index. Sequences are identical when they have the same local
+    fingerprint (see CompileCache.fingerprint), so their shape functions must
+    be the same objects. Only sequences sharing a cheap signature with
+    another one are fingerprinted. The first and last sequences, which get
+    the label and the GOTO closing the loop, are always kept.
+    '''
+    candidates = {}
+    for ct, seq in enumerate(seqs[1:-1], 1):
+        try:
+            candidates.setdefault(sequence_signature(seq), []).append(ct)
+        except TypeError:
+            # unhashable pulse parameters
+            continue
+    originals = list(range(len(seqs)))
+    memo = {}
+    for cts in candidates.values():
+        if len(cts) < 2:
+            continue
+        firsts = {}
+        for ct in cts:
+            try:
+                key = CompileCache.fingerprint(seqs[ct], memo, local=True)
+            except CompileCache.Uncacheable:
+                continue
+            originals[ct] = firsts.setdefault(key, ct)
+    return originals
+
+
+def sequence_signature(entry):
+    # the labels and scalar parameters of the pulses, which tell most
+    # sequences of an experiment apart
+    if isinstance(entry, Pulse):
+        return (entry.label, entry.length, entry.amp, entry.phase)
+    if isinstance(entry, PulseBlock):
+        return tuple(sequence_signature(p) for p in entry.pulses.values())
+    if isinstance(entry, CompositePulse):
+        return sequence_signature(entry.pulses)
+    if isinstance(entry, CompoundGate):
+        return sequence_signature(entry.seq)
+    if isinstance(entry, list):
+        return tuple(sequence_signature(p) for p in entry)
+    return type(entry)
+
+
+def expand_wires(wireSeqs, originals):
+    '''
+    Expands the wires compiled for the unique sequences (followed by any
+    subroutines) to all the sequences, where the sequence ct is identical to
+    the sequence originals[ct]. Duplicates get copies of the wires of their
+    original: the pulses are immutable and shared, but the control flow is
+    copied since the translators timestamp it in place.
+    '''
+    positions = {}
+    for ct, original in enumerate(originals):
+        if original == ct:
+            positions[ct] = len(positions)
+    expanded = {}
+    for chan, wires in wireSeqs.items():
+        expanded[chan] = [wires[positions[ct]] if original == ct else
+                          [entry if isinstance(entry, Pulse) else copy(entry)
+                           for entry in wires[positions[original]]]
+                          for ct, original in enumerate(originals)]
+        expanded[chan] += wires[len(positions):]
+    return expanded
+
+
+def compile_sequences(seqs, channels=set(), workers=None, cache=None):
     '''
     Main function to convert sequences to miniLL's and waveform libraries.
+    If workers > 1, the sequences are compiled in a pool of worker processes.
+    If a CompileCache is given, sequences compiled before against the same
+    channel parameters are loaded from it rather than compiled again.
     '''
 
     # turn into a loop, by appending GOTO(0) at end of last sequence
@@ -504,17 +1265,9 @@ def compile_sequences(seqs, channels=set()):
 
     #expand the channel definitions for anything defined in subroutines
     for func in subroutines:
-        channels |= find_unique_channels(subroutines)
+        channels = channels | find_unique_channels(subroutines)
 
-    # use seqs[0] as prototype in case we were not given a set of channels
-    wires = compile_sequence(seqs[0], channels)
-    if not channels:
-        channels = set(wires.keys())
-    wireSeqs = {chan: [seq] for chan, seq in wires.items()}
-    for seq in seqs[1:]:
-        wires = compile_sequence(seq, channels)
-        for chan in wireSeqs.keys():
-            wireSeqs[chan].append(wires[chan])
+    wireSeqs = compile_wires(seqs, channels, workers=workers, cache=cache)
     #Print a message so for the experiment we know how many sequences there are
     print('Compiled {} sequences.'.format(len(seqs) - len(subroutines)))
 
@@ -523,6 +1276,114 @@ def compile_sequences(seqs, channels=set()):
 
     return wireSeqs
 
+
+def compile_wires(seqs, channels, workers=None, cache=None):
+    '''
+    Compiles each sequence in 'seqs' as is and collects the results into a
+    dictionary of wires keyed by channel.
+    '''
+    compiled = [None] * len(seqs)
+    if not channels:
+        # use seqs[0] as prototype in case we were not given a set of channels
+        compiled[0] = compile_sequence(seqs[0], channels)
+        channels = set(compiled[0].keys())
+        chanList = list(compiled[0].keys())
+    else:
+        chanList = list(channels)
+
+    if cache:
+        keys = cache.sequence_keys(seqs, channels)
+        if compiled[0] is not None:
+            cache.store_wires(keys[0], compiled[0])
+        for ct, key in enumerate(keys):
+            if compiled[ct] is None:
+                compiled[ct] = cache.load_wires(key, chanList)
+    todo = [ct for ct, wires in enumerate(compiled) if wires is None]
+
+    if workers and workers > 1 and len(todo) > 1:
+        results = compile_sequences_parallel([seqs[ct] for ct in todo],
+                                             channels, chanList, workers)
+        for ct, wires in zip(todo, results):
+            compiled[ct] = dict(zip(chanList, wires))
+    else:
+        for ct in todo:
+            compiled[ct] = compile_sequence(seqs[ct], channels)
+
+    if cache:
+        for ct in todo:
+            cache.store_wires(keys[ct], compiled[ct])
+
+    return {chan: [wires[chan] for wires in compiled] for chan in chanList}
+
+# state shared with forked worker processes in compile_sequences_parallel
+_parallel_state = {}
+
+class _ChannelPickler(pickle.Pickler):
+    '''
+    Pickles channels by reference into a table shared by the parent and the
+    forked workers, so that the compiled wires keep pointing at the parent's
+    channel objects.
+    '''
+    def persistent_id(self, obj):
+        if isinstance(obj, Channels.Channel):
+            return _parallel_state['chanIndex'].get(id(obj))
+        return None
+
+class _ChannelUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return _parallel_state['chanTable'][pid]
+
+def _compile_chunk(bounds):
+    start, stop = bounds
+    seqs = _parallel_state['seqs']
+    channels = _parallel_state['channels']
+    chanList = _parallel_state['chanList']
+    out = []
+    for seq in seqs[start:stop]:
+        wires = compile_sequence(seq, channels)
+        out.append([wires[chan] for chan in chanList])
+    buf = io.BytesIO()
+    _ChannelPickler(buf, pickle.HIGHEST_PROTOCOL).dump(out)
+    return buf.getvalue()
+
+def compile_sequences_parallel(seqs, channels, chanList, workers):
+    '''
+    Compile each sequence in seqs in a pool of forked worker processes.
+    Returns a list with one entry per sequence holding the compiled wires in
+    chanList order. Falls back to serial compilation where fork is not available.
+    '''
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        warn("Parallel compilation requires fork; compiling serially")
+        return [[wires[chan] for chan in chanList] for wires in
+                (compile_sequence(seq, channels) for seq in seqs)]
+
+    chanTable = list(chanList)
+    for chan in ChannelLibraries.channelLib.channelDict.values():
+        if isinstance(chan, Channels.Channel):
+            chanTable.append(chan)
+    _parallel_state.update({
+        'seqs': seqs,
+        'channels': channels,
+        'chanList': chanList,
+        'chanTable': chanTable,
+        'chanIndex': {id(chan): ct for ct, chan in enumerate(chanTable)}
+    })
+
+    # a few chunks per worker to balance uneven sequence lengths
+    numChunks = min(len(seqs), 4 * workers)
+    edges = np.linspace(0, len(seqs), numChunks + 1).astype(int)
+    logger.debug("Compiling %d sequences in %d chunks on %d workers",
+                 len(seqs), numChunks, workers)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            chunks = pool.map(_compile_chunk, zip(edges[:-1], edges[1:]))
+        out = []
+        for chunk in chunks:
+            out += _ChannelUnpickler(io.BytesIO(chunk)).load()
+    finally:
+        _parallel_state.clear()
+    return out
+
 def compile_sequence(seq, channels=None):
     '''
     Takes a list of control flow and pulses, and returns aligned blocks
@@ -659,8 +1520,10 @@ def normalize(seq, channels=None):
 class Waveform(object):
     """
     Simplified channel independent version of a Pulse with a key into waveform library.
+    Waveforms are slotted since there is one per entry of every wire.
     """
-
+    __slots__ = ('label', 'key', 'amp', 'length', 'phase', 'frameChange',
+                 'isTimeAmp', 'frequency', 'logicalChan', 'maddr', 'startTime')
 
     def __init__(self, pulse=None):
         if pulse is None:
@@ -685,6 +1548,7 @@ class Waveform(object):
             self.frequency = pulse.frequency
             self.logicalChan = pulse.channel
             self.maddr = pulse.maddr
+        self.startTime = None
 
     def __repr__(self):
         return self.__str__()
@@ -697,16 +1561,19 @@ class Waveform(object):
             return "Waveform(" + self.label + ", " + str(
                 self.key)[:6] + ", " + str(self.length) + ")"
 
+    def _fields(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return self._fields() == other._fields()
         return False
 
     def __ne__(self, other):
         return not self == other
 
     def __hash__(self):
-        return hash(frozenset(self.__dict__.items()))
+        return hash(self._fields())
 
     @property
     def isZero(self):
@@ -780,7 +1647,10 @@ def debug_print(seqs, label):
                     logger.debug(" %s", elem)
 
 def save_code(seqs, filename):
-    from IPython.lib.pretty import pretty
+    with open_code_file(filename) as FID:
+        FID.write(pretty_code(seqs))
+
+def open_code_file(filename):
     import io  #needed for writing unicode to file in Python 2.7
     # create the target folder if it does not exist
     targetFolder = os.path.split(os.path.normpath(os.path.join(config.AWGDir,
@@ -789,36 +1659,61 @@ def save_code(seqs, filename):
         os.mkdir(targetFolder)
     fullname = os.path.normpath(os.path.join(config.AWGDir, filename +
                                              '-code.py'))
-    with io.open(fullname, "w", encoding="utf-8") as FID:
-        FID.write(u'seqs =\n')
-        FID.write(pretty(seqs))
+    FID = io.open(fullname, "w", encoding="utf-8")
+    FID.write(u'seqs =\n')
+    return FID
+
+def pretty_code(seqs):
+    from IPython.lib.pretty import pretty
+    return pretty(seqs)
 
 def count_measurements(wireSeqs):
     # count number of measurements per sequence as the max over the the number
     # of measurements per wire
-
-    # pick an arbitrary key to determine sequence length
-    seq_len = len(wireSeqs[list(wireSeqs)[0]])
-    seq_measurements = [0 for _ in range(seq_len)]
-    for ct in range(seq_len):
-        seq_measurements[ct] = \
-            reduce(max, count_measurements_per_wire_idx(wireSeqs, ct).values())
+    subroutines = find_subroutines(wireSeqs)
+    seq_measurements = [
+        reduce(max, count_measurements_per_wire_idx(wireSeqs, ct, subroutines).values())
+        for ct in sequence_indices(wireSeqs, subroutines)]
     return sum(seq_measurements)
 
 def count_measurements_per_wire(wireSeqs):
-    # pick an arbitrary key to determine sequence length
-    seq_len = len(wireSeqs[list(wireSeqs)[0]])
+    subroutines = find_subroutines(wireSeqs)
     meas_wires = list(filter(lambda x: isinstance(x, Channels.Measurement), wireSeqs))
     measurements = {wire: 0 for wire in meas_wires}
-    for ct in range(seq_len):
-        seq_measurements = count_measurements_per_wire_idx(wireSeqs, ct)
+    for ct in sequence_indices(wireSeqs, subroutines):
+        seq_measurements = count_measurements_per_wire_idx(wireSeqs, ct, subroutines)
         for wire in meas_wires:
             measurements[wire] += seq_measurements[wire]
     return measurements
 
-def count_measurements_per_wire_idx(wireSeqs, idx):
-    measurements = {
-        wire: sum(PatternUtils.contains_measurement(e) for e in seqs[idx])
-              for wire, seqs in wireSeqs.items()
-    }
+def count_measurements_per_wire_idx(wireSeqs, idx, subroutines=None):
+    # measurements in subroutines count once per call
+    if subroutines is None:
+        subroutines = {}
+    measurements = {}
+    for wire, seqs in wireSeqs.items():
+        count = 0
+        for e in seqs[idx]:
+            if isinstance(e, ControlFlow.Call) and e.target in subroutines:
+                count += count_measurements_per_wire_idx(
+                    {wire: seqs}, subroutines[e.target], subroutines)[wire]
+            else:
+                count += PatternUtils.contains_measurement(e)
+        measurements[wire] = count
     return measurements
+
+def find_subroutines(wireSeqs):
+    '''
+    Maps the labels of the subroutines appended by compile_sequences to their
+    index in the wires.
+    '''
+    # pick an arbitrary key, all wires share the control flow
+    seqs = wireSeqs[list(wireSeqs)[0]]
+    return {seq[0]: ct for ct, seq in enumerate(seqs)
+            if len(seq) > 1 and isinstance(seq[0], BlockLabel.BlockLabel) and
+            isinstance(seq[-1], ControlFlow.Return)}
+
+def sequence_indices(wireSeqs, subroutines):
+    seq_len = len(wireSeqs[list(wireSeqs)[0]])
+    subroutine_idx = set(subroutines.values())
+    return [ct for ct in range(seq_len) if ct not in subroutine_idx]
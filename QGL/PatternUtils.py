@@ -77,14 +77,20 @@ def correct_mixers(wfLib, T):
         wfLib[k] = T[0, :].dot(iqWF) + 1j * T[1, :].dot(iqWF)
 
 
-def add_gate_pulses(seq):
+def add_gate_pulses(seq, gated=None):
     '''
-    add gating pulses to Qubit pulses
+    add gating pulses to Qubit pulses. CompoundGates are updated in place, so
+    those shared between sequences are only gated once when the same 'gated'
+    set (of the ids of the gates already done) is passed for each sequence.
     '''
+    if gated is None:
+        gated = set()
 
     for ct in range(len(seq)):
         if isinstance(seq[ct], CompoundGate):
-            add_gate_pulses(seq[ct].seq)
+            if id(seq[ct]) not in gated:
+                gated.add(id(seq[ct]))
+                add_gate_pulses(seq[ct].seq, gated)
         elif isinstance(seq[ct], PulseBlock):
             pb = None
             for chan, pulse in seq[ct].pulses.items():
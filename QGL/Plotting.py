@@ -22,15 +22,16 @@ limitations under the License.
 '''
 
 import os.path, uuid, tempfile
-import bokeh.plotting as bk
-from bokeh.layouts import column
-from bokeh.util.warnings import BokehUserWarning
-from bokeh.resources import INLINE
 import numpy as np
 import warnings
 from . import config
 
+# bokeh is imported on first use as it is slow to import
+
 def output_notebook(local=True, suppress_warnings=False):
+    import bokeh.plotting as bk
+    from bokeh.util.warnings import BokehUserWarning
+    from bokeh.resources import INLINE
     if suppress_warnings:
         warnings.simplefilter("ignore", BokehUserWarning)
     if local:
@@ -39,6 +40,8 @@ def output_notebook(local=True, suppress_warnings=False):
         bk.output_notebook()
 
 def output_file(local=True, suppress_warnings=True):
+    import bokeh.plotting as bk
+    from bokeh.util.warnings import BokehUserWarning
     if suppress_warnings:
         warnings.simplefilter("ignore", BokehUserWarning)
     mode = "inline" if local else "cdn"
@@ -78,6 +81,8 @@ def build_waveforms(seq):
 
 
 def plot_waveforms(waveforms, figTitle=''):
+    import bokeh.plotting as bk
+    from bokeh.layouts import column
     channels = waveforms.keys()
     # plot
     plots = []
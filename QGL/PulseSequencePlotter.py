@@ -25,12 +25,6 @@ limitations under the License.
 import os.path
 import json
 from importlib import import_module
-from bokeh.layouts import column
-from bokeh.models import CustomJS, ColumnDataSource, Slider
-from bokeh.plotting import Figure, show
-from bokeh.palettes import d3, brewer, Inferno
-
-from jinja2 import Template
 import numpy as np
 
 from . import config
@@ -54,8 +48,15 @@ def build_awg_translator_map():
             translators_map[ext] = [module]
     return translators_map
 
-# static translator map
-translators = build_awg_translator_map()
+# static translator map, built on first use so that the drivers (and h5py) are
+# not imported along with QGL
+translators = None
+
+def get_translators():
+    global translators
+    if translators is None:
+        translators = build_awg_translator_map()
+    return translators
 
 
 def resolve_translator(filename, translators):
@@ -77,6 +78,13 @@ def plot_pulse_files(metafile, time=False):
 
     Helper function to plot a list of AWG files. A JS slider allows choice of sequence number.
     '''
+    # bokeh is slow to import, so only do it when plotting
+    from bokeh.layouts import column
+    from bokeh.models import CustomJS, ColumnDataSource, Slider
+    from bokeh.plotting import Figure, show
+    from bokeh.palettes import d3, brewer, Inferno
+    from jinja2 import Template
+
     #If we only go one filename turn it into a list
     
     with open(metafile, 'r') as FID:
@@ -169,7 +177,7 @@ def extract_waveforms(fileNames, nameDecorator='', time=False):
         if '_' in AWGName:
             AWGName = AWGName[:AWGName.index('_')]
 
-        translator = resolve_translator(fileName, translators)
+        translator = resolve_translator(fileName, get_translators())
         wfs = translator.read_sequence_file(fileName)
         sample_time = 1.0/translator.SAMPLING_RATE if time else 1
 
@@ -199,6 +207,13 @@ def plot_pulse_files_compare(metafile1, metafile2, time=False):
 
     Helper function to plot a list of AWG files. A JS slider allows choice of sequence number.
     '''
+    # bokeh is slow to import, so only do it when plotting
+    from bokeh.layouts import column
+    from bokeh.models import CustomJS, ColumnDataSource, Slider
+    from bokeh.plotting import Figure, show
+    from bokeh.palettes import d3, brewer, Inferno
+    from jinja2 import Template
+
     #If we only go one filename turn it into a list
     fileNames1 = []
     fileNames2 = []
@@ -30,10 +30,27 @@ from . import PulseShapes
 
 from collections import namedtuple
 
+class Fingerprinted(object):
+    '''
+    Gives pulses, blocks and gates a digest of their structure that is stable
+    across processes (see CompileCache.fingerprint).
+    '''
+    __slots__ = ()
+
+    def fingerprint(self, memo=None):
+        '''
+        Computing the digest walks the whole object. Pass the same 'memo' dict
+        to several calls to reuse the digests of the sub-objects they share,
+        e.g. memoized pulses, while those objects are alive.
+        '''
+        # CompileCache depends on this module
+        from . import CompileCache
+        return CompileCache.fingerprint(self, memo)
+
 class Pulse(namedtuple("Pulse", ["label", "channel", "length", "amp", "phase", "frequency",
                                  "frameChange", "shapeParams", "isTimeAmp",
                                  "isZero", "ignoredStrParams",
-                                 "maddr", "moffset"])):
+                                 "maddr", "moffset"]), Fingerprinted):
     __slots__ = ()
 
     def __new__(cls, label, channel, shapeParams, amp=1.0, phase=0, frameChange=0, ignoredStrParams=[], maddr=-1, moffset=0):
@@ -74,6 +91,10 @@ class Pulse(namedtuple("Pulse", ["label", "channel", "length", "amp", "phase", "
     def _repr_pretty_(self, p, cycle):
         p.text(str(self))
 
+    def __reduce__(self):
+        # restore the fields as is rather than re-deriving them in __new__
+        return (self._make, (tuple(self),))
+
     def hashshape(self):
         return hash(frozenset(self.shapeParams.items()))
 
@@ -130,7 +151,7 @@ def TAPulse(label,
 
 
 
-class CompositePulse(namedtuple("CompositePulse", ["label", "pulses"])):
+class CompositePulse(namedtuple("CompositePulse", ["label", "pulses"]), Fingerprinted):
     '''
     A sequential series of pulses that reside within one time bin of a pulse block
     '''
@@ -185,7 +206,7 @@ class CompositePulse(namedtuple("CompositePulse", ["label", "pulses"])):
         return all(p.isZero for p in self.pulses)
 
 
-class PulseBlock(object):
+class PulseBlock(Fingerprinted):
     '''
     The basic building block for pulse sequences. This is what we can concatenate
     together to make sequences. We overload the * operator so that we can combine
@@ -291,7 +312,7 @@ def align(mode="center", *pulses):
     else:
         logger.error('Pulse alignment type must be one of left, right, or center.')
 
-class CompoundGate(object):
+class CompoundGate(Fingerprinted):
     '''
     A wrapper around a python list to allow us to define '*' on lists.
     Used by multi-pulse structures like CNOT_CR so that we can retain the
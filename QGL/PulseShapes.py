@@ -2,7 +2,10 @@
 All generic pulse shapes are defined here.
 '''
 
+import operator
+import weakref
 import numpy as np
+from functools import reduce
 from math import pi, sin, cos, acos, sqrt
 
 
@@ -238,3 +241,64 @@ def arb_axis_drag(nutFreq=10e6,
             'Non-zero transverse rotation with zero-length pulse.')
 
     return shape
+
+
+class CompositeShape(object):
+    '''
+    The shape of a waveform composed of the shapes of other pulses, either
+    stacked end to end ('stack') or summed sample by sample ('sum'), each
+    scaled by a complex coefficient. It stands in for the shape function of
+    the composite pulse.
+
+    Nodes are interned: building a node equal to a live one returns that one,
+    so that its samples, which are computed once per sampling rate, are shared
+    by every channel and sequence using it.
+    '''
+    _nodes = weakref.WeakValueDictionary()
+
+    def __new__(cls, operation, coefficients, pulses):
+        coefficients = tuple(coefficients)
+        pulses = tuple(pulses)
+        key = (operation, tuple(zip(coefficients,
+            (frozenset(p.shapeParams.items()) for p in pulses))))
+        node = cls._nodes.get(key)
+        if node is None:
+            node = super(CompositeShape, cls).__new__(cls)
+            node.operation = operation
+            node.coefficients = coefficients
+            node.pulses = pulses
+            node.key = key
+            node.samples = {}
+            cls._nodes[key] = node
+        return node
+
+    def __call__(self, sampling_rate=1e9, **params):
+        if sampling_rate not in self.samples:
+            shapes = [c * _pulse_shape(p, sampling_rate)
+                      for c, p in zip(self.coefficients, self.pulses)]
+            if self.operation == 'stack':
+                wf = np.hstack(shapes)
+            else:
+                wf = reduce(operator.add, shapes)
+            self.samples[sampling_rate] = wf
+        return self.samples[sampling_rate]
+
+    def __reduce__(self):
+        # the samples are recomputed rather than pickled
+        return (CompositeShape, (self.operation, self.coefficients, self.pulses))
+
+    def __eq__(self, other):
+        return isinstance(other, CompositeShape) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+def _pulse_shape(pulse, sampling_rate):
+    params = dict(pulse.shapeParams)
+    shape_fun = params.pop('shape_fun')
+    params['sampling_rate'] = sampling_rate
+    return shape_fun(**params)
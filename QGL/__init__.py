@@ -1,7 +1,7 @@
 from .Channels import Qubit, Measurement, Edge
 from .ChannelLibraries import QubitFactory, MeasFactory, EdgeFactory, MarkerFactory, ChannelLibrary, channelLib
 from .PulsePrimitives import *
-from .Compiler import compile_to_hardware, set_log_level
+from .Compiler import compile_to_hardware, compile_to_hardware_streaming, compile_to_memory, compile_to_hardware_async, set_log_level
 from .PulseSequencer import align
 from .ControlFlow import repeat, repeatall, qif, qwhile, qdowhile, qfunction, qwait, qsync, Barrier
 from .BasicSequences import *
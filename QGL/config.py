@@ -21,6 +21,15 @@ pulse_primitives_lib = "standard"
 # CNOT in your gate set, e.g. CNOT_simple or CNOT_CR)
 cnot_implementation  = "CNOT_simple"
 
+# persistent compile cache: None/False to disable, True to cache in AWGDir,
+# or a directory
+compile_cache        = None
+# size limit of the compile cache in bytes
+compile_cache_size   = 2**30
+
+# record per-stage timings and memory of compile_to_hardware in the meta file
+compile_profile      = False
+
 class LoaderMeta(type):
     def __new__(metacls, __name__, __bases__, __dict__):
         """Add include constructer to class."""
@@ -68,6 +77,7 @@ def find_meas_file():
 
 def load_config(filename=None):
     global meas_file, AWGDir, plotBackground, gridColor, pulse_primitives_lib, cnot_implementation
+    global compile_cache, compile_cache_size, compile_profile
 
     if filename:
         meas_file = filename
@@ -93,5 +103,8 @@ def load_config(filename=None):
     gridColor            = cfg['config'].get('GridColor', None)
     pulse_primitives_lib = cfg['config'].get('PulsePrimitivesLibrary', 'standard')
     cnot_implementation  = cfg['config'].get('cnot_implementation', 'CNOT_simple')
+    compile_cache        = cfg['config'].get('CompileCache', None)
+    compile_cache_size   = int(cfg['config'].get('CompileCacheSize', 2**30))
+    compile_profile      = cfg['config'].get('CompileProfile', False)
 
     return meas_file
\ No newline at end of file
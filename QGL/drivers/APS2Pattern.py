@@ -18,8 +18,10 @@ limitations under the License.
 
 import os
 import logging
+import heapq
 from warnings import warn
 from copy import copy
+from collections import OrderedDict
 from future.moves.itertools import zip_longest
 import pickle
 
@@ -42,9 +44,12 @@ ADDRESS_UNIT = 4  #everything is done in units of 4 timesteps
 MIN_ENTRY_LENGTH = 8
 MAX_WAVEFORM_PTS = 2**28  #maximum size of waveform memory
 WAVEFORM_CACHE_SIZE = 2**17
+WAVEFORM_CACHE_LINE_LENGTH = WAVEFORM_CACHE_SIZE // 2  #the cache holds two lines
+CACHE_LINE_PLAN_WINDOW = 64  #run ends tried per cache line by plan_cache_lines
 MAX_WAVEFORM_VALUE = 2**13 - 1  #maximum waveform value i.e. 14bit DAC
 MAX_NUM_INSTRUCTIONS = 2**26
 MAX_REPEAT_COUNT = 2**16 - 1
+INSTRUCTION_CACHE_LINE_LENGTH = 128
 MAX_TRIGGER_COUNT = 2**32 - 1
 NUM_NCO = 4
 
@@ -106,6 +111,60 @@ SAVE_WF_OFFSETS = False
 # Do we want a pulse file per instrument or per channel
 SEQFILE_PER_CHANNEL = False
 
+# Whether to roll up repeated blocks of instructions into LOAD/REPEAT loops
+COMPRESS_LOOPS = False
+
+def is_patchable_file(filename):
+    '''
+    Whether an existing file can be updated in place by write_sequence_file,
+    i.e. it is an APS2 sequence file whose datasets are resizable.
+    '''
+    try:
+        with h5py.File(filename, 'r') as FID:
+            target = FID['/'].attrs.get('target hardware')
+            if isinstance(target, str):
+                target = target.encode('utf-8')
+            if target != b'APS2':
+                return False
+            for name in ['chan_1/waveforms', 'chan_2/waveforms', 'chan_1/instructions']:
+                if name in FID and FID[name].maxshape != (None, ):
+                    return False
+    except OSError:
+        return False
+    return True
+
+def write_dataset(FID, name, data):
+    '''
+    Writes the 1D array 'data' to the dataset 'name' of an open h5 file. The
+    dataset is created chunked and resizable so that later writes only
+    rewrite the chunks that changed, e.g. after recalibrating a few pulses.
+    Returns the number of elements written.
+    '''
+    dataset = FID.get(name)
+    if dataset is not None and (dataset.dtype != data.dtype or
+                                dataset.maxshape != (None, )):
+        del FID[name]
+        dataset = None
+    if dataset is None:
+        FID.create_dataset(name, data=data, chunks=True, maxshape=(None, ))
+        return len(data)
+
+    old_length = dataset.shape[0]
+    if old_length != len(data):
+        dataset.resize((len(data), ))
+    written = 0
+    step = dataset.chunks[0]
+    for start in range(0, min(old_length, len(data)), step):
+        stop = min(start + step, old_length, len(data))
+        if not np.array_equal(dataset[start:stop], data[start:stop]):
+            dataset[start:stop] = data[start:stop]
+            written += stop - start
+    if len(data) > old_length:
+        dataset[old_length:] = data[old_length:]
+        written += len(data) - old_length
+    logger.debug("Rewrote %d of %d elements of %s", written, len(data), name)
+    return written
+
 def get_empty_channel_set():
     return {'ch12': {}, 'ch12m1': {}, 'ch12m2': {}, 'ch12m3': {}, 'ch12m4': {}}
 
@@ -145,17 +204,8 @@ def create_wf_vector(wfLib, seqs):
         #if we can fit them all in just pack
         wfVec = np.zeros(max_pts_needed, dtype=np.int16)
         for key, wf in wfLib.items():
-            #Clip the wf
-            wf[wf > 1] = 1.0
-            wf[wf < -1] = -1.0
-            #TA pairs need to be repeated ADDRESS_UNIT times
-            if wf.size == 1:
-                wf = wf.repeat(ADDRESS_UNIT)
-            #Ensure the wf is an integer number of ADDRESS_UNIT's
-            trim = wf.size % ADDRESS_UNIT
-            if trim:
-                wf = wf[:-trim]
-            wfVec[idx:idx + wf.size] = np.int16(MAX_WAVEFORM_VALUE * wf)
+            wf = pack_waveform(wf)
+            wfVec[idx:idx + wf.size] = wf
             offsets[-1][key] = idx
             idx += wf.size
 
@@ -163,49 +213,27 @@ def create_wf_vector(wfLib, seqs):
         wfVec.resize(idx)
 
     else:
-        #otherwise fill in one cache line at a time
-        CACHE_LINE_LENGTH = WAVEFORM_CACHE_SIZE / 2
-        wfVec = np.zeros(CACHE_LINE_LENGTH, dtype=np.int16)
-        offsets = [{}]
+        #otherwise split the sequences over cache lines to be prefetched in turn
+        wf_sizes = {key: packed_waveform_size(wf) for key, wf in wfLib.items()}
+        lines = plan_cache_lines(seqs, wf_sizes)
+        if len(lines) * WAVEFORM_CACHE_LINE_LENGTH > MAX_WAVEFORM_PTS:
+            raise RuntimeError("Waveforms do not fit in the APS2 waveform memory")
+        wfVec = np.zeros(len(lines) * WAVEFORM_CACHE_LINE_LENGTH, dtype=np.int16)
+        offsets = []
         cache_lines = []
-        for seq in seqs:
-            #go through sequence and see what we need to add
-            pts_to_add = 0
-            for entry in seq:
-                if isinstance(entry, Compiler.Waveform):
-                    sig = wf_sig(entry)
-                    if sig not in offsets[-1]:
-                        pts_to_add += entry.length
-
-            #If what we need to add spills over then add a line and start again
-            if (idx % CACHE_LINE_LENGTH) + pts_to_add > CACHE_LINE_LENGTH:
-                idx = int(CACHE_LINE_LENGTH * (
-                    (idx + CACHE_LINE_LENGTH) // CACHE_LINE_LENGTH))
-                wfVec = np.append(wfVec,
-                                  np.zeros(CACHE_LINE_LENGTH,
-                                           dtype=np.int16))
-                offsets.append({})
-
-            for entry in seq:
-                if isinstance(entry, Compiler.Waveform):
-                    sig = wf_sig(entry)
-                    if sig not in offsets[-1]:
-                        wf = wfLib[sig]
-                        wf[wf > 1] = 1.0
-                        wf[wf < -1] = -1.0
-                        #TA pairs need to be repeated ADDRESS_UNIT times
-                        if wf.size == 1:
-                            wf = wf.repeat(ADDRESS_UNIT)
-                        #Ensure the wf is an integer number of ADDRESS_UNIT's
-                        trim = wf.size % ADDRESS_UNIT
-                        if trim:
-                            wf = wf[:-trim]
-                        wfVec[idx:idx + wf.size] = np.int16(
-                            MAX_WAVEFORM_VALUE * wf)
-                        offsets[-1][sig] = idx
-                        idx += wf.size
-
-            cache_lines.append(int(idx // CACHE_LINE_LENGTH))
+        for line, (start, stop) in enumerate(lines):
+            offsets.append({})
+            idx = line * WAVEFORM_CACHE_LINE_LENGTH
+            for seq in seqs[start:stop]:
+                for entry in seq:
+                    if isinstance(entry, Compiler.Waveform):
+                        sig = wf_sig(entry)
+                        if sig not in offsets[-1]:
+                            wf = pack_waveform(wfLib[sig])
+                            wfVec[idx:idx + wf.size] = wf
+                            offsets[-1][sig] = idx
+                            idx += wf.size
+                cache_lines.append(line)
 
     return wfVec, offsets, cache_lines
 
@@ -386,7 +414,156 @@ class Instruction(object):
         return int((self.header << 56) | (self.payload & 0xffffffffffffff))
 
 
-def Waveform(addr, count, isTA, write=False, label=None):
+class InstructionArray(object):
+    '''
+    Columnar instruction vector. The header and payload words of each
+    instruction are stored in preallocated NumPy arrays next to the symbol
+    ids of their labels and targets (-1 for none), so that long programs can
+    be encoded without creating an Instruction object per word. Indexing or
+    iterating yields Instruction objects for inspection.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.header = np.zeros(capacity, dtype=np.uint8)
+        self.payload = np.zeros(capacity, dtype=np.uint64)
+        self.labels = np.full(capacity, -1, dtype=np.int32)
+        self.targets = np.full(capacity, -1, dtype=np.int32)
+        # symbol table shared by labels and targets
+        self.symbols = []
+        self.symbol_ids = {}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError("instruction index out of range")
+        return Instruction(int(self.header[idx]), self.payload[idx],
+                           self.symbol(self.labels[idx]),
+                           self.symbol(self.targets[idx]))
+
+    def __iter__(self):
+        for idx in range(self.size):
+            yield self[idx]
+
+    def symbol(self, symbol_id):
+        return self.symbols[symbol_id] if symbol_id >= 0 else None
+
+    def symbol_id(self, symbol):
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return symbol_id
+
+    def reserve(self, count):
+        capacity = len(self.header)
+        if self.size + count <= capacity:
+            return
+        capacity = max(2 * capacity, self.size + count)
+        for name, fill in [('header', 0), ('payload', 0), ('labels', -1),
+                           ('targets', -1)]:
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append(self, header, payload, label=None, target=None):
+        ct = self.size
+        if ct == len(self.header):
+            self.reserve(1)
+        self.header[ct] = header
+        self.payload[ct] = payload
+        if label:
+            self.labels[ct] = self.symbol_id(label)
+        if target:
+            self.targets[ct] = self.symbol_id(target)
+        self.size = ct + 1
+
+    def append_command(self, cmd, payload, write=False, label=None):
+        '''
+        Columnar version of Command.
+        '''
+        if isinstance(payload, int):
+            self.append((cmd << 4) | (write & 0x1), payload, label)
+        else:
+            self.append((cmd << 4) | (write & 0x1), 0, label, target=payload)
+
+    def append_instruction(self, instr):
+        self.append(instr.header, instr.payload, instr.label, instr.target)
+
+    def extend(self, other, start=0, stop=None):
+        '''
+        Appends the instructions start:stop of another InstructionArray.
+        '''
+        stop = other.size if stop is None else stop
+        count = stop - start
+        self.reserve(count)
+        end = self.size + count
+        self.header[self.size:end] = other.header[start:stop]
+        self.payload[self.size:end] = other.payload[start:stop]
+        if other is self:
+            id_map = np.arange(len(self.symbols), dtype=np.int32)
+        else:
+            id_map = np.array([self.symbol_id(symbol) for symbol in other.symbols],
+                              dtype=np.int32)
+        for name in ['labels', 'targets']:
+            ids = getattr(other, name)[start:stop]
+            getattr(self, name)[self.size:end] = np.where(
+                ids >= 0, id_map[np.maximum(ids, 0)], -1)
+        self.size = end
+
+    def append_repeated(self, header, payload, count):
+        '''
+        Appends 'count' copies of an unlabeled instruction, e.g. padding NoOps.
+        '''
+        self.reserve(count)
+        end = self.size + count
+        self.header[self.size:end] = header
+        self.payload[self.size:end] = payload
+        self.size = end
+
+    @property
+    def opcodes(self):
+        return self.header[:self.size] >> 4
+
+    def resolve_symbols(self):
+        '''
+        Array version of resolve_symbols: fills in the address of the first
+        instruction carrying the label of each target.
+        '''
+        labels = self.labels[:self.size]
+        targets = self.targets[:self.size]
+        # address of the first occurrence of each label
+        addresses = np.full(len(self.symbols) + 1, -1, dtype=np.int64)
+        labeled = np.flatnonzero(labels >= 0)
+        ids, first = np.unique(labels[labeled], return_index=True)
+        addresses[ids] = labeled[first]
+        jumps = np.flatnonzero(targets >= 0)
+        if jumps.size == 0:
+            return
+        jump_addresses = addresses[targets[jumps]]
+        undefined = jump_addresses < 0
+        if np.any(undefined):
+            # as in resolve_symbols, fall back on the next jump that has a
+            # known target
+            defined = np.flatnonzero(~undefined)
+            following = np.searchsorted(defined, np.flatnonzero(undefined))
+            if following.size and following[-1] == defined.size:
+                symbol = self.symbols[targets[jumps[undefined][-1]]]
+                raise KeyError(symbol)
+            jump_addresses[undefined] = jump_addresses[defined[following]]
+        self.payload[jumps] |= (jump_addresses & 0xffffffff).astype(np.uint64)
+
+    def flatten(self):
+        return ((self.header[:self.size].astype(np.uint64) << np.uint64(56)) |
+                (self.payload[:self.size] & np.uint64(0xffffffffffffff)))
+
+
+def waveform_words(addr, count, isTA, write=False):
     header = (WFM << 4) | (0x3 << 2) | (write &
                                         0x1)  #broadcast to both engines
     count = int(count)
@@ -394,7 +571,11 @@ def Waveform(addr, count, isTA, write=False, label=None):
     addr = (addr // ADDRESS_UNIT) & 0x00ffffff  # 24 bit addr
     payload = (PLAY << WFM_OP_OFFSET) | ((int(isTA) & 0x1)
                                          << TA_PAIR_BIT) | (count << 24) | addr
-    return Instruction(header, payload, label)
+    return header, payload
+
+
+def Waveform(addr, count, isTA, write=False, label=None):
+    return Instruction(*waveform_words(addr, count, isTA, write), label=label)
 
 
 def WaveformPrefetch(addr):
@@ -404,6 +585,10 @@ def WaveformPrefetch(addr):
 
 
 def Marker(sel, state, count, write=False, label=None):
+    return Instruction(*marker_words(sel, state, count, write), label=label)
+
+
+def marker_words(sel, state, count, write=False):
     header = (MARKER << 4) | ((sel & 0x3) << 2) | (write & 0x1)
     count = int(count)
     four_count = ((count // ADDRESS_UNIT) - 1) & 0xffffffff  # 32 bit count
@@ -416,7 +601,7 @@ def Marker(sel, state, count, write=False, label=None):
         transition = transitionWords[count_rem]
     payload = (PLAY << WFM_OP_OFFSET) | (transition << 33) | (
         (state & 0x1) << 32) | four_count
-    return Instruction(header, payload, label)
+    return header, payload
 
 
 def Command(cmd, payload, write=False, label=None):
@@ -469,8 +654,11 @@ def Prefetch(addr, label=None):
     return Command(PREFETCH, addr)
 
 
+NOP_HEADER = 0xff
+NOP_PAYLOAD = 0xffffffffffffff
+
 def NoOp():
-    return Instruction.unflatten(0xffffffffffffffff)
+    return Instruction(NOP_HEADER, NOP_PAYLOAD)
 
 # QGL instructions
 def Invalidate(addr, mask, label=None):
@@ -516,6 +704,205 @@ def LoadCmpVram(addr, mask, label=None):
     return Instruction(header, payload, label=label)
 
 
+def packed_waveform_size(wf):
+    '''
+    Number of points pack_waveform stores for a waveform.
+    '''
+    if wf.size == 1:
+        return ADDRESS_UNIT
+    return wf.size - wf.size % ADDRESS_UNIT
+
+
+def plan_cache_lines(seqs, wf_sizes, line_length=None, window=None):
+    '''
+    Splits the sequences into runs that are each played from one waveform
+    cache line, i.e. whose waveforms (keyed by wf_sig, with sizes given by
+    'wf_sizes') fit in 'line_length' points together. Each run costs a
+    WaveformPrefetch and every waveform used in more than one run is stored
+    once per run, so we look for the split with the fewest runs and, among
+    those, the fewest stored points. Runs have to be contiguous as the
+    sequences are played in order.
+
+    The fewest runs are found greedily, by extending each run as far as it
+    fits. The stored points are then minimized by a dynamic program over the
+    ends of the runs, which only tries the last 'window' ends (defaults to
+    CACHE_LINE_PLAN_WINDOW) that keep the fewest runs, so the plan takes
+    linear time.
+
+    Returns a list of (start, stop) sequence index pairs.
+    '''
+    if line_length is None:
+        line_length = WAVEFORM_CACHE_LINE_LENGTH
+    if window is None:
+        window = CACHE_LINE_PLAN_WINDOW
+    # the waveforms are numbered, which makes the bookkeeping of the runs
+    # much cheaper than hashing their signatures
+    numbers = {}
+    sizes = []
+    working_sets = []
+    for ct, seq in enumerate(seqs):
+        working_set = set(wf_sig(entry) for entry in seq
+                          if isinstance(entry, Compiler.Waveform))
+        if sum(wf_sizes[sig] for sig in working_set) > line_length:
+            raise RuntimeError(
+                "Waveforms of sequence {} do not fit in a cache line of {} points".format(
+                    ct, line_length))
+        for sig in working_set:
+            if sig not in numbers:
+                numbers[sig] = len(sizes)
+                sizes.append(wf_sizes[sig])
+        working_sets.append(tuple(numbers[sig] for sig in working_set))
+    num_seqs = len(seqs)
+    run = CacheLineRun(working_sets, sizes)
+
+    # reach[start] = the end of the longest run from start, found with a
+    # sliding window over the sequences
+    reach = [num_seqs] * num_seqs
+    for start in range(num_seqs):
+        while run.stop < num_seqs and run.fits(run.stop, line_length):
+            run.push()
+        reach[start] = run.stop
+        run.pop_front()
+
+    # runs[start] = the fewest runs for sequences start onwards
+    runs = [0] * (num_seqs + 1)
+    for start in reversed(range(num_seqs)):
+        runs[start] = runs[reach[start]] + 1
+
+    # the points sequence ct adds to a run from start are those of its
+    # waveforms not used since start; the waveforms last used at ct before
+    # stop no longer count once start moves back to ct
+    contributions = [sum(sizes[wf] for wf in working_set)
+                     for working_set in working_sets]
+    reused = [[] for _ in range(num_seqs)]
+    last_use = [None] * len(sizes)
+    for ct, working_set in enumerate(working_sets):
+        for wf in working_set:
+            if last_use[wf] is not None:
+                reused[last_use[wf]].append((ct, sizes[wf]))
+            last_use[wf] = ct
+
+    # best[start] = (points, stop) for sequences start onwards; the run
+    # [start, reach[start]) slides back, and shorter runs are derived from it
+    best = [None] * num_seqs + [(0, num_seqs)]
+    run = CacheLineRun(working_sets, sizes, num_seqs)
+    for start in reversed(range(num_seqs)):
+        for ct, size in reused[start]:
+            contributions[ct] -= size
+        run.push_front()
+        while run.stop > reach[start]:
+            run.pop()
+        stop = run.stop
+        points = run.points
+        for _ in range(window):
+            if stop <= start or runs[stop] != runs[start] - 1:
+                break
+            if best[start] is None or points + best[stop][0] <= best[start][0]:
+                best[start] = (points + best[stop][0], stop)
+            stop -= 1
+            points -= contributions[stop]
+
+    lines = []
+    start = 0
+    while start < num_seqs:
+        stop = best[start][1]
+        lines.append((start, stop))
+        start = stop
+    return lines
+
+
+class CacheLineRun(object):
+    '''
+    The waveforms used by a run of sequences [start, stop), counted per
+    sequence so that sequences can be added and removed at either end. The
+    working sets of the sequences hold waveform numbers, indexing 'sizes'.
+    '''
+
+    def __init__(self, working_sets, sizes, start=0):
+        self.working_sets = working_sets
+        self.sizes = sizes
+        self.start = self.stop = start
+        self.counts = [0] * len(sizes)
+        self.points = 0
+
+    def fits(self, ct, line_length):
+        counts, sizes = self.counts, self.sizes
+        new_points = sum(sizes[wf] for wf in self.working_sets[ct] if not counts[wf])
+        return self.points + new_points <= line_length
+
+    def push(self):
+        self._add(self.stop)
+        self.stop += 1
+
+    def push_front(self):
+        self.start -= 1
+        self._add(self.start)
+
+    def pop(self):
+        self.stop -= 1
+        self._remove(self.stop)
+
+    def pop_front(self):
+        self._remove(self.start)
+        self.start += 1
+
+    def _add(self, ct):
+        counts = self.counts
+        for wf in self.working_sets[ct]:
+            if not counts[wf]:
+                self.points += self.sizes[wf]
+            counts[wf] += 1
+
+    def _remove(self, ct):
+        counts = self.counts
+        for wf in self.working_sets[ct]:
+            counts[wf] -= 1
+            if not counts[wf]:
+                self.points -= self.sizes[wf]
+
+
+def prefetch_schedule(wfLib, offsets, cache_lines):
+    '''
+    Describes how create_wf_vector spread the sequences over waveform cache
+    lines: the sequences played from each line (each preceded by a
+    WaveformPrefetch of the next line), the points stored in each and how many
+    points are duplicates of waveforms stored in other lines.
+    '''
+    wf_sizes = {key: packed_waveform_size(wf) for key, wf in wfLib.items()}
+    lines = []
+    for ct, line in enumerate(cache_lines):
+        if not lines or lines[-1]['cache_line'] != line:
+            lines.append({'cache_line': line, 'first_sequence': ct,
+                          'num_sequences': 0,
+                          'points': sum(wf_sizes[sig] for sig in offsets[line])})
+        lines[-1]['num_sequences'] += 1
+    unique_sigs = set()
+    for offset_dict in offsets:
+        unique_sigs |= set(offset_dict)
+    stored_points = sum(line['points'] for line in lines)
+    return {'cache_line_length': WAVEFORM_CACHE_LINE_LENGTH,
+            'num_prefetches': len(lines),
+            'duplicated_points': stored_points - sum(wf_sizes[sig] for sig in unique_sigs),
+            'lines': lines}
+
+
+def pack_waveform(wf):
+    '''
+    Clips a (real) waveform and converts it to DAC samples padded or trimmed
+    to a whole number of ADDRESS_UNIT's.
+    '''
+    wf[wf > 1] = 1.0
+    wf[wf < -1] = -1.0
+    #TA pairs need to be repeated ADDRESS_UNIT times
+    if wf.size == 1:
+        wf = wf.repeat(ADDRESS_UNIT)
+    #Ensure the wf is an integer number of ADDRESS_UNIT's
+    trim = wf.size % ADDRESS_UNIT
+    if trim:
+        wf = wf[:-trim]
+    return np.int16(MAX_WAVEFORM_VALUE * wf)
+
+
 def preprocess(seqs, shapeLib):
     seqs = PatternUtils.convert_lengths_to_samples(
         seqs, SAMPLING_RATE, ADDRESS_UNIT, Compiler.Waveform)
@@ -546,6 +933,18 @@ def wf_sig(wf):
 class ModulationCommand(object):
     """docstring for ModulationCommand"""
 
+    NCO_SELECT_BITS = {1 : 0b0001,
+                       2 : 0b0010,
+                       3 : 0b0100,
+                       4 : 0b1000,
+                       15: 0b1111}
+
+    OP_CODE_MAP = {"MODULATE": 0x0,
+                   "RESET_PHASE": 0x2,
+                   "SET_FREQ": 0x6,
+                   "SET_PHASE": 0xa,
+                   "UPDATE_FRAME": 0xe}
+
     def __init__(self,
                  instruction,
                  nco_select,
@@ -579,23 +978,16 @@ class ModulationCommand(object):
         return str(self)
 
     def to_instruction(self, write_flag=True, label=None):
+        return Instruction(*self.words(write_flag), label=label)
+
+    def words(self, write_flag=True):
         #Modulator op codes
         MODULATOR_OP_OFFSET = 44
         NCO_SELECT_OP_OFFSET = 40
         MODULATION_CLOCK = 300e6
 
-        nco_select_bits = {1 : 0b0001,
-                           2 : 0b0010,
-                           3 : 0b0100,
-                           4 : 0b1000,
-                           15: 0b1111}[self.nco_select]
-
-        op_code_map = {"MODULATE": 0x0,
-                       "RESET_PHASE": 0x2,
-                       "SET_FREQ": 0x6,
-                       "SET_PHASE": 0xa,
-                       "UPDATE_FRAME": 0xe}
-        payload = (op_code_map[self.instruction] << MODULATOR_OP_OFFSET) | (
+        nco_select_bits = self.NCO_SELECT_BITS[self.nco_select]
+        payload = (self.OP_CODE_MAP[self.instruction] << MODULATOR_OP_OFFSET) | (
             (nco_select_bits) << NCO_SELECT_OP_OFFSET)
         if self.instruction == "MODULATE":
             #zero-indexed quad count
@@ -610,9 +1002,7 @@ class ModulationCommand(object):
             #phases can span -0.5 to 0.5 or 0 to 1 in unsigned
             payload |= np.uint32(np.mod(self.phase / (2 * np.pi), 1) * 2**28)
 
-        instr = Instruction(MODULATION << 4, payload, label)
-        instr.writeFlag = write_flag
-        return instr
+        return (MODULATION << 4) | (write_flag & 0x1), payload
 
 def inject_modulation_cmds(seqs):
     """
@@ -748,7 +1138,7 @@ def synchronize_clocks(seqs):
             instr.length = 0
 
 
-def create_seq_instructions(seqs, offsets, label = None):
+def create_seq_instructions(seqs, offsets, label = None, instructions = None):
     '''
     Helper function to create instruction vector from an IR sequence and an offset dictionary
     keyed on the wf keys.
@@ -758,6 +1148,9 @@ def create_seq_instructions(seqs, offsets, label = None):
 
     We take the strategy of greedily grabbing the next instruction that occurs in time, accross
     all    waveform and marker channels.
+
+    The instructions are appended to the InstructionArray 'instructions' (a new
+    one by default), which is returned along with any trailing label.
     '''
 
     # timestamp all entries before filtering (where we lose time information on control flow)
@@ -766,18 +1159,13 @@ def create_seq_instructions(seqs, offsets, label = None):
 
     synchronize_clocks(seqs)
 
-    # create (seq, startTime) pairs over all sequences
-    timeTuples = []
-    for ct, seq in enumerate(seqs):
-        timeTuples += [(entry.startTime, ct) for entry in seq]
-    timeTuples.sort()
-
     # keep track of where we are in each sequence
-    indexes = np.zeros(len(seqs), dtype=np.int64)
+    indexes = [0] * len(seqs)
 
     # always start with SYNC (stealing label from beginning of sequence)
     # unless it is a subroutine (using last entry as return as tell)
-    instructions = []
+    if instructions is None:
+        instructions = InstructionArray()
     for ct, seq in enumerate(seqs):
         if len(seq):
             first_non_empty = ct
@@ -786,22 +1174,27 @@ def create_seq_instructions(seqs, offsets, label = None):
         if isinstance(seqs[first_non_empty][0], BlockLabel.BlockLabel):
             if not label:
                 label = seqs[first_non_empty][0]
-            timeTuples.pop(0)
             indexes[first_non_empty] += 1
-        instructions.append(Sync(label=label))
+        instructions.append_command(SYNC, WAIT_SYNC << WFM_OP_OFFSET, write=True, label=label)
         label = None
 
-    while len(timeTuples) > 0:
+    # each sequence is already ordered in time, so merge the (startTime, seq,
+    # index) triples of all sequences rather than sorting them
+    def time_tuples(ct):
+        seq = seqs[ct]
+        for idx in range(indexes[ct], len(seq)):
+            yield seq[idx].startTime, ct, idx
+    timeTuples = heapq.merge(*[time_tuples(ct) for ct in range(len(seqs))])
+    next_tuple = next(timeTuples, None)
+
+    while next_tuple is not None:
         #pop off all entries that have the same time
         entries = []
-        start_time = 0
-        while True:
-            start_time, seq_idx = timeTuples.pop(0)
-            entries.append((seqs[seq_idx][indexes[seq_idx]], seq_idx))
-            indexes[seq_idx] += 1
-            next_start_time = timeTuples[0][0] if len(timeTuples) > 0 else -1
-            if start_time != next_start_time:
-                break
+        start_time = next_tuple[0]
+        while next_tuple is not None and next_tuple[0] == start_time:
+            _, seq_idx, idx = next_tuple
+            entries.append((seqs[seq_idx][idx], seq_idx))
+            next_tuple = next(timeTuples, None)
 
         write_flags = [True] * len(entries)
         for ct, (entry, seq_idx) in enumerate(entries):
@@ -819,36 +1212,35 @@ def create_seq_instructions(seqs, offsets, label = None):
                     continue
                 # control flow instructions
                 elif isinstance(entry, ControlFlow.Wait):
-                    instructions.append(Wait(label=label))
+                    instructions.append_command(WAIT, WAIT_TRIG << WFM_OP_OFFSET, write=True, label=label)
                 elif isinstance(entry, ControlFlow.LoadCmp):
-                    instructions.append(LoadCmp(label=label))
+                    instructions.append_command(LOADCMP, 0, label=label)
                 elif isinstance(entry, ControlFlow.Sync):
-                    instructions.append(Sync(label=label))
+                    instructions.append_command(SYNC, WAIT_SYNC << WFM_OP_OFFSET, write=True, label=label)
                 elif isinstance(entry, ControlFlow.Return):
-                    instructions.append(Return(label=label))
+                    instructions.append_command(RET, 0, label=label)
                 # target argument commands
                 elif isinstance(entry, ControlFlow.Goto):
-                    instructions.append(Goto(entry.target, label=label))
+                    instructions.append_command(GOTO, entry.target, label=label)
                 elif isinstance(entry, ControlFlow.Call):
-                    instructions.append(Call(entry.target, label=label))
+                    instructions.append_command(CALL, entry.target, label=label)
                 elif isinstance(entry, ControlFlow.Repeat):
-                    instructions.append(Repeat(entry.target, label=label))
+                    instructions.append_command(REPEAT, entry.target, label=label)
                 # value argument commands
                 elif isinstance(entry, ControlFlow.LoadRepeat):
-                    instructions.append(Load(entry.value - 1, label=label))
+                    instructions.append_command(LOAD, entry.value - 1, label=label)
                 elif isinstance(entry, ControlFlow.ComparisonInstruction):
                     # TODO modify Cmp operator to load from specified address
-                    instructions.append(Cmp(CMPTABLE[entry.operator],
-                                            entry.value,
-                                            label=label))
+                    instructions.append_command(CMP, (CMPTABLE[entry.operator] << 8) | (entry.value & 0xff),
+                                                label=label)
                 elif isinstance(entry, TdmInstructions.LoadCmpVramInstruction) and entry.tdm == False:
-                    instructions.append(LoadCmpVram(entry.addr, entry.mask, label=label))
+                    instructions.append_instruction(LoadCmpVram(entry.addr, entry.mask, label=label))
                 # some TDM instructions are ignored by the APS
                 elif isinstance(entry, TdmInstructions.CustomInstruction):
                     pass
                 elif isinstance(entry, TdmInstructions.WriteAddrInstruction):
                     if entry.instruction == 'INVALIDATE' and entry.tdm == False:
-                        instructions.append(Invalidate(entry.addr, entry.value, label=label))
+                        instructions.append_instruction(Invalidate(entry.addr, entry.value, label=label))
 
                 continue
 
@@ -859,14 +1251,14 @@ def create_seq_instructions(seqs, offsets, label = None):
                         warn("Dropping Waveform entry of length %s!" % entry.length)
                         continue
 
-                    instructions.append(Waveform(
+                    instructions.append(*waveform_words(
                             offsets[wf_sig(entry)], entry.length,
                             entry.isTimeAmp or entry.isZero,
-                            write=write_flags[ct], label=label))
+                            write=write_flags[ct]), label=label)
                 elif isinstance(entry, ModulationCommand):
-                    instructions.append(entry.to_instruction(
-                        write_flag=write_flags[ct],
-                        label=label))
+                    instructions.append(*entry.words(
+                        write_flag=write_flags[ct]),
+                        label=label)
 
             else:  # a marker engine
                 if isinstance(entry, Compiler.Waveform):
@@ -875,18 +1267,96 @@ def create_seq_instructions(seqs, offsets, label = None):
                         continue
                     markerSel = seq_idx - 1
                     state = not entry.isZero
-                    instructions.append(Marker(markerSel,
-                                               state,
-                                               entry.length,
-                                               write=write_flags[ct],
-                                               label=label))
+                    instructions.append(*marker_words(markerSel,
+                                                      state,
+                                                      entry.length,
+                                                      write=write_flags[ct]),
+                                        label=label)
 
             #clear label
-            if len(timeTuples)>0:
+            if next_tuple is not None:
                 label = None
 
     return instructions, label
 
+def run_lengths(mask):
+    '''
+    Number of consecutive True entries of 'mask' starting at each index.
+    '''
+    breaks = np.append(np.flatnonzero(~mask), len(mask))
+    idx = np.arange(len(mask))
+    return breaks[np.searchsorted(breaks, idx)] - idx
+
+def compress_loops(instructions, seq_starts, max_length=None):
+    '''
+    Rolls up consecutive copies of a block of waveform, marker and modulation
+    instructions into a LOAD/REPEAT loop. Blocks must be unlabeled except for
+    their first instruction and are at most 'max_length' instructions long,
+    so that the REPEAT jumps back less than one instruction cache line.
+
+    The APS2 has a single repeat counter, so sequences that already contain
+    loops are left alone, as are subroutines which may be called from within
+    a loop. 'seq_starts' are the indices at which the sequences begin and
+    end. Returns the new InstructionArray and sequence starts.
+    '''
+    if max_length is None:
+        max_length = INSTRUCTION_CACHE_LINE_LENGTH - 2
+    num_instrs = len(instructions)
+    opcodes = instructions.opcodes
+    labels = instructions.labels[:num_instrs]
+    words = instructions.flatten()
+    wf_ops = (instructions.payload[:num_instrs] >> np.uint64(WFM_OP_OFFSET)) & np.uint64(0x3)
+    eligible = (opcodes == MODULATION) | (
+        ((opcodes == WFM) | (opcodes == MARKER)) & (wf_ops == PLAY))
+    starts = np.array(seq_starts)
+    seq_ids = np.repeat(np.arange(len(starts) - 1), np.diff(starts))
+    skip_seqs = np.zeros(len(starts) - 1, dtype=bool)
+    skip_seqs[seq_ids[np.isin(opcodes, [LOAD, REPEAT, RET])]] = True
+    eligible &= ~skip_seqs[seq_ids]
+    # instructions that can be inside a block or start a later copy
+    clean = eligible & (labels < 0)
+    clean[starts[starts < num_instrs]] = False
+    num_dirty = np.concatenate(([0], np.cumsum(~clean)))
+
+    # best savings in instructions, block length and copies for each start
+    savings = np.zeros(num_instrs, dtype=np.int64)
+    lengths = np.zeros(num_instrs, dtype=np.int64)
+    num_copies = np.zeros(num_instrs, dtype=np.int64)
+    for length in range(1, min(max_length, num_instrs // 2) + 1):
+        stop = num_instrs - length
+        matches = eligible[:stop] & clean[length:] & (words[:stop] == words[length:])
+        copies = np.minimum(1 + run_lengths(matches) // length,
+                            MAX_REPEAT_COUNT + 1)
+        saved = length * (copies - 1) - 2
+        saved[num_dirty[length:stop + length] != num_dirty[1:stop + 1]] = 0
+        better = saved > savings[:stop]
+        savings[:stop][better] = saved[better]
+        lengths[:stop][better] = length
+        num_copies[:stop][better] = copies[better]
+
+    compressed = InstructionArray(num_instrs)
+    new_index = np.zeros(num_instrs + 1, dtype=np.int64)
+    cursor = 0
+    for start in np.flatnonzero(savings > 0):
+        if start < cursor:
+            continue
+        length = int(lengths[start])
+        copies = int(num_copies[start])
+        new_index[cursor:start] = np.arange(cursor, start) - cursor + len(compressed)
+        compressed.extend(instructions, cursor, start)
+        new_index[start] = len(compressed)
+        loop_label = BlockLabel.newlabel()
+        compressed.append_command(LOAD, copies - 1,
+                                  label=instructions.symbol(labels[start]))
+        body_start = len(compressed)
+        compressed.extend(instructions, start, start + length)
+        compressed.labels[body_start] = compressed.symbol_id(loop_label)
+        compressed.append_command(REPEAT, loop_label)
+        cursor = start + copies * length
+    new_index[cursor:] = np.arange(cursor, num_instrs + 1) - cursor + len(compressed)
+    compressed.extend(instructions, cursor)
+    return compressed, new_index[starts].tolist()
+
 def create_instr_data(seqs, offsets, cache_lines):
     '''
     Constructs the complete instruction data vector, and does basic checks for validity.
@@ -896,73 +1366,84 @@ def create_instr_data(seqs, offsets, cache_lines):
     logger = logging.getLogger(__name__)
     logger.debug('')
 
-    seq_instrs = []
+    # all sequences go into one columnar vector; remember where each starts
+    seq_instrs = InstructionArray()
+    seq_starts = []
     need_prefetch = len(cache_lines) > 0
     num_cache_lines = len(set(cache_lines))
     cache_line_changes = np.concatenate(
         ([0], np.where(np.diff(cache_lines))[0] + 1))
     label = None
     for ct, seq in enumerate(zip_longest(*seqs, fillvalue=[])):
-        new_instrs, label = create_seq_instructions(list(seq), offsets[cache_lines[ct]]
-         if need_prefetch else offsets[0], label = label)
-        seq_instrs.append(new_instrs)
+        seq_starts.append(len(seq_instrs))
         #if we need wf prefetching and have moved waveform cache lines then inject prefetch for the next line
-        if need_prefetch and (ct in cache_line_changes):
+        inject_prefetch = need_prefetch and (ct in cache_line_changes)
+        if inject_prefetch:
             next_cache_line = cache_lines[cache_line_changes[(np.where(
                 ct == cache_line_changes)[0][0] + 1) % len(
                     cache_line_changes)]]
-            seq_instrs[-1].insert(0, WaveformPrefetch(int(
-                next_cache_line * WAVEFORM_CACHE_SIZE / 2)))
-            #steal label if necessary
-            if not seq_instrs[-1][0].label:
-                seq_instrs[-1][0].label = seq_instrs[-1][1].label
-                seq_instrs[-1][1].label = None
-    #concatenate instructions
-    instructions = []
+            seq_instrs.append((WFM << 4) | (0x3 << 2) | 0x1,
+                              (WFM_PREFETCH << WFM_OP_OFFSET) |
+                              int(next_cache_line * WAVEFORM_CACHE_LINE_LENGTH))
+        _, label = create_seq_instructions(list(seq), offsets[cache_lines[ct]]
+         if need_prefetch else offsets[0], label = label, instructions = seq_instrs)
+        #steal label if necessary
+        if inject_prefetch:
+            idx = seq_starts[-1]
+            seq_instrs.labels[idx] = seq_instrs.labels[idx + 1]
+            seq_instrs.labels[idx + 1] = -1
+    seq_starts.append(len(seq_instrs))
+    if COMPRESS_LOOPS:
+        seq_instrs, seq_starts = compress_loops(seq_instrs, seq_starts)
+    opcodes = seq_instrs.opcodes
+
+    #Use last instruction being return as mark of start of subroutines
     subroutines_start = -1
-    for ct, seq in enumerate(seq_instrs):
-        #Use last instruction being return as mark of start of subroutines
-        try:
-            if (seq[-1].header >> 4) == RET:
-                subroutines_start = ct
-                break
-        except:
-            pass
-        instructions += seq
+    for ct, (start, stop) in enumerate(zip(seq_starts[:-1], seq_starts[1:])):
+        if stop > start and opcodes[stop - 1] == RET:
+            subroutines_start = ct
+            break
 
     #if we have any subroutines then group in cache lines
-    if subroutines_start >= 0:
-        subroutine_instrs = []
+    if subroutines_start < 0:
+        instructions = seq_instrs
+    else:
+        main_stop = seq_starts[subroutines_start]
+        subroutine_instrs = InstructionArray()
         subroutine_cache_line = {}
-        CACHE_LINE_LENGTH = 128
+        CACHE_LINE_LENGTH = INSTRUCTION_CACHE_LINE_LENGTH
         offset = 0
-        for sub in seq_instrs[subroutines_start:]:
+        for start, stop in zip(seq_starts[subroutines_start:-1],
+                               seq_starts[subroutines_start + 1:]):
+            sub_length = stop - start
             #TODO for now we don't properly handle prefetching mulitple cache lines
-            if len(sub) > CACHE_LINE_LENGTH:
-                warnings.warn(
-                    "Subroutines longer than {} instructions may not be prefetched correctly")
+            if sub_length > CACHE_LINE_LENGTH:
+                warn("Subroutines longer than {} instructions may not be prefetched correctly".format(
+                    CACHE_LINE_LENGTH))
             #Don't unecessarily split across a cache line
-            if (len(sub) + offset > CACHE_LINE_LENGTH) and (
-                    len(sub) < CACHE_LINE_LENGTH):
+            if (sub_length + offset > CACHE_LINE_LENGTH) and (
+                    sub_length < CACHE_LINE_LENGTH):
                 pad_instrs = 128 - ((offset + 128) % 128)
-                subroutine_instrs += [NoOp()] * pad_instrs
+                subroutine_instrs.append_repeated(NOP_HEADER, NOP_PAYLOAD, pad_instrs)
                 offset = 0
+            sub_label = seq_instrs.symbol(seq_instrs.labels[start])
             if offset == 0:
-                line_label = sub[0].label
-            subroutine_cache_line[sub[0].label] = line_label
-            subroutine_instrs += sub
-            offset += len(sub) % CACHE_LINE_LENGTH
+                line_label = sub_label
+            subroutine_cache_line[sub_label] = line_label
+            subroutine_instrs.extend(seq_instrs, start, stop)
+            offset += sub_length % CACHE_LINE_LENGTH
         logger.debug("Placed {} subroutines into {} cache lines".format(
-            len(seq_instrs[subroutines_start:]), len(subroutine_instrs) //
+            len(seq_starts) - 1 - subroutines_start, len(subroutine_instrs) //
             CACHE_LINE_LENGTH))
         #inject prefetch commands before waits
-        wait_idx = [idx for idx, instr in enumerate(instructions)
-                    if (instr.header >> 4) == WAIT] + [len(instructions)]
-        instructions_with_prefetch = instructions[:wait_idx[0]]
+        wait_idx = list(np.flatnonzero(opcodes[:main_stop] == WAIT)) + [main_stop]
+        calls = np.flatnonzero(opcodes[:main_stop] == CALL)
+        instructions = InstructionArray(main_stop + 8 * len(wait_idx))
+        instructions.extend(seq_instrs, 0, wait_idx[0])
         last_prefetch = None
         for start, stop in zip(wait_idx[:-1], wait_idx[1:]):
-            call_targets = [instr.target for instr in instructions[start:stop]
-                            if (instr.header >> 4) == CALL]
+            call_targets = [seq_instrs.symbol(seq_instrs.targets[idx]) for idx in
+                            calls[np.searchsorted(calls, start):np.searchsorted(calls, stop)]]
             needed_lines = set()
             for target in call_targets:
                 needed_lines.add(subroutine_cache_line[target])
@@ -971,25 +1452,23 @@ def create_instr_data(seqs, offsets, cache_lines):
                     "Unable to prefetch more than 8 cache lines")
             for needed_line in needed_lines:
                 if needed_line != last_prefetch:
-                    instructions_with_prefetch.append(Prefetch(needed_line))
+                    instructions.append_command(PREFETCH, needed_line)
                     last_prefetch = needed_line
-            instructions_with_prefetch += instructions[start:stop]
+            instructions.extend(seq_instrs, start, stop)
 
-        instructions = instructions_with_prefetch
         #pad out instruction vector to ensure circular cache never loads a subroutine
         pad_instrs = 7 * 128 + (128 - ((len(instructions) + 128) % 128))
-        instructions += [NoOp()] * pad_instrs
+        instructions.append_repeated(NOP_HEADER, NOP_PAYLOAD, pad_instrs)
 
-        instructions += subroutine_instrs
+        instructions.extend(subroutine_instrs)
 
     #turn symbols into integers addresses
-    resolve_symbols(instructions)
+    instructions.resolve_symbols()
 
     assert len(instructions) < MAX_NUM_INSTRUCTIONS, \
     'Oops! too many instructions: {0}'.format(len(instructions))
 
-    return np.fromiter((instr.flatten() for instr in instructions), np.uint64,
-                       len(instructions))
+    return instructions.flatten()
 
 
 def resolve_symbols(seq):
@@ -1026,9 +1505,11 @@ def compress_marker(markerLL):
                 idx += 1
 
 
-def write_sequence_file(awgData, fileName):
+def build_sequence(awgData):
     '''
-    Main function to pack channel sequences into an APS2 h5 file.
+    Converts the channel sequences of an APS2 into its waveform and
+    instruction vectors. Returns the waveform library, the waveform info of
+    the two channels (see create_wf_vector) and the instructions.
     '''
     # Convert QGL IR into a representation that is closer to the hardware.
     awgData['ch12']['linkList'], wfLib = preprocess(
@@ -1053,6 +1534,61 @@ def write_sequence_file(awgData, fileName):
                                     for key, wf in wfLib.items()}, awgData[
                                         'ch12']['linkList']))
 
+    # build instruction vector
+    seq_data = [awgData[s]['linkList']
+                for s in ['ch12', 'ch12m1', 'ch12m2', 'ch12m3', 'ch12m4']]
+    instructions = create_instr_data(seq_data, wfInfo[0][1], wfInfo[0][2])
+    return wfLib, wfInfo, instructions
+
+
+def sequence_datasets(wfInfo, instructions):
+    '''
+    The arrays of an APS2 sequence file keyed by their dataset names. The
+    arrays are not copied.
+    '''
+    datasets = OrderedDict()
+    for chanct in range(2):
+        chanStr = '/chan_{0}'.format(chanct + 1)
+        if wfInfo[chanct][0].size == 0:
+            #If there are no waveforms, ensure that there is some element
+            #so that the waveform group gets written to file.
+            #TODO: Fix this in libaps2
+            datasets[chanStr + '/waveforms'] = np.array([0], dtype=np.uint16)
+        else:
+            datasets[chanStr + '/waveforms'] = wfInfo[chanct][0]
+        #Write the instructions to channel 1
+        if np.mod(chanct, 2) == 0:
+            datasets[chanStr + '/instructions'] = instructions
+    return datasets
+
+
+def sequence_meta(wfLib, wfInfo):
+    '''
+    The metadata returned along with the sequence data, i.e. how the
+    waveforms are prefetched if they do not fit in the waveform cache.
+    '''
+    if wfInfo[0][2]:
+        return {'waveform_prefetch': prefetch_schedule(wfLib, wfInfo[0][1],
+                                                       wfInfo[0][2])}
+    return None
+
+
+def sequence_buffers(awgData):
+    '''
+    In-memory counterpart of write_sequence_file. Returns the arrays that
+    would be written to the sequence file keyed by their dataset names (e.g.
+    '/chan_1/instructions') and the metadata.
+    '''
+    wfLib, wfInfo, instructions = build_sequence(awgData)
+    return sequence_datasets(wfInfo, instructions), sequence_meta(wfLib, wfInfo)
+
+
+def write_sequence_file(awgData, fileName):
+    '''
+    Main function to pack channel sequences into an APS2 h5 file.
+    '''
+    wfLib, wfInfo, instructions = build_sequence(awgData)
+
     if SAVE_WF_OFFSETS:
         #create a set of all waveform signatures in offset dictionaries
         #we could have multiple offsets for the same pulse becuase it could
@@ -1084,38 +1620,195 @@ def write_sequence_file(awgData, fileName):
         with open(os.path.splitext(fileName)[0] + ".offsets", "wb") as FID:
             pickle.dump(offsets, FID)
 
-    # build instruction vector
-    seq_data = [awgData[s]['linkList']
-                for s in ['ch12', 'ch12m1', 'ch12m2', 'ch12m3', 'ch12m4']]
-    instructions = create_instr_data(seq_data, wfInfo[0][1], wfInfo[0][2])
-
-    #Open the HDF5 file
-    if os.path.isfile(fileName):
+    #Open the HDF5 file, patching a previous version in place
+    if os.path.isfile(fileName) and not is_patchable_file(fileName):
         os.remove(fileName)
-    with h5py.File(fileName, 'w') as FID:
+    with h5py.File(fileName, 'a') as FID:
         FID['/'].attrs['Version'] = 4.0
         FID['/'].attrs['target hardware'] = 'APS2'
         FID['/'].attrs['minimum firmware version'] = 4.0
         FID['/'].attrs['channelDataFor'] = np.uint16([1, 2])
 
         #Create the groups and datasets
+        for name, data in sequence_datasets(wfInfo, instructions).items():
+            FID.require_group(os.path.dirname(name))
+            write_dataset(FID, name, data)
+
+    # report how the waveforms are prefetched
+    meta = sequence_meta(wfLib, wfInfo)
+    if meta:
+        schedule = meta['waveform_prefetch']
+        logger.info("Waveforms of %s are prefetched into %d cache lines "
+                    "(%d duplicated points)", fileName,
+                    schedule['num_prefetches'], schedule['duplicated_points'])
+    return meta
+
+
+class SequenceFileWriter(object):
+    '''
+    Writes an APS2 h5 file incrementally from successive chunks of sequences,
+    as produced by Compiler.compile_to_hardware_streaming. Waveforms and
+    instructions are appended to resizable datasets so that only the current
+    chunk has to be held in memory.
+
+    All waveforms have to fit in the waveform cache, as prefetching needs the
+    complete waveform library up front. Forward references to labels are
+    patched when the writer is closed.
+    '''
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.FID = None
+        self.label = None
+        self.symbols = {}
+        self.pending = []
+        self.offsets = {}
+        self.wf_offsets = {}
+        self.wf_pts = 0
+        self.num_instructions = 0
+
+    def __enter__(self):
+        if os.path.isfile(self.fileName):
+            os.remove(self.fileName)
+        self.FID = h5py.File(self.fileName, 'w')
+        for chanct in range(2):
+            self.FID.create_dataset('/chan_{0}/waveforms'.format(chanct + 1),
+                                    (0, ), dtype=np.int16, maxshape=(None, ))
+        self.FID.create_dataset('/chan_1/instructions', (0, ),
+                                dtype=np.uint64, maxshape=(None, ))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.FID:
+            self.FID.close()
+            self.FID = None
+
+    def append(self, awgData):
+        '''
+        Packs the next chunk of channel sequences into the file.
+        '''
+        linkList, wfLib = preprocess(awgData['ch12']['linkList'],
+                                     awgData['ch12']['wfLib'])
+        seq_data = [linkList]
+        for field in ['ch12m1', 'ch12m2', 'ch12m3', 'ch12m4']:
+            markerLL = awgData[field].get('linkList', [])
+            PatternUtils.convert_lengths_to_samples(markerLL, SAMPLING_RATE,
+                                                    1, Compiler.Waveform)
+            compress_marker(markerLL)
+            seq_data.append(markerLL)
+
+        self.add_waveforms(wfLib, linkList)
+
+        instructions = InstructionArray()
+        seq_starts = []
+        for seq in zip_longest(*seq_data, fillvalue=[]):
+            seq_starts.append(len(instructions))
+            _, self.label = create_seq_instructions(
+                list(seq), self.offsets, label=self.label,
+                instructions=instructions)
+            # no way to prefetch subroutines that are not known yet
+            if len(instructions) and instructions.opcodes[-1] == RET:
+                raise NotImplementedError(
+                    "Subroutines cannot be written incrementally")
+        if COMPRESS_LOOPS:
+            instructions, _ = compress_loops(
+                instructions, seq_starts + [len(instructions)])
+
+        # resolve the symbols we know about and keep the rest for later
+        labels = instructions.labels[:len(instructions)]
+        for ct in np.flatnonzero(labels >= 0):
+            label = instructions.symbol(labels[ct])
+            if label not in self.symbols:
+                self.symbols[label] = self.num_instructions + int(ct)
+        targets = instructions.targets[:len(instructions)]
+        for ct in np.flatnonzero(targets >= 0):
+            target = instructions.symbol(targets[ct])
+            if target in self.symbols:
+                instructions.payload[ct] |= np.uint64(self.symbols[target])
+            else:
+                self.pending.append((self.num_instructions + int(ct), target))
+
+        self.num_instructions += len(instructions)
+        assert self.num_instructions < MAX_NUM_INSTRUCTIONS, \
+        'Oops! too many instructions: {0}'.format(self.num_instructions)
+        self.extend('/chan_1/instructions', instructions.flatten())
+
+    def add_waveforms(self, wfLib, seqs):
+        '''
+        Appends the waveforms not seen in previous chunks to the waveform
+        memory.
+        '''
+        new_sigs = [sig for sig in wfLib.keys() if sig not in self.offsets]
+        for sig in new_sigs:
+            wf = wfLib[sig]
+            self.wf_pts += ADDRESS_UNIT if len(wf) == 1 else len(wf)
+        if self.wf_pts > WAVEFORM_CACHE_SIZE:
+            raise RuntimeError(
+                "Waveforms exceed the APS2 waveform cache, which is not "
+                "supported when writing sequence files incrementally")
+
+        wfVecs = [[], []]
+        idx = self.FID['/chan_1/waveforms'].shape[0]
+        for sig in new_sigs:
+            wfVecs[0].append(pack_waveform(wfLib[sig].real))
+            wfVecs[1].append(pack_waveform(wfLib[sig].imag))
+            self.offsets[sig] = idx
+            idx += wfVecs[0][-1].size
+        for chanct in range(2):
+            if wfVecs[chanct]:
+                self.extend('/chan_{0}/waveforms'.format(chanct + 1),
+                            np.concatenate(wfVecs[chanct]))
+
+        if SAVE_WF_OFFSETS and new_sigs:
+            new_sigs = set(new_sigs)
+            for entry in flatten(seqs):
+                if len(new_sigs) == 0:
+                    break
+                if isinstance(entry, Compiler.Waveform):
+                    sig = wf_sig(entry)
+                    if sig in new_sigs:
+                        #time ampltidue entries are clamped to ADDRESS_UNIT
+                        wf_length = ADDRESS_UNIT if entry.isTimeAmp else entry.length
+                        self.wf_offsets[entry.label] = ([self.offsets[sig]],
+                                                        wf_length)
+                        new_sigs.discard(sig)
+
+    def extend(self, name, data):
+        dataset = self.FID[name]
+        start = dataset.shape[0]
+        dataset.resize((start + data.size, ))
+        dataset[start:] = data
+
+    def close(self):
+        '''
+        Patches the remaining forward references and finalizes the file.
+        '''
+        instructions = self.FID['/chan_1/instructions']
+        for ct, target in self.pending:
+            if target not in self.symbols:
+                raise KeyError("Undefined label {0}".format(target))
+            instructions[ct] = instructions[ct] | np.uint64(self.symbols[target])
+        self.pending = []
+
+        if SAVE_WF_OFFSETS:
+            with open(os.path.splitext(self.fileName)[0] + ".offsets",
+                      "wb") as FID:
+                pickle.dump(self.wf_offsets, FID)
+
+        self.FID['/'].attrs['Version'] = 4.0
+        self.FID['/'].attrs['target hardware'] = 'APS2'
+        self.FID['/'].attrs['minimum firmware version'] = 4.0
+        self.FID['/'].attrs['channelDataFor'] = np.uint16([1, 2])
         for chanct in range(2):
-            chanStr = '/chan_{0}'.format(chanct + 1)
-            chanGroup = FID.create_group(chanStr)
-            #Write the waveformLib to file
-            if wfInfo[chanct][0].size == 0:
+            name = '/chan_{0}/waveforms'.format(chanct + 1)
+            if self.FID[name].shape[0] == 0:
                 #If there are no waveforms, ensure that there is some element
                 #so that the waveform group gets written to file.
-                #TODO: Fix this in libaps2
-                data = np.array([0], dtype=np.uint16)
-            else:
-                data = wfInfo[chanct][0]
-            FID.create_dataset(chanStr + '/waveforms', data=data)
-
-            #Write the instructions to channel 1
-            if np.mod(chanct, 2) == 0:
-                FID.create_dataset(chanStr + '/instructions',
-                                   data=instructions)
+                del self.FID[name]
+                self.FID.create_dataset(name, data=np.array([0],
+                                                            dtype=np.uint16))
+        self.FID.close()
+        self.FID = None
 
 
 def read_sequence_file(fileName):
@@ -1124,158 +1817,173 @@ def read_sequence_file(fileName):
     Dictionary keys are channel strings such as ch1, ch12m1
     Lists are or tuples of time-amplitude pairs (time, output)
     """
-    chanStrs = ['ch1', 'ch2', 'ch12m1', 'ch12m2', 'ch12m3', 'ch12m4',
-                'mod_phase']
-    seqs = {ch: [] for ch in chanStrs}
-
-    def start_new_seq():
-        for ct, ch in enumerate(chanStrs):
-            if (ct < 2) or (ct == 6):
-                #analog or modulation channel
-                seqs[ch].append([])
-            else:
-                #marker channel
-                seqs[ch].append([])
-
     with h5py.File(fileName, 'r') as FID:
         file_version = FID["/"].attrs["Version"]
         wf_lib = {}
         wf_lib['ch1'] = (
             1.0 /
-            MAX_WAVEFORM_VALUE) * FID['/chan_1/waveforms'].value.flatten()
+            MAX_WAVEFORM_VALUE) * FID['/chan_1/waveforms'][()].flatten()
         wf_lib['ch2'] = (
             1.0 /
-            MAX_WAVEFORM_VALUE) * FID['/chan_2/waveforms'].value.flatten()
-        instructions = FID['/chan_1/instructions'].value.flatten()
-        freq = np.zeros(NUM_NCO)  #radians per timestep
-        phase = np.zeros(NUM_NCO)
-        frame = np.zeros(NUM_NCO)
-        next_freq = np.zeros(NUM_NCO)
-        next_phase = np.zeros(NUM_NCO)
-        next_frame = np.zeros(NUM_NCO)
-        accumulated_phase = np.zeros(NUM_NCO)
-        reset_flag = [False]*NUM_NCO
-
-        for data in instructions:
-            instr = Instruction.unflatten(data)
-
-            modulator_opcode = instr.payload >> 44
-
-            #update phases at these boundaries
-            if (instr.opcode == WAIT) | (instr.opcode == SYNC) | (
-                (instr.opcode) == MODULATION and (modulator_opcode == 0x0)):
-                for ct in range(NUM_NCO):
-                    if reset_flag[ct]:
-                        #would expect this to be zero but this is first non-zero point
-                        accumulated_phase[ct] = next_freq[ct] * ADDRESS_UNIT
-                        reset_flag[ct] = False
-                freq[:] = next_freq[:]
-                phase[:] = next_phase[:]
-                frame[:] = next_frame[:]
-
-            #Assume new sequence at every WAIT
-            if instr.opcode == WAIT:
-                start_new_seq()
-
-            elif instr.opcode == WFM and ((
-                (instr.payload >> WFM_OP_OFFSET) & 0x3) == PLAY):
-                addr = (instr.payload & 0x00ffffff) * ADDRESS_UNIT
-                count = (instr.payload >> 24) & 0xfffff
-                count = (count + 1) * ADDRESS_UNIT
-                isTA = (instr.payload >> 45) & 0x1
-                chan_select_bits = ((instr.header >> 2) & 0x1,
-                                    (instr.header >> 3) & 0x1)
-                #On older firmware we broadcast by default whereas on newer we respect the engine select
-                for chan, select_bit in zip(('ch1', 'ch2'), chan_select_bits):
-                    if (file_version < 4) or select_bit:
-                        if isTA:
-                            seqs[chan][-1].append((count, wf_lib[chan][addr]))
-                        else:
-                            for sample in wf_lib[chan][addr:addr + count]:
-                                seqs[chan][-1].append((1, sample))
-
-            elif instr.opcode == MARKER:
-                chan = 'ch12m' + str(((instr.header >> 2) & 0x3) + 1)
-                count = instr.payload & 0xffffffff
-                count = (count + 1) * ADDRESS_UNIT
-                state = (instr.payload >> 32) & 0x1
-                seqs[chan][-1].append((count, state))
-
-            elif instr.opcode == MODULATION:
-                # modulator_op_code_map = {"MODULATE":0x0, "RESET_PHASE":0x2, "SET_FREQ":0x6, "SET_PHASE":0xa, "UPDATE_FRAME":0xe}
-                nco_select_bits = (instr.payload >> 40) & 0xf
-                if modulator_opcode == 0x0:
-                    #modulate
-                    count = ((instr.payload & 0xffffffff) + 1) * ADDRESS_UNIT
-                    nco_select = {0b0001: 0,
-                                  0b0010: 1,
-                                  0b0100: 2,
-                                  0b1000: 3}[nco_select_bits]
-                    seqs['mod_phase'][-1] = np.append(
-                        seqs['mod_phase'][-1], freq[nco_select] *
-                        np.arange(count) + accumulated_phase[nco_select] +
-                        phase[nco_select] + frame[nco_select])
-                    accumulated_phase += count * freq
-                else:
-                    phase_rad = 2 * np.pi * (instr.payload &
-                                             0xffffffff) / 2**28
-                    for ct in range(NUM_NCO):
-                        if (nco_select_bits >> ct) & 0x1:
-                            if modulator_opcode == 0x2:
-                                #reset
-                                next_phase[ct] = 0
-                                next_frame[ct] = 0
-                                reset_flag[ct] = True
-                            elif modulator_opcode == 0x6:
-                                #set frequency
-                                next_freq[ct] = phase_rad / ADDRESS_UNIT
-                            elif modulator_opcode == 0xa:
-                                #set phase
-                                next_phase[ct] = phase_rad
-                            elif modulator_opcode == 0xe:
-                                #update frame
-                                next_frame[ct] += phase_rad
-
-        #Apply modulation if we have any
-        for ct, (
-                ch1, ch2, mod_phase
-        ) in enumerate(zip(seqs['ch1'], seqs['ch2'], seqs['mod_phase'])):
-            if len(mod_phase):
-                #only really works if ch1, ch2 are broadcast together
-                mod_ch1 = []
-                mod_ch2 = []
-                cum_time = 0
-                for ((time_ch1, amp_ch1),
-                     (time_ch2, amp_ch2)) in zip(ch1, ch2):
-                    if (amp_ch1 != 0) or (amp_ch2 != 0):
-                        assert time_ch1 == time_ch2
-                        if time_ch1 == 1:
-                            #single timestep
-                            modulated = np.exp(1j * mod_phase[cum_time]) * (
-                                amp_ch1 + 1j * amp_ch2)
-                            mod_ch1.append((1, modulated.real))
-                            mod_ch2.append((1, modulated.imag))
-                        else:
-                            #expand TA
-                            modulated = np.exp(
-                                1j *
-                                mod_phase[cum_time:cum_time + time_ch1]) * (
-                                    amp_ch1 + 1j * amp_ch2)
-                            for val in modulated:
-                                mod_ch1.append((1, val.real))
-                                mod_ch2.append((1, val.imag))
-                    else:
-                        mod_ch1.append((time_ch1, amp_ch1))
-                        mod_ch2.append((time_ch2, amp_ch2))
-
-                    cum_time += time_ch1
-                seqs['ch1'][ct] = mod_ch1
-                seqs['ch2'][ct] = mod_ch2
-
-        del seqs['mod_phase']
+            MAX_WAVEFORM_VALUE) * FID['/chan_2/waveforms'][()].flatten()
+        instructions = FID['/chan_1/instructions'][()].flatten()
+
+    # decode all the instructions at once
+    instructions = instructions.astype(np.uint64)
+    header = (instructions >> np.uint64(56)).astype(np.int64)
+    payload = instructions & np.uint64(0xffffffffffffff)
+    opcodes = header >> 4
+    # assume new sequence at every WAIT; drop anything before the first one
+    seq_ids = np.cumsum(opcodes == WAIT) - 1
+    num_seqs = int(seq_ids[-1]) + 1 if len(seq_ids) else 0
+
+    def split_seqs(mask, *columns):
+        ids = seq_ids[mask]
+        bounds = np.searchsorted(ids, np.arange(num_seqs + 1))
+        return [[column[start:stop] for column in columns]
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    seqs = {}
+    # markers
+    is_marker = (opcodes == MARKER) & (seq_ids >= 0)
+    marker_sel = (header >> 2) & 0x3
+    counts = ((payload & np.uint64(0xffffffff)).astype(np.int64) + 1) * ADDRESS_UNIT
+    states = ((payload >> np.uint64(32)) & np.uint64(0x1)).astype(np.int64)
+    for sel in range(4):
+        mask = is_marker & (marker_sel == sel)
+        seqs['ch12m' + str(sel + 1)] = [
+            list(zip(count.tolist(), state.tolist())) for count, state in
+            split_seqs(mask, counts[mask], states[mask])]
+
+    # waveforms, with TA pairs as one entry and the others sample by sample
+    is_play = ((opcodes == WFM) & (seq_ids >= 0) &
+               (((payload >> np.uint64(WFM_OP_OFFSET)) & np.uint64(0x3)) == PLAY))
+    addrs = (payload & np.uint64(0x00ffffff)).astype(np.int64) * ADDRESS_UNIT
+    counts = (((payload >> np.uint64(24)) & np.uint64(0xfffff)).astype(np.int64) + 1) * ADDRESS_UNIT
+    is_ta = ((payload >> np.uint64(45)) & np.uint64(0x1)).astype(bool)
+    analog = {}
+    for chan, select_bit in [('ch1', 2), ('ch2', 3)]:
+        #On older firmware we broadcast by default whereas on newer we respect the engine select
+        mask = is_play
+        if file_version >= 4:
+            mask = mask & (((header >> select_bit) & 0x1) == 1)
+        num_points = np.where(is_ta[mask], 1, counts[mask])
+        offsets = np.arange(num_points.sum()) - np.repeat(
+            np.cumsum(num_points) - num_points, num_points)
+        times = np.repeat(np.where(is_ta[mask], counts[mask], 1), num_points)
+        amps = wf_lib[chan][np.repeat(addrs[mask], num_points) + offsets]
+        ids = np.repeat(seq_ids[mask], num_points)
+        bounds = np.searchsorted(ids, np.arange(num_seqs + 1))
+        analog[chan] = [(times[start:stop], amps[start:stop])
+                        for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    # replay the NCOs over the modulation and synchronization events only
+    mod_phase = [[] for _ in range(num_seqs)]
+    freq = np.zeros(NUM_NCO)  #radians per timestep
+    phase = np.zeros(NUM_NCO)
+    frame = np.zeros(NUM_NCO)
+    next_freq = np.zeros(NUM_NCO)
+    next_phase = np.zeros(NUM_NCO)
+    next_frame = np.zeros(NUM_NCO)
+    accumulated_phase = np.zeros(NUM_NCO)
+    reset_flag = [False]*NUM_NCO
+    modulator_opcodes = (payload >> np.uint64(44)).astype(np.int64)
+    events = np.flatnonzero((opcodes == WAIT) | (opcodes == SYNC) |
+                            (opcodes == MODULATION))
+    for idx, opcode, modulator_opcode, value, seq_id in zip(
+            events.tolist(), opcodes[events].tolist(),
+            modulator_opcodes[events].tolist(), payload[events].tolist(),
+            seq_ids[events].tolist()):
+        #update phases at these boundaries
+        if opcode != MODULATION or modulator_opcode == 0x0:
+            for ct in range(NUM_NCO):
+                if reset_flag[ct]:
+                    #would expect this to be zero but this is first non-zero point
+                    accumulated_phase[ct] = next_freq[ct] * ADDRESS_UNIT
+                    reset_flag[ct] = False
+            freq[:] = next_freq[:]
+            phase[:] = next_phase[:]
+            frame[:] = next_frame[:]
+        if opcode != MODULATION:
+            continue
+
+        # modulator_op_code_map = {"MODULATE":0x0, "RESET_PHASE":0x2, "SET_FREQ":0x6, "SET_PHASE":0xa, "UPDATE_FRAME":0xe}
+        nco_select_bits = (value >> 40) & 0xf
+        if modulator_opcode == 0x0:
+            #modulate
+            count = ((value & 0xffffffff) + 1) * ADDRESS_UNIT
+            nco_select = {0b0001: 0,
+                          0b0010: 1,
+                          0b0100: 2,
+                          0b1000: 3}[nco_select_bits]
+            if seq_id >= 0:
+                mod_phase[seq_id].append(
+                    freq[nco_select] * np.arange(count) +
+                    accumulated_phase[nco_select] + phase[nco_select] +
+                    frame[nco_select])
+            accumulated_phase += count * freq
+        else:
+            phase_rad = 2 * np.pi * (value & 0xffffffff) / 2**28
+            for ct in range(NUM_NCO):
+                if (nco_select_bits >> ct) & 0x1:
+                    if modulator_opcode == 0x2:
+                        #reset
+                        next_phase[ct] = 0
+                        next_frame[ct] = 0
+                        reset_flag[ct] = True
+                    elif modulator_opcode == 0x6:
+                        #set frequency
+                        next_freq[ct] = phase_rad / ADDRESS_UNIT
+                    elif modulator_opcode == 0xa:
+                        #set phase
+                        next_phase[ct] = phase_rad
+                    elif modulator_opcode == 0xe:
+                        #update frame
+                        next_frame[ct] += phase_rad
+
+    #Apply modulation if we have any
+    for ct, phases in enumerate(mod_phase):
+        if len(phases):
+            #only really works if ch1, ch2 are broadcast together
+            (time_ch1, amp_ch1), (time_ch2, amp_ch2) = analog['ch1'][ct], analog['ch2'][ct]
+            num_entries = min(len(time_ch1), len(time_ch2))
+            analog['ch1'][ct], analog['ch2'][ct] = modulate_entries(
+                np.concatenate(phases), time_ch1[:num_entries],
+                amp_ch1[:num_entries], time_ch2[:num_entries],
+                amp_ch2[:num_entries])
+
+    for chan in ['ch1', 'ch2']:
+        seqs[chan] = [list(zip(times.tolist(), amps.tolist()))
+                      for times, amps in analog[chan]]
     return seqs
 
 
+def modulate_entries(mod_phase, time_ch1, amp_ch1, time_ch2, amp_ch2):
+    '''
+    Applies the NCO phases 'mod_phase' to the (time, amplitude) entries of a
+    pair of analog channels, expanding the non-zero entries sample by sample.
+    '''
+    nonzero = (amp_ch1 != 0) | (amp_ch2 != 0)
+    assert np.all(time_ch1[nonzero] == time_ch2[nonzero])
+    start_times = np.cumsum(time_ch1) - time_ch1
+    num_points = np.where(nonzero, time_ch1, 1)
+    offsets = np.arange(num_points.sum()) - np.repeat(
+        np.cumsum(num_points) - num_points, num_points)
+    expanded = np.repeat(nonzero, num_points)
+    samples = (np.repeat(start_times, num_points) + offsets)[expanded]
+    modulated = np.exp(1j * mod_phase[samples]) * np.repeat(
+        amp_ch1 + 1j * amp_ch2, num_points)[expanded]
+    out = []
+    for times, amps, part in [(time_ch1, amp_ch1, modulated.real),
+                              (time_ch2, amp_ch2, modulated.imag)]:
+        times = np.repeat(times, num_points)
+        times[expanded] = 1
+        amps = np.repeat(amps, num_points)
+        amps[expanded] = part
+        out.append((times, amps))
+    return out
+
+
 def update_wf_library(filename, pulses, offsets):
     """
     Update a H5 waveform library in place give an iterable of (pulseName, pulse)
@@ -1283,7 +1991,7 @@ def update_wf_library(filename, pulses, offsets):
     """
     assert USE_PHASE_OFFSET_INSTRUCTION == False
     #load the h5 file
-    with h5py.File(filename) as FID:
+    with h5py.File(filename, 'r+') as FID:
         for label, pulse in pulses.items():
             #create a new waveform
             if pulse.isTimeAmp:
@@ -1442,13 +2150,21 @@ def write_tdm_seq(seq, tdm_fileName):
         FID['/'].attrs['channelDataFor'] = np.uint16([1, 2])
 
         #Create the groups and datasets
-        for chanct in range(2):
-            chanStr = '/chan_{0}'.format(chanct + 1)
-            chanGroup = FID.create_group(chanStr)
-            FID.create_dataset(chanStr + '/waveforms', data=np.uint16([]))
-            #Write the instructions to channel 1
-            if np.mod(chanct, 2) == 0:
-                FID.create_dataset(chanStr + '/instructions', data=seq)
+        for name, data in tdm_datasets(seq).items():
+            FID.create_dataset(name, data=data)
+
+def tdm_datasets(seq):
+    '''
+    The arrays of a TDM sequence file keyed by their dataset names.
+    '''
+    datasets = OrderedDict()
+    for chanct in range(2):
+        chanStr = '/chan_{0}'.format(chanct + 1)
+        datasets[chanStr + '/waveforms'] = np.uint16([])
+        #Write the instructions to channel 1
+        if np.mod(chanct, 2) == 0:
+            datasets[chanStr + '/instructions'] = np.asarray(seq)
+    return datasets
 
 # Utility Functions for displaying programs
 
@@ -1471,8 +2187,7 @@ def read_instructions(filename):
 def replace_instructions(filename, instructions, channel = 1):
     channelStr =  get_channel_instructions_string(channel)
     with h5py.File(filename, 'r+') as fid:
-        del fid[channelStr]
-        fid.create_dataset(channelStr, data=instructions)
+        write_dataset(fid, channelStr, np.asarray(instructions, dtype=np.uint64))
 
 def display_decompiled_file(filename, tdm = False):
     raw = raw_instructions(filename)
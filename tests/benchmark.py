@@ -0,0 +1,208 @@
+'''
+Benchmarks of the compiler and the drivers on representative workloads.
+
+Each benchmark runs a workload on the APS2 channel library of the unit tests
+a few times and records its wall times along with the peak memory allocated
+by one extra, traced run. The time to import QGL is measured in fresh
+interpreters. The results are saved as JSON so that they can be
+compared against a baseline, e.g. tests/benchmark_baseline.json:
+
+    BBN_MEAS_FILE=tests/test_measure.yml python -m tests.benchmark --save out.json
+    BBN_MEAS_FILE=tests/test_measure.yml python -m tests.benchmark --compare tests/benchmark_baseline.json
+
+Comparing exits with status 1 when a benchmark got slower or used more memory
+than the baseline by more than the tolerance. Timings depend on the machine,
+so baselines should be recorded on the machine they are compared on.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+
+import QGL
+from QGL import *
+from QGL.drivers import APS2Pattern
+
+from .test_Sequences import APS2Helper
+
+
+class BenchmarkLibrary(APS2Helper):
+    '''
+    The channel library of the APS2 unit tests, compiling to a benchmark
+    folder of config.AWGDir.
+    '''
+
+    def __init__(self):
+        APS2Helper.__init__(self)
+        APS2Helper.setUp(self)
+        QGL.config.AWGDir = os.path.normpath(
+            os.path.join(self.awg_dir, os.pardir, 'Benchmark'))
+        if not os.path.exists(QGL.config.AWGDir):
+            os.makedirs(QGL.config.AWGDir)
+
+
+def rb_lengths(numQubits, numLengths, repeats):
+    np.random.seed(20180201)
+    lengths = [2**n for n in range(1, numLengths + 1)]
+    return create_RB_seqs(numQubits, lengths, repeats=repeats)
+
+
+def benchmarks(lib):
+    '''
+    Returns the benchmarks keyed by name, as (setup, run) pairs: setup()
+    builds the inputs outside of the measurement and run(inputs) is timed.
+    '''
+    q1, q2 = lib.q1, lib.q2
+    rb_file = []
+
+    def read_setup():
+        if not rb_file:
+            SingleQubitRB(q1, rb_lengths(1, 6, 32))
+            rb_file.append(os.path.join(QGL.config.AWGDir, 'RB', 'RB-APS1.h5'))
+        return rb_file[0]
+
+    out = OrderedDict()
+    for numLengths, repeats in [(4, 8), (6, 32), (8, 64)]:
+        out['SingleQubitRB-{}x{}'.format(numLengths, repeats)] = (
+            lambda n=numLengths, r=repeats: rb_lengths(1, n, r),
+            lambda seqs: SingleQubitRB(q1, seqs))
+    for numLengths, repeats in [(3, 4), (5, 16)]:
+        out['TwoQubitRB-{}x{}'.format(numLengths, repeats)] = (
+            lambda n=numLengths, r=repeats: rb_lengths(2, n, r),
+            lambda seqs: TwoQubitRB(q1, q2, seqs))
+    for numAmps in [101, 1001]:
+        out['RabiAmp-{}'.format(numAmps)] = (
+            lambda n=numAmps: np.linspace(-1, 1, n),
+            lambda amps: RabiAmp(q1, amps))
+    out['CPMG-200'] = (
+        lambda: 4 * np.arange(1, 51),
+        lambda numPulses: CPMG(q1, numPulses, 100e-9))
+    out['Reset-2'] = (lambda: None, lambda _: Reset((q1, q2)))
+    out['read_sequence_file'] = (read_setup, APS2Pattern.read_sequence_file)
+    return out
+
+
+def measure(setup, run, repeat):
+    '''
+    Times 'repeat' runs of a benchmark, then traces the memory of one more.
+    '''
+    times = []
+    for _ in range(repeat):
+        inputs = setup()
+        start = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - start)
+    inputs = setup()
+    tracemalloc.start()
+    try:
+        run(inputs)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return OrderedDict([('wall_time', min(times)),
+                        ('times', times),
+                        ('peak_memory', peak_memory)])
+
+
+def measure_import(repeat):
+    '''
+    Times importing QGL in a fresh interpreter, as scripts and spawned worker
+    processes do, net of the startup of the interpreter itself.
+    '''
+    def run_python(code):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code])
+        return time.perf_counter() - start
+    startup = min(run_python('pass') for _ in range(repeat))
+    times = [run_python('import QGL') - startup for _ in range(repeat)]
+    return OrderedDict([('wall_time', min(times)),
+                        ('times', times),
+                        ('peak_memory', None)])
+
+
+def report(name, result):
+    memory = result['peak_memory']
+    print('{0:<24} {1:>10.1f} ms {2:>10} MB'.format(
+        name, 1e3 * result['wall_time'],
+        '-' if memory is None else '{0:.1f}'.format(memory / 2**20)))
+
+
+def run_benchmarks(names=None, repeat=3):
+    '''
+    Runs the benchmarks whose name contains one of 'names' (all of them by
+    default) and returns the results along with a description of the
+    environment.
+    '''
+    results = OrderedDict()
+    if not names or any(n in 'import' for n in names):
+        results['import'] = measure_import(repeat)
+        report('import', results['import'])
+    lib = BenchmarkLibrary()
+    for name, (setup, run) in benchmarks(lib).items():
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = measure(setup, run, repeat)
+        report(name, results[name])
+    return OrderedDict([
+        ('environment', OrderedDict([
+            ('python', platform.python_version()),
+            ('numpy', np.__version__),
+            ('machine', platform.machine()),
+            ('processor', platform.processor()),
+            ('date', time.strftime('%Y-%m-%d'))])),
+        ('benchmarks', results)])
+
+
+def compare_results(results, baseline, tolerance=1.5):
+    '''
+    Returns a list of the regressions of 'results' against 'baseline': the
+    benchmarks whose wall time or peak memory grew by more than a factor
+    'tolerance'.
+    '''
+    regressions = []
+    for name, new in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        for key in ['wall_time', 'peak_memory']:
+            if old.get(key) and new[key] is not None and new[key] > tolerance * old[key]:
+                regressions.append('{0}: {1} went from {2:.4g} to {3:.4g}'.format(
+                    name, key, old[key], new[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='only run the benchmarks containing these names')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--save', help='file to save the results to')
+    parser.add_argument('--compare', help='baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='ratio to the baseline flagged as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.names, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as FID:
+            json.dump(results, FID, indent=2)
+    if args.compare:
+        with open(args.compare) as FID:
+            baseline = json.load(FID)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
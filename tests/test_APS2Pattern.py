@@ -1,4 +1,7 @@
 import h5py
+import os
+import tempfile
+import time
 import unittest
 import numpy as np
 from copy import copy
@@ -47,6 +50,115 @@ class APSPatternUtils(unittest.TestCase):
             instrOpCode = (actual.header >> 4) & 0xf
             assert (instrOpCode == expected)
 
+    def test_instruction_array(self):
+        start = BlockLabel.BlockLabel('start')
+        loop = BlockLabel.BlockLabel('loop')
+        missing = BlockLabel.BlockLabel('missing')
+        instrs = [APS2Pattern.Sync(label=start),
+                  APS2Pattern.Goto(loop),
+                  APS2Pattern.Waveform(0, 24, False, write=True),
+                  APS2Pattern.Goto(missing),
+                  APS2Pattern.Marker(1, 1, 13, label=loop),
+                  APS2Pattern.Call(start),
+                  APS2Pattern.NoOp()]
+        array = APS2Pattern.InstructionArray(capacity=2)
+        for instr in instrs:
+            array.append_instruction(instr)
+        assert len(array) == len(instrs)
+        assert list(array) == instrs
+
+        APS2Pattern.resolve_symbols(instrs)
+        array.resolve_symbols()
+        assert [instr.address for instr in array] == [instr.address for instr in instrs]
+        assert array.flatten().tolist() == [instr.flatten() for instr in instrs]
+
+        # slices keep their symbols
+        other = APS2Pattern.InstructionArray()
+        other.append_repeated(APS2Pattern.NOP_HEADER, APS2Pattern.NOP_PAYLOAD, 2)
+        other.extend(array, 4, 6)
+        assert list(other) == [APS2Pattern.NoOp()] * 2 + instrs[4:6]
+        assert other[2].label == loop and other[3].target == start
+
+    def test_compress_loops(self):
+        start = BlockLabel.BlockLabel('start')
+        middle = BlockLabel.BlockLabel('middle')
+        block = [APS2Pattern.Waveform(0, 24, False, write=True),
+                 APS2Pattern.Marker(1, 1, 13, write=True)]
+        instrs = ([APS2Pattern.Sync(label=start)] + block * 5 +
+                  [copy(block[0]), copy(block[1])] + block * 2 +
+                  [APS2Pattern.Goto(start)])
+        instrs[11].label = middle
+        array = APS2Pattern.InstructionArray()
+        for instr in instrs:
+            array.append_instruction(instr)
+        compressed, seq_starts = APS2Pattern.compress_loops(array, [0, len(array)])
+        assert seq_starts == [0, len(compressed)]
+        opcodes = [instr.opcode for instr in compressed]
+        # the labeled copy starts a new loop
+        assert opcodes == [APS2Pattern.SYNC,
+                           APS2Pattern.LOAD, APS2Pattern.WFM, APS2Pattern.MARKER, APS2Pattern.REPEAT,
+                           APS2Pattern.LOAD, APS2Pattern.WFM, APS2Pattern.MARKER, APS2Pattern.REPEAT,
+                           APS2Pattern.GOTO]
+        assert compressed[1].payload == 4 and compressed[5].payload == 2
+        assert compressed[5].label == middle
+        assert compressed[4].target == compressed[2].label
+
+        # sequences with loops are left alone
+        array.append_command(APS2Pattern.LOAD, 1)
+        compressed, _ = APS2Pattern.compress_loops(array, [0, len(array)])
+        assert list(compressed) == list(array)
+
+    def test_plan_cache_lines(self):
+        def waveform(key):
+            wf = Compiler.Waveform()
+            wf.key = key
+            wf.amp = 1.0
+            wf.length = 4
+            return wf
+        a, b, c = waveform('a'), waveform('b'), waveform('c')
+        wf_sizes = {APS2Pattern.wf_sig(wf): 4 for wf in (a, b, c)}
+        seqs = [[a], [a, b], [b], [c], [c, a]]
+        assert APS2Pattern.plan_cache_lines(seqs, wf_sizes, 8) == [(0, 3), (3, 5)]
+        assert APS2Pattern.plan_cache_lines(seqs, wf_sizes, 12) == [(0, 5)]
+        # among the splits with the fewest lines, duplicate as little as possible
+        wf_sizes[APS2Pattern.wf_sig(c)] = 2
+        seqs = [[a], [c], [b, c], [b]]
+        assert APS2Pattern.plan_cache_lines(seqs, wf_sizes, 8) == [(0, 1), (1, 4)]
+        self.assertRaises(RuntimeError, APS2Pattern.plan_cache_lines,
+                          [[a, b, c]], wf_sizes, 8)
+
+        # thousands of sequences sharing their waveforms (as in RB) are
+        # planned in linear time
+        shared = [waveform(key) for key in range(48)]
+        wf_sizes = {APS2Pattern.wf_sig(wf): 100 for wf in shared}
+        seqs = [[shared[(7 * ct + n) % 48] for n in range(20)] for ct in range(5000)]
+        start = time.perf_counter()
+        assert APS2Pattern.plan_cache_lines(seqs, wf_sizes, 4800) == [(0, 5000)]
+        lines = APS2Pattern.plan_cache_lines(seqs, wf_sizes, 2400)
+        assert time.perf_counter() - start < 5
+        assert [stop for _, stop in lines][-1] == 5000
+        assert all(stop == next_start for (_, stop), (next_start, _) in zip(lines, lines[1:]))
+
+    def test_write_dataset(self):
+        data = np.arange(10**6, dtype=np.uint64)
+        with tempfile.TemporaryDirectory() as path:
+            fileName = os.path.join(path, 'test.h5')
+            with h5py.File(fileName, 'w') as FID:
+                assert APS2Pattern.write_dataset(FID, 'chan_1/instructions', data) == len(data)
+                step = FID['chan_1/instructions'].chunks[0]
+            data[12345] = 0
+            with h5py.File(fileName, 'r+') as FID:
+                # only the chunk that changed is rewritten
+                assert APS2Pattern.write_dataset(FID, 'chan_1/instructions', data) == step
+                assert APS2Pattern.write_dataset(FID, 'chan_1/instructions', data[:-10]) == 0
+                assert APS2Pattern.write_dataset(FID, 'chan_1/instructions', data) == 10
+                assert np.array_equal(FID['chan_1/instructions'][()], data)
+                # datasets of another type are replaced
+                wfs = np.zeros(100, dtype=np.int16)
+                FID.create_dataset('chan_1/waveforms', data=wfs)
+                assert APS2Pattern.write_dataset(FID, 'chan_1/waveforms', wfs) == len(wfs)
+                assert FID['chan_1/waveforms'].maxshape == (None, )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+from functools import reduce
+
+import numpy as np
+
+from QGL import config
+from QGL import Cliffords
+from QGL.BasicSequences import create_RB_arrays
+
+
+def matrix_inverse(seq, numQubits):
+    # the inverse of the product of 'seq' found by scanning the matrices
+    mat = reduce(lambda x, y: np.dot(y, x),
+                 [Cliffords.clifford_mat(c, numQubits) for c in seq])
+    numCliffords = 24 if numQubits == 1 else len(Cliffords.C2Seqs)
+    for ct in range(numCliffords):
+        if np.isclose(np.abs(np.dot(mat, Cliffords.clifford_mat(ct, numQubits)).trace()),
+                      mat.shape[0]):
+            return ct
+
+
+class CliffordsTest(unittest.TestCase):
+
+    def test_single_qubit_table(self):
+        table = Cliffords.clifford_table(1)
+        for c1 in range(24):
+            for c2 in range(24):
+                assert table.product([c1, c2]) == Cliffords.clifford_multiply(c1, c2)
+            assert table.product([c1, table.inverse(c1)]) == 0
+        np.random.seed(20180201)
+        for seq in np.random.randint(0, 24, size=(10, 5)).tolist():
+            assert table.inverse(table.product(seq)) == matrix_inverse(seq, 1)
+
+    def test_two_qubit_table(self):
+        table = Cliffords.clifford_table(2)
+        np.random.seed(20180201)
+        for seq in np.random.randint(0, len(Cliffords.C2Seqs), size=(5, 4)).tolist():
+            recovery = table.inverse(table.product(seq))
+            assert recovery == matrix_inverse(seq, 2)
+            mat = reduce(lambda x, y: np.dot(y, x),
+                         [Cliffords.clifford_mat(c, 2) for c in seq])
+            assert Cliffords.inverse_clifford(mat) == recovery
+
+    def test_RB_arrays(self):
+        np.random.seed(20180201)
+        for numQubits in [1, 2]:
+            table = Cliffords.clifford_table(numQubits)
+            arrays = create_RB_arrays(numQubits, [2, 5], repeats=4, interleaveGate=7)
+            assert [array.shape for array in arrays] == [(4, 3), (4, 9)]
+            for seq in arrays[1]:
+                assert np.all(seq[1:-1:2] == 7)
+                assert table.product(seq) == 0
+                assert seq[-1] == matrix_inverse(seq[:-1].tolist(), numQubits)
+
+    def test_saved_table(self):
+        AWGDir = config.AWGDir
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config.AWGDir = tmpdir
+            try:
+                actions = Cliffords.build_clifford_actions(1)
+                fileName = Cliffords.clifford_table_file(1)
+                assert os.path.exists(fileName)
+                np.savez(fileName, actions=actions[::-1])
+                # the saved table is used as is
+                assert np.array_equal(Cliffords.build_clifford_actions(1),
+                                      actions[::-1])
+            finally:
+                config.AWGDir = AWGDir
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,13 @@
 import h5py
+import tempfile
+import types
 import unittest
 import numpy as np
 
 from QGL import *
 
+# read by a shape function in test_compile_cache
+RAMP_END = 0
 
 class CompileUtils(unittest.TestCase):
     def setUp(self):
@@ -72,6 +76,55 @@ class CompileUtils(unittest.TestCase):
             (seq[0].amp * seq[0].shape, 1j * seq[1].amp * seq[1].shape))
         assert all(abs(entry.shape - wf) < 1e-16)
 
+    def test_composite_shape_shared(self):
+        q1 = self.q1
+        q2 = self.q2
+        q1.pulse_params['length'] = 20e-9
+        q2.pulse_params['length'] = 40e-9
+        seqs = [[(X90(q1) + Y90(q1)) * X(q2)] for _ in range(2)]
+        ll = Compiler.compile_sequences(seqs)
+        merged = Compiler.merge_channels(ll, [q1, q2])
+        pulses = [[e for e in seq if isinstance(e, Pulse)][0] for seq in merged]
+        # the merged waveform is built from one node, evaluated once
+        node = pulses[0].shapeParams['shape_fun']
+        assert isinstance(node, PulseShapes.CompositeShape)
+        assert node.operation == 'sum'
+        assert pulses[1].shapeParams['shape_fun'] is node
+        assert pulses[0].hashshape() == pulses[1].hashshape()
+        wf = pulses[0].shape
+        assert pulses[1].shape is wf
+        assert list(node.samples) == [q1.phys_chan.sampling_rate]
+        stack = node.pulses[0].shapeParams['shape_fun']
+        assert stack.operation == 'stack'
+        X90p, Y90p = X90(q1), Y90(q1)
+        expected = np.hstack((X90p.amp * X90p.shape, 1j * Y90p.amp * Y90p.shape)) + \
+                   X(q2).amp * X(q2).shape
+        assert np.allclose(wf, expected)
+
+    def test_duplicate_sequences(self):
+        q1 = self.q1
+        seqs = create_cal_seqs((q1,), 3)
+        # the first and last sequences are kept as is
+        assert Compiler.find_duplicate_sequences(seqs) == [0, 1, 1, 3, 3, 5]
+        seqs[2][0] = X(q1, amp=0.5)
+        assert Compiler.find_duplicate_sequences(seqs) == [0, 1, 2, 3, 3, 5]
+
+        # distinct shape functions are never confused, even with the same
+        # name and signature, or the same code
+        f1 = lambda amp=1, length=0, sampling_rate=1e9, **params: amp * np.ones(int(length * sampling_rate))
+        f2 = lambda amp=1, length=0, sampling_rate=1e9, **params: amp * np.zeros(int(length * sampling_rate))
+        f3 = types.FunctionType(f1.__code__, f1.__globals__, f1.__name__, f1.__defaults__)
+        f3.__qualname__ = f1.__qualname__
+        seqs = [[Id(q1), MEAS(q1)]] + [[X(q1, shape_fun=f), MEAS(q1)] for f in (f1, f2, f3, f1)] + [[MEAS(q1)]]
+        assert Compiler.find_duplicate_sequences(seqs) == [0, 1, 2, 3, 1, 5]
+
+        wait = qwait()
+        wireSeqs = {q1: [[wait, X(q1)], [Y(q1)], [Z(q1)]]}
+        wires = Compiler.expand_wires(wireSeqs, [0, 0, 2])[q1]
+        assert wires == [[wait, X(q1)], [wait, X(q1)], [Y(q1)], [Z(q1)]]
+        # the control flow of duplicates is copied
+        assert wires[1][0] is not wait and wires[1][1] is wires[0][1]
+
     def test_pull_uniform_entries(self):
         q1 = self.q1
         q1.pulse_params['length'] = 20e-9
@@ -108,6 +161,20 @@ class CompileUtils(unittest.TestCase):
         self.assertAlmostEqual(max_length, 120e-9)
         self.assertTrue(all(np.isclose(e.length, max_length, atol=1e-10) for e in entries))
 
+    def test_pull_uniform_entries_zero(self):
+        q1 = self.q1
+        q1.pulse_params['length'] = 20e-9
+        q2 = self.q2
+        seq = [(X90(q1) + Y90(q1) + X90(q1)) * Id(q2, 60e-9)]
+        ll = Compiler.compile_sequence(seq)
+        entryIterators = [iter(ll[q1]), iter(ll[q2])]
+        entries = [next(e) for e in entryIterators]
+        entries, max_length = Compiler.pull_uniform_entries(entries, entryIterators)
+        # the only non-zero channel is passed through without concatenating
+        assert len(entries) == 1
+        assert entries[0] == ll[q1][:3]
+        self.assertAlmostEqual(max_length, 60e-9)
+
     def test_merge_channels(self):
         q1 = self.q1
         q1.pulse_params['length'] = 20e-9
@@ -159,6 +226,134 @@ class CompileUtils(unittest.TestCase):
         assert wire_meas[mq1] == 3
         assert wire_meas[mq2] == 4
 
+    def test_compile_sequences_parallel(self):
+        q1 = self.q1
+        q2 = self.q2
+        def make_seqs():
+            seqs = [[X90(q1), Id(q2, 40e-9*ct), Y(q1)*X(q2), MEAS(q1)] for ct in range(8)]
+            seqs[0].insert(0, BlockLabel.BlockLabel('start'))
+            return seqs
+        serial = Compiler.compile_sequences(make_seqs(), set())
+        parallel = Compiler.compile_sequences(make_seqs(), set(), workers=2)
+        assert list(serial.keys()) == list(parallel.keys())
+        for chan in serial.keys():
+            assert serial[chan] == parallel[chan]
+            # channels come back as the same objects, not copies
+            for wire in parallel[chan]:
+                for entry in wire:
+                    if isinstance(entry, Pulse):
+                        assert entry.channel is chan
+
+    def test_compile_cache(self):
+        q1 = self.q1
+        q2 = self.q2
+        def make_seqs():
+            seqs = [[X90(q1), Id(q2, 40e-9*ct), Y(q1)*X(q2), MEAS(q1)] for ct in range(4)]
+            seqs[0].insert(0, BlockLabel.BlockLabel('start'))
+            return seqs
+        with tempfile.TemporaryDirectory() as path:
+            cache = CompileCache.CompileCache(path)
+            fresh = Compiler.compile_sequences(make_seqs(), set(), cache=cache)
+            assert cache.stats['sequence_hits'] == 0
+            cached = Compiler.compile_sequences(make_seqs(), set(), cache=cache)
+            # the prototype sequence is always compiled
+            assert cache.stats['sequence_hits'] == 3
+            for chan in fresh.keys():
+                assert fresh[chan] == cached[chan]
+                for wire in cached[chan]:
+                    for entry in wire:
+                        if isinstance(entry, Pulse):
+                            assert entry.channel is chan
+
+            # changing a channel parameter invalidates the entries
+            cache.reset_stats()
+            q2.frequency = 10e6
+            Compiler.compile_sequences(make_seqs(), set(), cache=cache)
+            assert cache.stats['sequence_hits'] == 0
+
+            # so does editing a shape function
+            def ramp(amp=1, length=0, sampling_rate=1e9, **params):
+                return amp * np.linspace(0, 1, int(length * sampling_rate))
+            seqs = [[X(q1, shape_fun=ramp), MEAS(q1)]]
+            keys = cache.sequence_keys(seqs, {q1})
+            waveform_key = cache.waveform_key(seqs[0][0])
+            def ramp(amp=1, length=0, sampling_rate=1e9, **params):
+                return amp * np.linspace(1, RAMP_END, int(length * sampling_rate))
+            seqs = [[X(q1, shape_fun=ramp), MEAS(q1)]]
+            assert cache.sequence_keys(seqs, {q1}) != keys
+            assert cache.waveform_key(seqs[0][0]) != waveform_key
+            # or a constant it reads
+            global RAMP_END
+            waveform_key = cache.waveform_key(seqs[0][0])
+            RAMP_END = 0.5
+            assert cache.waveform_key(seqs[0][0]) != waveform_key
+            RAMP_END = 0
+            # closures are keyed by the values they capture
+            def make_ramp(end):
+                return lambda amp=1, length=0, sampling_rate=1e9, **params: \
+                    amp * np.linspace(1, end, int(length * sampling_rate))
+            assert cache.waveform_key(X(q1, shape_fun=make_ramp(0))) == \
+                cache.waveform_key(X(q1, shape_fun=make_ramp(0)))
+            assert cache.waveform_key(X(q1, shape_fun=make_ramp(0))) != \
+                cache.waveform_key(X(q1, shape_fun=make_ramp(0.5)))
+
+            cache.max_size = 1
+            cache.prune()
+            assert cache.stats['evictions'] > 0
+            assert cache.size <= 1
+
+    def test_preprocess_sweep(self):
+        q1 = self.q1
+        def make_seqs():
+            seqs = [[Utheta(q1, amp=amp), MEAS(q1)] for amp in np.linspace(-1, 1, 5)]
+            seqs += [[X90(q1), Id(q1, d), U90(q1, phase=d*1e6), MEAS(q1)]
+                     for d in np.linspace(0, 1e-6, 5)]
+            seqs += [[Id(q1), MEAS(q1)], [X(q1), MEAS(q1)]]
+            return seqs
+        seqs = make_seqs()
+        Compiler.preprocess_sequences(seqs)
+        swept = make_seqs()
+        Compiler.preprocess_sweep(swept)
+        # the measurement block is shared with the template
+        assert swept[1][-1] is swept[0][-1]
+        channels = set.union(*[Compiler.find_unique_channels(seq) for seq in seqs])
+        for seq, stamped in zip(seqs, swept):
+            wires = Compiler.compile_sequence(seq, channels)
+            stamped_wires = Compiler.compile_sequence(stamped, channels)
+            for chan in channels:
+                assert wires[chan] == stamped_wires[chan]
+
+        # sequences that only differ in structure are preprocessed as usual
+        raw = [Utheta(q1, amp=0.5), MEAS(q1)]
+        processed = list(raw)
+        Compiler.preprocess_sequences([processed])
+        assert Compiler.stamp_sweep_template(raw, processed, [Utheta(q1, amp=0.2), MEAS(q1)])
+        assert Compiler.stamp_sweep_template(raw, processed, [Utheta(q1, amp=0), MEAS(q1)]) is None
+        assert Compiler.stamp_sweep_template(raw, processed, [Utheta(q1, amp=0.5, length=40e-9), MEAS(q1)]) is None
+        assert Compiler.stamp_sweep_template(raw, processed, [X(q1), MEAS(q1)]) is None
+
+    def test_extract_subroutines(self):
+        q1 = self.q1
+        q2 = self.q2
+        tail = [X90(q1), Y90(q1), X(q2), MEAS(q1)]
+        seqs = [[ControlFlow.Wait(), X90(q1), Id(q1, 20e-9*ct)] + tail for ct in range(4)]
+        seqs += [[ControlFlow.Wait(), X90(q1), Z90(q1)] + tail,
+                 [ControlFlow.Wait(), Id(q1), MEAS(q1)]]
+        labels = Compiler.extract_subroutines(seqs)
+        assert len(labels) == 1
+        subroutine = ControlFlow.qfunction_specialization(labels[0])
+        assert subroutine[1:] == tail + [ControlFlow.Return()]
+        for seq in seqs[:4]:
+            assert seq[-1] == ControlFlow.Call(labels[0])
+            assert len(seq) == 4
+        # the fragment would follow a frame change
+        assert seqs[4][-1] == MEAS(q1)
+        assert len(seqs[5]) == 3
+
+        # measurements in subroutines count once per call
+        wireSeqs = Compiler.compile_sequences(seqs)
+        assert Compiler.count_measurements(wireSeqs) == 6
+
     def test_frame_update(self):
         # test that the compiler replaces Z's with frame updates
         q1 = self.q1
@@ -173,5 +368,15 @@ class CompileUtils(unittest.TestCase):
         for p, frame_change in zip(out_seq, expected_frame_change):
             assert p.frameChange == frame_change
 
+    def test_waveform_slots(self):
+        q1 = self.q1
+        wfs = [Compiler.Waveform(p) for p in Compiler.compile_sequence([X(q1), Y90(q1)])[q1]]
+        assert not hasattr(wfs[0], '__dict__')
+        assert wfs[0].startTime is None
+        # waveforms are compared by value
+        assert Compiler.Waveform(X(q1)) == Compiler.Waveform(X(q1))
+        assert Compiler.Waveform(X(q1)) != Compiler.Waveform(Y(q1))
+        assert len({Compiler.Waveform(X(q1)), Compiler.Waveform(X(q1))}) == 1
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,12 +1,15 @@
 import h5py
 import numpy as np
-import unittest, time, os, random, sys
+import unittest, time, os, random, sys, json
+import asyncio, concurrent.futures, tracemalloc
+from contextlib import contextmanager
 
 from QGL import *
 import QGL
 
 from QGL.Channels import Edge, Measurement, LogicalChannel, LogicalMarkerChannel, PhysicalMarkerChannel, PhysicalQuadratureChannel
 from QGL.drivers import APSPattern, APS2Pattern, TekPattern
+from QGL import Cliffords
 
 # Pulled in logger to help debug stand-alone run issue with the config.AWGDir
 # (the configuration was NOT gettng loaded when run independently)
@@ -440,6 +443,201 @@ class TestAPS2(unittest.TestCase, APS2Helper, TestSequences):
         filenames = compile_to_hardware(seqs, 'CNOT_CR_mux/CNOT_CR_mux')
         self.compare_sequences('CNOT_CR_mux')
 
+    def test_profile(self):
+        self.set_awg_dir()
+        q1 = self.q1
+        seqs = [[X90(q1), Id(q1, 20e-9*n), Y(q1), MEAS(q1)] for n in range(4)]
+        profiler = CompileProfile.Profiler()
+        metafile = compile_to_hardware(seqs, 'Profile/Profile', profile=profiler)
+        for stage in ['save_code', 'add_digitizer_trigger', 'add_gate_pulses',
+                      'compile_sequences', 'apply_gating_constraints',
+                      'map_logical_to_physical', 'generate_waveforms',
+                      'write_meta']:
+            assert profiler.stages[stage].calls == 1
+            assert profiler.stages[stage].peak_memory >= 0
+        # one call per AWG
+        assert profiler.stages['APS2Pattern.write_sequence_file'].calls == 2
+        with open(metafile) as FID:
+            meta = json.load(FID)
+        assert set(meta['compile_profile']) == set(profiler.stages) - {'write_meta'}
+
+        # concurrent compilations share the profiler and the tracing of memory
+        profiler.reset()
+        make_seqs = lambda: [[X90(q1), Id(q1, 20e-9*n), Y(q1), MEAS(q1)] for n in range(4)]
+        async def compile_both():
+            return await asyncio.gather(*[compile_to_hardware_async(
+                make_seqs(), 'Profile/Concurrent{}'.format(ct), profile=profiler)
+                for ct in range(2)])
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(compile_both())
+        finally:
+            loop.close()
+        for stage in ['add_gate_pulses', 'compile_sequences', 'generate_waveforms']:
+            assert profiler.stages[stage].calls == 2
+            assert profiler.stages[stage].peak_memory >= 0
+        assert not tracemalloc.is_tracing()
+
+    def test_streaming(self):
+        self.set_awg_dir()
+        q1 = self.q1
+        def make_seqs():
+            for n in range(1, 8):
+                yield [X90(q1), Id(q1, 20e-9*n), Y(q1)] * n + [MEAS(q1)]
+            yield [X(q1)] + repeat(5, [Y90(q1), X90(q1)]) + [MEAS(q1)]
+
+        BlockLabel.newlabel.numlabels = 0
+        compile_to_hardware(list(make_seqs()), 'Streaming/Streaming')
+        for chunk_size in [1, 3]:
+            BlockLabel.newlabel.numlabels = 0
+            compile_to_hardware_streaming(make_seqs(), 'Streaming/Streaming',
+                                          chunk_size=chunk_size,
+                                          suffix=str(chunk_size))
+            for awg in ['APS1', 'APS2']:
+                fileName = os.path.join(self.awg_dir, 'Streaming', 'Streaming-' + awg)
+                with h5py.File(fileName + '.h5', 'r') as FID, \
+                        h5py.File(fileName + str(chunk_size) + '.h5', 'r') as streamed:
+                    for dataset in ['chan_1/waveforms', 'chan_2/waveforms',
+                                    'chan_1/instructions']:
+                        assert np.array_equal(FID[dataset][()],
+                                              streamed[dataset][()])
+
+    def test_compile_to_memory(self):
+        self.set_awg_dir()
+        q1 = self.q1
+        seqs = [[X90(q1), Id(q1, 20e-9*n), Y(q1), MEAS(q1)] for n in range(4)]
+        metafile = compile_to_hardware(seqs, 'Memory/Memory')
+        with open(metafile) as FID:
+            meta = json.load(FID)
+        seqs = [[X90(q1), Id(q1, 20e-9*n), Y(q1), MEAS(q1)] for n in range(4)]
+        buffers, mem_meta = compile_to_memory(seqs)
+        assert mem_meta['num_measurements'] == meta['num_measurements']
+        assert set(mem_meta['instruments']) == set(meta['instruments'])
+        for awg, fileName in meta['instruments'].items():
+            data = buffers[mem_meta['instruments'][awg]]
+            with h5py.File(fileName, 'r') as FID:
+                for name in ['/chan_1/waveforms', '/chan_2/waveforms',
+                             '/chan_1/instructions']:
+                    assert np.array_equal(FID[name][()], data[name])
+            assert data['/chan_1/instructions'].dtype == np.uint64
+
+    def test_compile_to_hardware_async(self):
+        self.set_awg_dir()
+        q1 = self.q1
+        seqs = [[X90(q1), Id(q1, 20e-9*n), Y(q1), MEAS(q1)] for n in range(4)]
+        metafile = compile_to_hardware(seqs, 'Async/Sync')
+        seqs = [[X90(q1), Id(q1, 20e-9*n), Y(q1), MEAS(q1)] for n in range(4)]
+        loop = asyncio.new_event_loop()
+        try:
+            async_metafile = loop.run_until_complete(
+                compile_to_hardware_async(seqs, 'Async/Async'))
+        finally:
+            loop.close()
+        with open(metafile) as FID:
+            meta = json.load(FID)
+        with open(async_metafile) as FID:
+            async_meta = json.load(FID)
+        assert async_meta['num_measurements'] == meta['num_measurements']
+        for awg, fileName in meta['instruments'].items():
+            with h5py.File(fileName, 'r') as FID, \
+                    h5py.File(async_meta['instruments'][awg], 'r') as async_FID:
+                for name in ['/chan_1/waveforms', '/chan_1/instructions']:
+                    assert np.array_equal(FID[name][()], async_FID[name][()])
+
+        # cancelling the task stops the compilation at the next stage
+        class CancellingProfiler(QGL.CompileProfile.Profiler):
+            @contextmanager
+            def stage(self, name):
+                if name == 'map_logical_to_physical':
+                    loop.call_soon_threadsafe(task.cancel)
+                    # let the task handle the cancellation before going on
+                    deadline = time.time() + 10
+                    while not task.done() and time.time() < deadline:
+                        time.sleep(1e-3)
+                with super().stage(name) as stats:
+                    yield stats
+        sweep = [[X90(q1), Id(q1, 20e-9*n), Y(q1), MEAS(q1)] for n in range(200)]
+        cancelled_meta = os.path.join(self.awg_dir, 'Async', 'Cancelled-meta.json')
+        if os.path.exists(cancelled_meta):
+            os.remove(cancelled_meta)
+        profiler = CancellingProfiler(trace_memory=False)
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(compile_to_hardware_async(
+                sweep, 'Async/Cancelled', profile=profiler, executor=executor))
+            with self.assertRaises(asyncio.CancelledError):
+                loop.run_until_complete(task)
+            executor.shutdown(wait=True)
+            assert 'map_logical_to_physical' in profiler.stages
+            assert 'generate_waveforms' not in profiler.stages
+            assert not os.path.exists(cancelled_meta)
+            # and leaves nothing behind for the next compilation
+            metafile = loop.run_until_complete(compile_to_hardware_async(
+                sweep, 'Async/Cancelled'))
+        finally:
+            loop.close()
+        with open(metafile) as FID:
+            assert json.load(FID)['num_measurements'] == len(sweep)
+
+    def test_write_workers(self):
+        self.set_awg_dir()
+        q1, q2 = self.q1, self.q2
+        make_seqs = lambda: [[X90(q1), Y(q2), Id(q1, 20e-9*n), MEAS(q1), MEAS(q2)]
+                             for n in range(4)]
+        metafile = compile_to_hardware(make_seqs(), 'WriteWorkers/Serial')
+        parallel_metafile = compile_to_hardware(make_seqs(), 'WriteWorkers/Parallel',
+                                                write_workers=2)
+        with open(metafile) as FID:
+            meta = json.load(FID)
+        with open(parallel_metafile) as FID:
+            parallel_meta = json.load(FID)
+        assert len(meta['instruments']) > 1
+        assert parallel_meta.get('extra_meta') == meta.get('extra_meta')
+        for awg, fileName in meta['instruments'].items():
+            with h5py.File(fileName, 'r') as FID, \
+                    h5py.File(parallel_meta['instruments'][awg], 'r') as parallel_FID:
+                for name in ['/chan_1/waveforms', '/chan_2/waveforms',
+                             '/chan_1/instructions']:
+                    assert np.array_equal(FID[name][()], parallel_FID[name][()])
+
+    def test_RB_library(self):
+        self.set_awg_dir()
+        q1 = self.q1
+        np.random.seed(20152606)
+        seqs = create_RB_seqs(1, [2, 8, 32], repeats=4)
+        metafile = SingleQubitRB_AC(q1, seqs)
+        with h5py.File(os.path.join(self.awg_dir, 'RB', 'RB-APS1.h5'), 'r') as FID:
+            instructions = FID['/chan_1/instructions'][()]
+            waveforms = FID['/chan_1/waveforms'][()]
+        SingleQubitRB_AC(q1, seqs, library=True)
+        with h5py.File(os.path.join(self.awg_dir, 'RB', 'RB-APS1.h5'), 'r') as FID:
+            assert np.array_equal(FID['/chan_1/instructions'][()], instructions)
+            assert np.array_equal(FID['/chan_1/waveforms'][()], waveforms)
+
+        library = Cliffords.CliffordLibrary(lambda c: Cliffords.clifford_seq(c, q1))
+        assert library(3) is library(3)
+
+    def test_read_sequence_file(self):
+        self.set_awg_dir()
+        q1 = self.q1
+        q1.frequency = 10e6
+        seqs = [[Utheta(q1, amp=amp), MEAS(q1)] for amp in [0.5, -0.5, 0.0]]
+        compile_to_hardware(seqs, 'ReadSequence/ReadSequence')
+        fileName = os.path.join(self.awg_dir, 'ReadSequence', 'ReadSequence-APS1.h5')
+        wfs = APS2Pattern.read_sequence_file(fileName)
+        assert all(len(wfs[chan]) == len(seqs) for chan in wfs)
+        for ct in range(len(seqs)):
+            lengths = [sum(time for time, _ in wfs[chan][ct])
+                       for chan in ['ch1', 'ch2', 'ch12m1']]
+            assert lengths[0] == lengths[1] == lengths[2]
+        # the pulses are modulated onto both quadratures
+        envelopes = [np.abs([a + 1j*b for (_, a), (_, b) in zip(wfs['ch1'][ct], wfs['ch2'][ct])])
+                     for ct in range(len(seqs))]
+        assert any(amp != 0 for _, amp in wfs['ch2'][0])
+        assert np.allclose(envelopes[0], envelopes[1])
+        assert not np.any(envelopes[2])
+
 
 class TestAPS1(unittest.TestCase, AWGTestHelper, TestSequences):
     def setUp(self):
@@ -31,6 +31,36 @@ class PulseTypes(unittest.TestCase):
         assert( type(X(q3) * CNOT_CR(q1, q2)) == CompoundGate )
         assert( type(CNOT_CR(q1, q2) * CNOT_CR(q3, q4)) == CompoundGate )
 
+    def test_fingerprints(self):
+        q1, q2 = self.q1, self.q2
+
+        pulse = X(q1)
+        assert pulse.fingerprint() == X(q1).fingerprint()
+        assert pulse.fingerprint() != Y(q1).fingerprint()
+        assert pulse.fingerprint() != X(q2).fingerprint()
+        assert pulse.fingerprint() != X(q1, amp=0.5).fingerprint()
+        assert pulse.hashshape() == X(q1).hashshape()
+        # a shared memo reuses the digests of shared sub-objects
+        memo = {}
+        assert pulse.fingerprint(memo) == pulse.fingerprint()
+        assert (pulse * X(q2)).fingerprint(memo) == (X(q1) * X(q2)).fingerprint()
+        # pulses stay slotted
+        assert not hasattr(pulse, '__dict__')
+
+        composite = X(q1) + Y(q1)
+        assert composite.fingerprint() == (X(q1) + Y(q1)).fingerprint()
+        assert composite.fingerprint() != (Y(q1) + X(q1)).fingerprint()
+
+        block = X(q1) * Y(q2)
+        assert block.fingerprint() == (X(q1) * Y(q2)).fingerprint()
+        fingerprint = block.fingerprint()
+        block.pulses[q2] = X(q2)
+        assert block.fingerprint() != fingerprint
+
+        gate = CNOT_CR(q1, q2)
+        assert gate.fingerprint() == CNOT_CR(q1, q2).fingerprint()
+        assert gate.fingerprint() != CNOT_CR(q2, q1).fingerprint()
+
 # Added to support simple python invocation
 #
 if __name__ == "__main__":